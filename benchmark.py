@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Benchmarks of the main paths of gedi (covariance matrix, log likelihood
+with and without the keplerian, gradient, predictions and the keplerian
+itself) for several numbers of points, recording the wall time and the
+peak memory allocated by numpy to a JSON file, and comparing them with a
+stored baseline:
+    python benchmark.py --output new.json --baseline baseline.json
+The exit status is 1 if any case got slower (or bigger) than the baseline
+by more than the tolerance, and the table shows for each case the slope of
+log(time) against log(N) between the two largest sizes, ~3 for the dense
+factorizations, so a change of complexity stands out. The cases estimated
+to need more than --memory (the memory of the machine by default) are
+skipped and listed with the memory they would need.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import scipy
+
+from gedi import calc, kernels, rvfunction
+
+#peak memory of each case in N x N float64 matrices, measured with
+#tracemalloc, to skip the sizes that do not fit in memory: N = 20000 needs
+#about 15 GB for the likelihood and 60 GB for gradient_composite
+_MATRICES = {'build_matrix': 5, 'likelihood': 5, 'likelihood_kepler': 5,
+             'gradient_single': 8, 'gradient_composite': 20,
+             'compute_kernel': 7, 'kepler': 0}
+
+
+def _physical_memory():
+    """ Memory of the machine in GB, 8 if it cannot be found """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2.**30
+    except (AttributeError, ValueError, OSError):
+        return 8.
+
+
+def needed_memory(name, n):
+    """ Estimated peak memory of a case with n points, in GB """
+    return _MATRICES[name] * 8. * n**2 / 2.**30
+
+
+def _data(n, seed=0):
+    """ Simulated data with n points """
+    rng = np.random.RandomState(seed)
+    x = np.sort(rng.uniform(0, 10*n**0.5, n))
+    yerr = 0.5 + 0.1*rng.rand(n)
+    y = 3*np.sin(2*np.pi*x/25) + yerr*rng.randn(n)
+    return x, y, yerr
+
+
+def cases(n):
+    """
+        cases() returns the functions to time with n points, with all their
+    inputs already prepared
+    """
+    x, y, yerr = _data(n)
+    single = kernels.ExpSquared(3, 20)
+    composite = kernels.ExpSquared(3, 40) * kernels.ExpSineSquared(1, 1, 25) \
+        + kernels.Matern32(0.5, 2) + kernels.WhiteNoise(0.3)
+    qp = kernels.QuasiPeriodic(3, 1, 40, 25) + kernels.WhiteNoise(0.3)
+    kepler_params = [12.3, 4, 0.3, 1.2, 0]
+    return {
+        'build_matrix': lambda: calc.build_matrix(composite, x, yerr),
+        'likelihood': lambda: calc.likelihood(qp, x, y, yerr),
+        'likelihood_kepler': lambda: calc.likelihood(qp, x, y, yerr, True,
+                                                     kepler_params),
+        'gradient_single': lambda: calc.gradient_likelihood(single, x, y,
+                                                            yerr),
+        'gradient_composite': lambda: calc.gradient_likelihood(composite, x,
+                                                               y, yerr),
+        'compute_kernel': lambda: calc.compute_kernel(qp, x, x, y, yerr),
+        'kepler': lambda: rvfunction.kepler(P=12.3, K=4, e=0.3, w=1.2, T=0,
+                                            t=x),
+        }
+
+
+def measure(function, repeat=3, budget=10.):
+    """
+        measure() times a function, keeping the best of a few runs, and
+    finds the peak memory allocated during one run
+
+        Parameters
+    function = function to time, without arguments
+    repeat = maximum number of runs
+    budget = no more runs are made after this many seconds
+
+        Returns
+    seconds = best wall time
+    peak = peak memory allocated, in MB
+    """
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1] / 2.**20
+    tracemalloc.stop()
+    best, total = np.inf, 0.
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+        best, total = min(best, seconds), total + seconds
+        if total > budget:
+            break
+    return best, peak
+
+
+def run(sizes, names=None, memory=None, repeat=3, verbose=True):
+    """
+        run() runs the benchmarks
+
+        Parameters
+    sizes = numbers of points
+    names = cases to run, all of them if None
+    memory = memory available, in GB, larger cases are skipped; the memory
+            of the machine if None
+    repeat = maximum number of runs of each case
+    verbose = True to print each result as it is measured
+
+        Returns
+    report = dictionary with the versions and machine ('meta') and a list
+            of the results ('results'), each with the 'case', the number of
+            points 'n', the 'status' ('ok' or 'skipped', with the memory
+            estimate 'needed_gb'), the wall time 'seconds' and the peak
+            memory 'peak_mb'
+    """
+    names = names or list(_MATRICES)
+    memory = _physical_memory() if memory is None else memory
+    report = {'meta': {'python': platform.python_version(),
+                       'numpy': np.__version__, 'scipy': scipy.__version__,
+                       'machine': platform.platform(),
+                       'processor': platform.processor(),
+                       'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'memory_gb': memory},
+              'results': []}
+    for n in sizes:
+        functions = cases(n)
+        for name in names:
+            result = {'case': name, 'n': n}
+            if needed_memory(name, n) > memory:
+                result.update(status='skipped',
+                              needed_gb=needed_memory(name, n))
+            else:
+                seconds, peak = measure(functions[name], repeat)
+                result.update(status='ok', seconds=seconds, peak_mb=peak)
+            report['results'].append(result)
+            if verbose:
+                print(_line(result))
+    return report
+
+
+def _line(result):
+    """ One line of the table of results """
+    if result['status'] != 'ok':
+        return '{0:20s} {1:7d}   skipped, needs --memory {2:.0f}'.format(
+            result['case'], result['n'], result['needed_gb'])
+    return '{0:20s} {1:7d} {2:10.4f} s {3:10.1f} MB'.format(
+        result['case'], result['n'], result['seconds'], result['peak_mb'])
+
+
+def scaling(report):
+    """
+        scaling() estimates the exponent of N in the time of each case,
+    from the two largest sizes measured
+
+        Returns
+    exponents = dictionary with the exponent of each case
+    """
+    exponents = {}
+    for name in set(result['case'] for result in report['results']):
+        done = sorted((result['n'], result['seconds'])
+                      for result in report['results']
+                      if result['case'] == name and result['status'] == 'ok')
+        if len(done) >= 2:
+            (n1, t1), (n2, t2) = done[-2:]
+            exponents[name] = np.log(t2 / t1) / np.log(n2 / n1)
+    return exponents
+
+
+def compare(report, baseline, tolerance=1.5, min_seconds=1e-3):
+    """
+        compare() finds the cases slower or using more memory than in the
+    baseline
+
+        Parameters
+    report = results of run()
+    baseline = results of run() stored before
+    tolerance = largest ratio of time (or memory) to the baseline accepted
+    min_seconds = times below this are too noisy to compare
+
+        Returns
+    regressions = list of (case, n, quantity, ratio)
+    """
+    stored = dict(((result['case'], result['n']), result)
+                  for result in baseline['results']
+                  if result['status'] == 'ok')
+    regressions = []
+    for result in report['results']:
+        old = stored.get((result['case'], result['n']))
+        if result['status'] != 'ok' or old is None:
+            continue
+        ratio = result['seconds'] / old['seconds']
+        if ratio > tolerance and result['seconds'] > min_seconds:
+            regressions.append((result['case'], result['n'], 'seconds',
+                                ratio))
+        ratio = result['peak_mb'] / max(old['peak_mb'], 1e-3)
+        if ratio > tolerance and result['peak_mb'] > 1.:
+            regressions.append((result['case'], result['n'], 'peak_mb',
+                                ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0],
+                                     formatter_class=
+                                     argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100, 1000, 5000, 20000])
+    parser.add_argument('--cases', nargs='+', choices=sorted(_MATRICES))
+    parser.add_argument('--memory', type=float,
+                        help='GB available, larger cases are skipped '
+                             '(default: the memory of the machine); '
+                             'N=20000 needs about 15 GB for the likelihood '
+                             'cases and 60 GB for gradient_composite')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--baseline', help='JSON file of a previous run')
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    args = parser.parse_args(argv)
+
+    report = run(args.sizes, args.cases, args.memory, args.repeat)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+
+    skipped = [result for result in report['results']
+               if result['status'] == 'skipped']
+    if skipped:
+        print('\n{0} cases skipped with --memory {1:.1f}, the largest needs '
+              '{2:.0f} GB'.format(len(skipped), report['meta']['memory_gb'],
+                                  max(r['needed_gb'] for r in skipped)))
+    print('\nexponent of N in the time, from the two largest sizes')
+    for name, exponent in sorted(scaling(report).items()):
+        print('{0:20s} {1:5.2f}'.format(name, exponent))
+    if args.baseline is None:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(report, baseline, args.tolerance)
+    print('\ncompared with {0}'.format(args.baseline))
+    for case, n, quantity, ratio in regressions:
+        print('REGRESSION {0:20s} {1:7d} {2:8s} x{3:.2f}'.format(case, n,
+                                                                quantity,
+                                                                ratio))
+    if not regressions:
+        print('no regressions')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+##### END
@@ -6,9 +6,37 @@
     
     gpCalc: contains the log likelihood calculation.
     gpKernel: contains all the developed kernels.
+    lags: prepared time differences reused by the kernels.
+    semisep: O(N) semiseparable log likelihood for some of the kernels.
+    toeplitz: O(N**2) log likelihood and prediction for regularly sampled data.
+    incremental: Gaussian process updated as new observations arrive.
+    periodogram: periods search with correlated noise, one factorization.
+    multioutput: radial velocities and activity indicators modelled together.
+    kronecker: instruments observing the same epochs, Kronecker eigensolver.
+    sparse: inducing point (FITC/VFE) approximation for large data sets.
+    mixed: float32 log likelihood with float64 iterative refinement.
+    tiled: out of core Cholesky on disk for N beyond the memory.
+    parallel: process pool log likelihood with the data in shared memory.
+    optimize: L-BFGS-B hyperparameter optimization with parallel restarts.
+    batch: fits of many time series on a process pool, with resumable output.
+    profiling: opt-in timers and counters of the stages of the calculations.
 
 """
 
 from gedi import calc
 from gedi import kernels
 from gedi import rvfunction
+from gedi import lags
+from gedi import profiling
+from gedi import semisep
+from gedi import toeplitz
+from gedi import sparse
+from gedi import mixed
+from gedi import parallel
+from gedi import incremental
+from gedi import optimize
+from gedi import batch
+from gedi import periodogram
+from gedi import multioutput
+from gedi import kronecker
+from gedi import tiled
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Batch fitting of many radial velocity time series (e.g. the targets of
+a survey) with the same kernel template. The fits run on a pool of
+processes, the largest data sets first so that no core waits on a long fit
+at the end, and each result is appended to an output file as soon as it is
+ready, one JSON object per line. Running again with the same output file
+skips the stars already in it, so an interrupted run resumes where it
+stopped.
+
+    Each time series is a text file with the columns time, rv and rv error,
+lines starting with # being comments.
+"""
+import glob as _glob
+import json as _json
+import os as _os
+import time as _time
+from multiprocessing import Pool as _Pool
+
+import numpy as _np
+
+from gedi import optimize as _optimize
+
+
+def find_series(source, pattern='*.txt'):
+    """
+        find_series() lists the time series to fit
+
+        Parameters
+    source = directory with the time series, or manifest file with the
+            path of one time series per line (relative to the manifest),
+            lines starting with # being comments
+    pattern = file names to take from a directory
+
+        Returns
+    series = list of (name, path), the name being the file name without
+            extension
+    """
+    if _os.path.isdir(source):
+        paths = sorted(_glob.glob(_os.path.join(source, pattern)))
+    else:
+        folder = _os.path.dirname(_os.path.abspath(source))
+        with open(source) as manifest:
+            paths = [_os.path.join(folder, line.strip()) for line in manifest
+                     if line.strip() and not line.startswith('#')]
+    series = [(_os.path.splitext(_os.path.basename(path))[0], path)
+              for path in paths]
+    names = [name for name, path in series]
+    if len(set(names)) != len(names):
+        raise ValueError('find_series: repeated names in {0}'.format(source))
+    return series
+
+
+def read_series(path):
+    """ Reads the columns time, rv and rv error of a time series """
+    t, rv, rverr = _np.loadtxt(path, usecols=(0, 1, 2), unpack=True, ndmin=2)
+    return t, rv, rverr
+
+
+def read_results(output):
+    """
+        read_results() reads the results written by fit(), ignoring a last
+    line left incomplete by an interruption
+
+        Returns
+    results = list with a dictionary for each line, a star retried after
+            failing has one for each attempt, the last one is the latest
+    """
+    results = []
+    if not _os.path.exists(output):
+        return results
+    with open(output) as f:
+        for line in f:
+            try:
+                results.append(_json.loads(line))
+            except ValueError:
+                continue
+    return results
+
+
+def _fit_star(args):
+    """ Fits one star, inside a worker of the pool or serially """
+    name, path, t, rv, rverr, kern, options = args
+    begin = _time.time()
+    result = {'name': name, 'path': path, 'n': int(t.size)}
+    try:
+        best, runs = _optimize.optimize(kern, t, rv, rverr, processes=1,
+                                        **options)
+    except Exception as error:
+        result.update(status='failed', error=repr(error),
+                      time=_time.time() - begin)
+        return result
+    result.update(status='ok',
+                  pars=[float(e) for e in best.pars],
+                  log_like=float(max(run['log_like'] for run in runs)),
+                  nfev=int(sum(run['nfev'] for run in runs)),
+                  time=_time.time() - begin)
+    return result
+
+
+def fit(kern, source, output, processes=None, pattern='*.txt',
+        retry_failed=True, **options):
+    """
+        fit() fits the kernel to every time series of source, appending the
+    results to output as they arrive
+
+        Parameters
+    kern = kernel template, its hyperparameters are the starting point of
+          every fit and its frozen hyperparameters stay fixed
+    source = directory or manifest with the time series, see find_series()
+    output = file where the results are appended, one JSON object per line
+            with the name, path and size ('n') of the star, its 'status'
+            ('ok' or 'failed', with the 'error'), the best hyperparameters
+            ('pars', in the order of kern.pars), the log likelihood, the
+            number of evaluations ('nfev') and the wall time ('time')
+    processes = number of stars fitted at the same time, None uses all cpus
+    pattern = file names to take from a directory
+    retry_failed = True to fit again the stars that failed before (out of
+                  memory, a bad starting point, ...), their new result is
+                  appended after the failed one; False to skip them too
+    options = passed on to optimize.optimize(), e.g. bounds, starts, seed
+
+        Returns
+    results = list with the results of the stars fitted in this call
+    """
+    done = set(result['name'] for result in read_results(output)
+               if result['status'] == 'ok' or not retry_failed)
+    tasks, unreadable = [], []
+    for name, path in find_series(source, pattern):
+        if name in done:
+            continue
+        try:
+            t, rv, rverr = read_series(path)
+        except (OSError, ValueError) as error:
+            unreadable.append({'name': name, 'path': path, 'n': 0,
+                               'status': 'failed', 'error': repr(error),
+                               'time': 0.})
+            continue
+        tasks.append((name, path, t, rv, rverr, kern, options))
+    #largest first, the long fits do not end up alone at the end
+    tasks.sort(key=lambda task: task[2].size, reverse=True)
+
+    #an interrupted write leaves a line without its end
+    if _os.path.exists(output) and _os.path.getsize(output):
+        with open(output, 'rb') as f:
+            f.seek(-1, _os.SEEK_END)
+            complete = f.read(1) == b'\n'
+        if not complete:
+            with open(output, 'a') as f:
+                f.write('\n')
+
+    results = []
+    with open(output, 'a') as f:
+        for result in unreadable:
+            f.write(_json.dumps(result) + '\n')
+            results.append(result)
+        f.flush()
+        if processes == 1:
+            stream = map(_fit_star, tasks)
+            pool = None
+        else:
+            pool = _Pool(processes)
+            stream = pool.imap_unordered(_fit_star, tasks)
+        try:
+            for result in stream:
+                f.write(_json.dumps(result) + '\n')
+                f.flush()
+                results.append(result)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+    return results
+
+
+##### END
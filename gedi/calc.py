@@ -1,10 +1,20 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import copy as _copy
+
 import numpy as _np
 from scipy.linalg import cho_factor as _cho_factor
 from scipy.linalg import cho_solve as _cho_solve
+from scipy.linalg import cholesky as _cholesky
+from scipy.linalg import solve_triangular as _solve_triangular
 
 from gedi import kernels as _kernels
+from gedi import lags as _lags
+from gedi import profiling as _profiling
+from gedi import rvfunction as _rvfunction
+from gedi import semisep as _semisep
+from gedi import toeplitz as _toeplitz
+from gedi.profiling import Profile
 
 
 def build_matrix(kern, x, yerr):
@@ -16,20 +26,34 @@ def build_matrix(kern, x, yerr):
 
         Parameters
     kern = kernel in use
-    x = range of values of the independent variable (usually time)
+    x = range of values of the independent variable (usually time), or a
+        gedi.lags.Lags object with the time differences already computed
     y = range of values of te dependent variable (the measurments)
     yerr = error in the measurments
     
         Returns
     K = covariance matrix
     """ 
-    r = x[:, None] - x[None, :]
-    K = kern(r)
+    start = _profiling.tic()
+    r = _lags.differences(x, not _kernels.is_stationary(kern))
+    K = _lags.full(r, _evaluate(kern, r))
     K = K + yerr**2*_np.identity(len(x)) 
+    _profiling.toc('build_matrix', start)
+    return K
+
+
+def _evaluate(kern, r):
+    """ kern(r), timing the evaluations of each class of kernel """
+    if isinstance(kern, _kernels._operator):
+        return kern(r) #the compiled program times each of its kernels
+    start = _profiling.tic()
+    K = kern(r)
+    _profiling.toc('kernel:' + type(kern).__name__, start)
     return K
 
 
-def likelihood(kern, x, y, yerr, kepler = False, kepler_params=[]):
+def likelihood(kern, x, y, yerr, kepler = False, kepler_params=[],
+               solver = 'dense'):
     """
         likelihood() calculates the marginal log likelihood.
 
@@ -40,393 +64,264 @@ def likelihood(kern, x, y, yerr, kepler = False, kepler_params=[]):
     yerr = error in the measurments 
 
     kepler = False if you don't want to use mean function, True otherwise
-    kepler_params = [Period, rvAmplitude, ecc, w, t0]
+    kepler_params = [Period, rvAmplitude, ecc, w, t0], or the same five
+                    values for each planet one after the other, or a
+                    rvfunction.Keplerian evaluated on the times x
+    solver = 'dense' to use the full covariance matrix and its Cholesky
+            factorization, 'semisep' to use the O(N) semiseparable solver of
+            gedi.semisep (only some kernels, see gedi.semisep.kernel_terms)
+            or 'toeplitz' for regularly sampled x and the same yerr on every
+            point, using the O(N**2) Levinson recursion of gedi.toeplitz
         Returns
     log_like = marginal log likelihood
     """
+    _profiling.count('likelihood')
     if kepler:
-        Pk, Krv, e, w, T = kepler_params
-
-        Mean_anom=[2*_np.pi*(x1-T)/Pk  for x1 in x] #mean anomaly
-        #eccentric anomaly -> E0=M + e*sin(M) + 0.5*(e**2)*sin(2*M)
-        E0=[x1 + e*_np.sin(x1)  + 0.5*(e**2)*_np.sin(2*x1) for x1 in Mean_anom]
-        #mean anomaly -> M0=E0 - e*sin(E0)
-        M0=[x1 - e*_np.sin(x1) for x1 in E0]
-
-        i=0
-        while i<100:
-            #[x + y for x, y in zip(first, second)]
-            calc_aux=[x2-y2 for x2,y2 in zip(Mean_anom,M0)]
-            E1=[x3 + y3/(1-e*_np.cos(x3)) for x3,y3 in zip(E0,calc_aux)]
-            M1=[x4 - e*_np.sin(x4) for x4 in E0]
-            i+=1
-            E0=E1
-            M0=M1
-        nu=[2*_np.arctan(_np.sqrt((1+e)/(1-e))*_np.tan(x5/2)) for x5 in E0]
-        RV=[Krv*(e*_np.cos(w)+_np.cos(w+x6)) for x6 in nu]
-
-        K = build_matrix(kern, x, yerr)
-        L1 = _cho_factor(K)
-        y = _np.array(y) - _np.array(RV) #to include the keplerian function
-        sol = _cho_solve(L1, y)
-        n = y.size
-        log_like = -0.5*_np.dot(y, sol) \
-                  - _np.sum(_np.log(_np.diag(L1[0]))) \
-                  - n*0.5*_np.log(2*_np.pi)
-        return log_like
-    else:
-        K = build_matrix(kern, x, yerr)
-        L1 = _cho_factor(K)
-        sol = _cho_solve(L1, y)
-        n = y.size
-        log_like = -0.5*_np.dot(y, sol) \
-                  - _np.sum(_np.log(_np.diag(L1[0]))) \
-                  - n*0.5*_np.log(2*_np.pi)
-        return log_like
-
-
-def minus_likelihood(kernel, t, y, yerr):
-    """ Calculates -log_likelihood()
-    to be used in scipy.optimize
+        start = _profiling.tic()
+        if not isinstance(kepler_params, _rvfunction.Keplerian):
+            kepler_params = _rvfunction.Keplerian(_lags.times(x),
+                                                  kepler_params)
+        RV = kepler_params.rv()
+        y = _np.array(y) - RV #to include the keplerian function
+        _profiling.toc('kepler', start)
+
+    if solver == 'semisep':
+        return _semisep.likelihood(kern, _lags.times(x), y, yerr)
+    elif solver == 'toeplitz':
+        return _toeplitz.likelihood(kern, _lags.times(x), y, yerr)
+    elif solver != 'dense':
+        raise ValueError('likelihood: unknown solver {0}'.format(solver))
+
+    K = build_matrix(kern, x, yerr)
+    return _log_likelihood(K, y)
+
+
+def _log_likelihood(K, y):
     """
-    return -likelihood(kernel, t, y, yerr)
-
-
-def new_kernel(original_kernel,b):
-    """
-        new_kernel() updates the parameters of the _kernels as the optimizations
-    advances
+        _log_likelihood() calculates the marginal log likelihood from an
+    already built covariance matrix
 
         Parameters
-    original_kernel = original kernel in use
-    b = new parameters or new hyperparameters if you prefer using that denomination
+    K = covariance matrix
+    y = range of values of te dependent variable (the measurments)
+
+        Returns
+    log_like = marginal log likelihood
     """
-    if isinstance(original_kernel,_kernels.ExpSquared):
-        return _kernels.ExpSquared(b[0],b[1])
-    elif isinstance(original_kernel,_kernels.ExpSineSquared):
-        return _kernels.ExpSineSquared(b[0],b[1],b[2])
-    elif isinstance(original_kernel,_kernels.RatQuadratic):
-        return _kernels.RatQuadratic(b[0],b[1],b[2])
-    elif isinstance(original_kernel,_kernels.Exponential):
-        return _kernels.Exponential(b[0],b[1])
-        
-    elif isinstance(original_kernel,_kernels.Matern32):
-        return _kernels.Matern32(b[0],b[1])
-    elif isinstance(original_kernel,_kernels.Matern52):
-        return _kernels.Matern52(b[0],b[1])
-    elif isinstance(original_kernel,_kernels.WhiteNoise):
-        return _kernels.WhiteNoise(b[0])
-    elif isinstance(original_kernel,_kernels.QuasiPeriodic):
-        return _kernels.QuasiPeriodic(b[0],b[1],b[2],b[3])
-    elif isinstance(original_kernel,_kernels.RQP):
-        return _kernels.RQP(b[0],b[1],b[2],b[3],b[4])
-    elif isinstance(original_kernel,_kernels.Sum):
-        k1_params = []
-        for i, e in enumerate(original_kernel.k1.pars):
-            k1_params.append(b[i])    
-        k2_params = []
-        for j, e in enumerate(original_kernel.k2.pars):
-            k2_params.append(b[len(original_kernel.k1.pars)+j])
-        new_k1 = new_kernel(original_kernel.k1,k1_params)
-        new_k2 = new_kernel(original_kernel.k2,k2_params)
-        return new_k1+new_k2
-        
-    elif isinstance(original_kernel,_kernels.Product):
-        k1_params = []
-        for i, e in enumerate(original_kernel.k1.pars):
-            k1_params.append(b[i])    
-        k2_params = []
-        for j, e in enumerate(original_kernel.k2.pars):
-            k2_params.append(b[len(original_kernel.k1.pars)+j])
-        new_k1 = new_kernel(original_kernel.k1,k1_params)
-        new_k2 = new_kernel(original_kernel.k2,k2_params)
-        return new_k1*new_k2
-        
-    else:
-        print('new_kernel: Something is missing')
+    start = _profiling.tic()
+    L1 = _cho_factor(K)
+    _profiling.toc('cholesky', start)
+    start = _profiling.tic()
+    sol = _cho_solve(L1, y)
+    _profiling.toc('solve', start)
+    n = y.size
+    log_like = -0.5*_np.dot(y, sol) \
+              - _np.sum(_np.log(_np.diag(L1[0]))) \
+              - n*0.5*_np.log(2*_np.pi)
+    return log_like
 
 
-def gradient_likelihood(kern,x,y,yerr):
+def batch_likelihood(kern, pars, x, y, yerr):
     """
-        gradient_likelihood() identifies the derivatives to use of a given 
-    kernel to calculate the gradient
+        batch_likelihood() calculates the marginal log likelihood for a stack 
+    of hyperparameter sets of the same kernel, building the covariance 
+    matrices as a 3-D array and factorizing them together. Made to be used 
+    with emcee's vectorize=True, for small to medium number of points.
 
         Parameters
-    kern = kernel in use
+    kern = kernel in use, only its structure matters
+    pars = array (B, P) with the B sets of hyperparameters, in the order of
+            kern.pars
     x = range of values of the independent variable (usually time)
     y = range of values of te dependent variable (the measurments)
     yerr = error in the measurments
 
         Returns
-    grad1, grad2, ... = gradients of the kernel derivatives
+    log_like = array (B,) of marginal log likelihoods, -inf when the
+            covariance matrix is not positive definite
     """
-    cov_matrix = build_matrix(kern,x,yerr)
-    if isinstance(kern,_kernels.ExpSquared):
-        grad1 = _grad_lp(kern.des_dtheta, x, y, yerr, cov_matrix)
-        grad2 = _grad_lp(kern.des_dl, x, y, yerr, cov_matrix)
-        return grad1, grad2
-
-    elif isinstance(kern,_kernels.ExpSineSquared):
-        grad1 = _grad_lp(kern.dess_dtheta,x,y,yerr,cov_matrix)
-        grad2 = _grad_lp(kern.dess_dl,x,y,yerr,cov_matrix)
-        grad3 = _grad_lp(kern.dess_dp,x,y,yerr,cov_matrix)
-        return grad1, grad2, grad3 
-
-    elif isinstance(kern,_kernels.RatQuadratic):
-        grad1 = _grad_lp(kern.drq_dtheta,x,y,yerr,cov_matrix)
-        grad2 = _grad_lp(kern.drq_dalpha,x,y,yerr,cov_matrix)
-        grad3 = _grad_lp(kern.drq_dl,x,y,yerr,cov_matrix)
-        return grad1, grad2, grad3 
-
-    elif isinstance(kern,_kernels.Exponential):
-        grad1 = _grad_lp(kern.dexp_dtheta,x,y,yerr,cov_matrix)
-        grad2 = _grad_lp(kern.dexp_dl,x,y,yerr,cov_matrix)
-        return grad1, grad2
-
-    elif isinstance(kern,_kernels.Matern32):
-        grad1 = _grad_lp(kern.dm32_dtheta,x,y,yerr,cov_matrix)
-        grad2 = _grad_lp(kern.dm32_dl,x,y,yerr,cov_matrix)
-        return grad1, grad2
-
-    elif isinstance(kern,_kernels.Matern52):
-        grad1 = _grad_lp(kern.dm52_dtheta,x,y,yerr,cov_matrix)
-        grad2 = _grad_lp(kern.dm52_dl,x,y,yerr,cov_matrix)
-        return grad1, grad2
-
-    elif isinstance(kern,_kernels.QuasiPeriodic):
-        grad1 = _grad_lp(kern.dqp_dtheta,x,y,yerr,cov_matrix)
-        grad2 = _grad_lp(kern.dqp_dl1,x,y,yerr,cov_matrix)
-        grad3 = _grad_lp(kern.dqp_dl2,x,y,yerr,cov_matrix)
-        grad4 = _grad_lp(kern.dqp_dp,x,y,yerr,cov_matrix)
-        return grad1, grad2, grad3, grad4
-
-    elif isinstance(kern,_kernels.WhiteNoise):
-        grad1 = _grad_lp(kern.dwn_dtheta,x,y,yerr,cov_matrix)
-        return grad1
-
-    elif isinstance(kern,_kernels.Sum):
-        grad_list = _grad_sum(kern,x,y,yerr)
-        for i, e in enumerate(grad_list):
-            if isinstance(e,float):
-                grad_list[i] = [grad_list[i]]
-        total = sum(grad_list, [])
-        return total
-
-    elif isinstance(kern,_kernels.Product):
-        return _grad_mul(kern,x,y,yerr)
-
-    else:
-        print('gradient -> Something went wrong!')
+    pars = _np.atleast_2d(pars)
+    r = _lags.differences(x, not _kernels.is_stationary(kern))
+    #kernel with parameters of shape (B, 1, 1) broadcasting over r
+    shape = (-1,) + (1,)*_lags.signed(r).ndim
+    batch_kern = new_kernel(kern, [p.reshape(shape) for p in pars.T])
+    K = _lags.full(r, _evaluate(batch_kern, r)) \
+        + yerr**2*_np.identity(len(x))
+    K = _np.broadcast_to(K, (pars.shape[0], len(x), len(x)))
+    n = y.size
+
+    good = _np.ones(pars.shape[0], dtype=bool)
+    start = _profiling.tic()
+    try:
+        L = _np.linalg.cholesky(K)
+    except _np.linalg.LinAlgError:
+        #one by one, the matrices not positive definite get -inf
+        L = _np.empty_like(K)
+        for i, k in enumerate(K):
+            try:
+                L[i] = _np.linalg.cholesky(k)
+            except _np.linalg.LinAlgError:
+                L[i] = _np.identity(n)
+                good[i] = False
+    _profiling.toc('cholesky', start)
+    start = _profiling.tic()
+    #one matrix at a time, older scipy versions only take 2-D matrices
+    z = _np.array([_solve_triangular(l, y, lower=True) for l in L])
+    _profiling.toc('solve', start)
+    log_like = -0.5*_np.sum(z**2, axis=-1) \
+               - _np.sum(_np.log(_np.diagonal(L, axis1=-2, axis2=-1)), axis=-1) \
+               - n*0.5*_np.log(2*_np.pi)
+    log_like[~good] = -_np.inf
+    return log_like
 
 
-def _grad_lp(kern,x,y,yerr,cov_matrix):
+def minus_likelihood(kernel, t, y, yerr):
+    """ Calculates -log_likelihood()
+    to be used in scipy.optimize
     """
-        _grad_lp() makes the covariance matrix calculations of the kernel
-    derivatives and calculates the gradient
+    return -likelihood(kernel, t, y, yerr)
 
-        Parameters
-    kern = kernel in use
-    x = range of values of the independent variable (usually time)
-    y = range of values of te dependent variable (the measurments)
-    yerr = error in the measurments 
-    cov_matrix = kernel covariance matrix
 
-        Returns
-    See gradient_likelihood(kernel,x,y,yerr) for more info
-    """ 
-    r = x[:, None] - x[None, :]
-    kgrad = kern(r)
-    kinv = _np.linalg.inv(cov_matrix)    
-    alpha = _np.dot(kinv,y)
-    A = _np.outer(alpha, alpha) - kinv
-    grad = 0.5 * _np.einsum('ij,ij', kgrad, A)
-    return grad 
+def minus_likelihood_gradient(kernel, t, y, yerr):
+    """ Calculates -log_likelihood() and its gradient in order to the
+    log(parameters) that are not frozen, to be used in scipy.optimize
+    with jac=True
+    """
+    log_like, grad = likelihood_gradient(kernel, t, y, yerr)
+    return -log_like, -grad[~kernel.frozen]
 
 
-def _grad_sum(kern,x,y,yerr):
+def new_kernel(original_kernel,b):
     """
-        _grad_sum() makes the gradient calculation for the sums of _kernels
+        new_kernel() returns a copy of a kernel with new parameters, for
+    updates in place use kernel.set_parameter_vector()
 
         Parameters
-    kern = kernel in use
-    x = range of values of the independent variable (usually time)
-    y = range of values of te dependent variable (the measurments)
-    yerr = error in the measurments
-
-        Returns
-    See _grad_likeSum(kernel,x,y,yerr,original_kernel) for more info
+    original_kernel = original kernel in use
+    b = new parameters or new hyperparameters if you prefer using that denomination,
+        frozen parameters included
     """
-    original_kernel = kern 
-    a = kern.__dict__
-    len_dict = len(kern.__dict__)
-    grad_result = []    
-    for i in _np.arange(1,len_dict+1):
-        var = "k{0:d}".format(i)
-        k_i = a[var] 
-
-        if isinstance(k_i,_kernels.Sum): #to solve the three sums problem
-            calc = _grad_sumAux(k_i,x,y,yerr,original_kernel)
-        else:
-            calc = _grad_likeSum(k_i,x,y,yerr,original_kernel)
-
-        if isinstance(calc, tuple): #to solve the whitenoise problem
-            grad_result.insert(1,calc)
-        else:
-            calc=tuple([calc])
-            grad_result.insert(1,calc)
-        grad_final = []
-        for j, e in enumerate(grad_result):
-
-           grad_final = grad_final + list(grad_result[j])
-    return grad_final
-    #NoneType -> It might happen if there's no return in gradient_likelihood
-
-
-def _grad_likeSum(kern,x,y,yerr,original_kernel):
+    if not isinstance(original_kernel, _kernels.kernel):
+        raise TypeError('new_kernel: {0} is not a kernel'.format(original_kernel))
+    kernel = _copy.deepcopy(original_kernel)
+    kernel.set_parameter_vector(b, include_frozen=True)
+    return kernel
+
+
+def gradient_likelihood(kern,x,y,yerr):
     """
-        _grad_likeSum() identifies the derivatives to use of a given 
-    kernel to calculate the gradient
+        gradient_likelihood() calculates the gradient of the log likelihood,
+    for any sum and product of kernels, see likelihood_gradient()
 
         Parameters
     kern = kernel in use
     x = range of values of the independent variable (usually time)
     y = range of values of te dependent variable (the measurments)
-    yerr = error in the measurments  
-    original_kernel = original kernel (original sum) being used
+    yerr = error in the measurments
 
         Returns
-    grad1, grad2, ... = gradients when using a sum operation    
-    """ 
-    cov_matrix = build_matrix(kern,x,yerr)
-
-    if isinstance(kern, _kernels.ExpSquared):
-        grad1 = _grad_lp(kern.des_dtheta, x, y, yerr, cov_matrix)
-        grad2 = _grad_lp(kern.des_dl, x, y, yerr, cov_matrix)
-        return grad1, grad2
-
-    elif isinstance(kern, _kernels.ExpSineSquared):
-        grad1 = _grad_lp(kern.dess_dtheta,x,y,yerr,cov_matrix)
-        grad2 = _grad_lp(kern.dess_dl,x,y,yerr,cov_matrix)
-        grad3 = _grad_lp(kern.dess_dp,x,y,yerr,cov_matrix)
-        return grad1, grad2, grad3 
-
-    elif isinstance(kern, _kernels.RatQuadratic):
-        grad1 = _grad_lp(kern.drq_dtheta,x,y,yerr,cov_matrix)
-        grad2 = _grad_lp(kern.drq_dalpha,x,y,yerr,cov_matrix)
-        grad3 = _grad_lp(kern.drq_dl,x,y,yerr,cov_matrix)
-        return grad1, grad2, grad3 
-
-    elif isinstance(kern, _kernels.Exponential):
-        grad1 = _grad_lp(kern.dexp_dtheta,x,y,yerr,cov_matrix)
-        grad2 = _grad_lp(kern.dexp_dl,x,y,yerr,cov_matrix)
-        return grad1, grad2
-
-    elif isinstance(kern, _kernels.Matern32):
-        grad1 = _grad_lp(kern.dm32_dtheta,x,y,yerr,cov_matrix)
-        grad2 = _grad_lp(kern.dm32_dl,x,y,yerr,cov_matrix)
-        return grad1, grad2
-
-    elif isinstance(kern, _kernels.Matern52):
-        grad1 = _grad_lp(kern.dm52_dtheta,x,y,yerr,cov_matrix)
-        grad2 = _grad_lp(kern.dm52_dl,x,y,yerr,cov_matrix)
-        return grad1, grad2
-
-    elif isinstance(kern, _kernels.QuasiPeriodic):
-        grad1 = _grad_lp(kern.dqp_dtheta,x,y,yerr,cov_matrix)
-        grad2 = _grad_lp(kern.dqp_dl1,x,y,yerr,cov_matrix)
-        grad3 = _grad_lp(kern.dqp_dl2,x,y,yerr,cov_matrix)
-        grad4 = _grad_lp(kern.dqp_dp,x,y,yerr,cov_matrix)
-        return grad1, grad2, grad3, grad4
-
-    elif isinstance(kern, _kernels.WhiteNoise):
-        grad1 = _grad_lp(kern.dwn_dtheta,x,y,yerr,cov_matrix)
-        return grad1
-
-    elif isinstance(kern, _kernels.Product):
-        return _grad_mulAux(kern,x,y,yerr,original_kernel)
-
-    else:
-        print('gradient -> Something went very wrong!')
-
-
-def _grad_sumAux(kern,x,y,yerr,original_kernel):
+    grad = array with the derivatives in order to the log(parameters), in
+            the same order as kern.pars
     """
-        _grad_sumAux() its necesary when we are dealing with multiple sums, i.e. 
-    sum of three or more _kernels
+    return likelihood_gradient(kern, x, y, yerr)[1]
 
-        Parameters
-    kern = kernel in use
-    x = range of values of the independent variable (usually time)
-    y = range of values of te dependent variable (the measurments)
-    yerr = error in the measurments
-    original_kernel = original kernel (original sum) being used
 
-        Return
-    See _grad_likeSum(kernel,x,y,yerr,original_kernel) for more info
-    """ 
-    original_kernel = original_kernel
-    a = kern.__dict__
-    len_dict = len(kern.__dict__)
-    grad_result = []    
-    for i in _np.arange(1,len_dict+1):
-        var = "k{0:d}".format(i)
-        k_i = a[var]
-        calc = _grad_likeSum(k_i,x,y,yerr,original_kernel)
-        if isinstance(calc, tuple):
-            grad_result.insert(1,calc)
-        else:
-            calc=tuple([calc])
-            grad_result.insert(1,calc)
-        grad_final = []
-        for j, e in enumerate(grad_result):
-           grad_final = grad_final + list(grad_result[j])
-    return grad_final
-
-
-def _grad_mul(kern,x,y,yerr):
+def likelihood_gradient(kern, x, y, yerr, mean=None):
     """
-        _grad_mul() makes the gradient calculation of multiplications of 
-    _kernels 
+        likelihood_gradient() calculates the marginal log likelihood and its
+    gradient. The kernel tree is evaluated once, keeping the derivatives of
+    each kernel, the covariance matrix is factorized once and the
+    derivatives of the sums and products are contracted with the trace
+    term in a single pass back through the tree, costing O(N**3) plus
+    O(P*N**2) for any structure of the kernel.
 
         Parameters
     kern = kernel in use
     x = range of values of the independent variable (usually time)
     y = range of values of te dependent variable (the measurments)
     yerr = error in the measurments
+    mean = None, or a rvfunction.Keplerian on the times x to fit the
+          orbits together with the kernel
 
         Returns
-    grad_result = gradients when multiplications are used
+    log_like = marginal log likelihood
+    grad = array with the derivatives of log_like in order to the
+            log(parameters), in the same order as kern.pars, followed by the
+            derivatives in order to the parameters of the mean (not their
+            logarithms), in the order of mean.get_parameter_vector()
     """
-    original_kernel = kern 
-    cov_matrix = build_matrix(original_kernel,x,yerr)
-    listof__kernels = [kern.__dict__["k2"]] #to put each kernel separately
-    kernel_k1 = kern.__dict__["k1"]
+    if mean is not None:
+        start = _profiling.tic()
+        y = _np.asarray(y, dtype=float) - mean.rv()
+        _profiling.toc('kepler', start)
+    r = _lags.differences(x, not _kernels.is_stationary(kern))
+    values, derivatives = {}, {}
+    K = _tree_forward(kern, r, values, derivatives)
+    K = _lags.full(r, K) + yerr**2*_np.identity(len(x))
+    _profiling.count('gradient')
+    start = _profiling.tic()
+    L1 = _cho_factor(K)
+    _profiling.toc('cholesky', start)
+    start = _profiling.tic()
+    alpha = _cho_solve(L1, y)
+    n = y.size
+    log_like = -0.5*_np.dot(y, alpha) \
+              - _np.sum(_np.log(_np.diag(L1[0]))) \
+              - n*0.5*_np.log(2*_np.pi)
+
+    kinv = _cho_solve(L1, _np.identity(n))
+    _profiling.toc('solve', start)
+    start = _profiling.tic()
+    A = _np.outer(alpha, alpha) - kinv
+    del K, kinv
+    grad = []
+    _tree_backward(kern, _lags.weights(r, A), values, derivatives, grad)
+    _profiling.toc('gradient_trace', start)
+    grad = 0.5*_np.concatenate(grad)
+    if mean is not None:
+        #d(log_like)/d(mean) = alpha
+        grad = _np.append(grad, _np.dot(mean.gradient(), alpha))
+    return log_like, grad
+
+
+def _tree_forward(kern, r, values, derivatives):
+    """
+        _tree_forward() evaluates every node of a tree of sums and products
+    of kernels once, keeping the values of the nodes and the derivatives of
+    the kernels at the leaves
 
-    while len(kernel_k1.__dict__) == 2:
-        listof__kernels.insert(0,kernel_k1.__dict__["k2"])
-        kernel_k1=kernel_k1.__dict__["k1"]
+        Returns
+    K = kernel evaluated at r
+    """
+    if isinstance(kern, (_kernels.Sum, _kernels.Product)):
+        K1 = _tree_forward(kern.k1, r, values, derivatives)
+        K2 = _tree_forward(kern.k2, r, values, derivatives)
+        K = K1 + K2 if isinstance(kern, _kernels.Sum) else K1 * K2
+    else:
+        start = _profiling.tic()
+        K, derivatives[id(kern)] = kern.value_and_derivatives(r)
+        _profiling.toc('kernel_derivatives:' + type(kern).__name__, start)
+    values[id(kern)] = K
+    return K
 
-    listof__kernels.insert(0,kernel_k1) #each kernel is now separated
 
-    kernelaux1=[];kernelaux2 = []
-    for i, e in enumerate(listof__kernels):
-        kernelaux1.append(listof__kernels[i])
-        kernelaux2.append(_kernel_deriv(listof__kernels[i]))
-    
-    grad_result = []
-    kernelaux11 = kernelaux1; kernelaux22 = kernelaux2
-    ii = 0
-    while ii<len(listof__kernels):
-        kernelaux11 = kernelaux1[:ii] + kernelaux1[ii+1 :]
-        _kernels = _np.prod(_np.array(kernelaux11))
-        for ij, e in enumerate(kernelaux22[ii]):
-            result = _grad_lp(kernelaux2[ii][ij]*_kernels,x,y,yerr,cov_matrix)
-            grad_result.insert(0,result)
-        kernelaux11 = kernelaux1;kernelaux22=kernelaux2
-        ii = ii+1
-
-    grad_result = grad_result[::-1]
-    return grad_result 
+def _tree_backward(kern, weights, values, derivatives, grad):
+    """
+        _tree_backward() goes back through the tree with the weights of the
+    trace term, multiplying them by the other factor at each product, and
+    appends to grad the contraction with the derivatives of each kernel
+    """
+    if isinstance(kern, _kernels.Sum):
+        _tree_backward(kern.k1, weights, values, derivatives, grad)
+        _tree_backward(kern.k2, weights, values, derivatives, grad)
+    elif isinstance(kern, _kernels.Product):
+        _tree_backward(kern.k1, weights * values[id(kern.k2)],
+                       values, derivatives, grad)
+        _tree_backward(kern.k2, weights * values[id(kern.k1)],
+                       values, derivatives, grad)
+    else:
+        grad.append(_np.tensordot(derivatives[id(kern)], weights,
+                                  axes=weights.ndim))
 
 
 def _kernel_deriv(kern):
@@ -446,7 +341,7 @@ def _kernel_deriv(kern):
         return kern.dess_dtheta, kern.dess_dl, kern.dess_dp
 
     elif  isinstance(kern, _kernels.RatQuadratic):
-        return kern.drq_dtheta, kern.drq_dl, kern.drq_dalpha
+        return kern.drq_dtheta, kern.drq_dalpha, kern.drq_dl
 
     elif isinstance(kern, _kernels.Exponential):
         return kern.dexp_dtheta, kern.dexp_dl
@@ -458,152 +353,149 @@ def _kernel_deriv(kern):
         return kern.dm52_dtheta, kern.dm52_dl
 
     elif isinstance(kern, _kernels.WhiteNoise):
-        return kern.dwn_dtheta
+        return kern.dwn_dtheta,
 
     elif isinstance(kern, _kernels.QuasiPeriodic):
         return kern.dqp_dtheta, kern.dqp_dl1, kern.dqp_dl2, kern.dqp_dp
 
+    elif isinstance(kern, _kernels.RQP):
+        return kern.drqp_dtheta, kern.drqp_dl1, kern.drqp_da, \
+               kern.drqp_dl2, kern.drqp_dlP
+
+    elif isinstance(kern, _kernels.Linear):
+        return kern.dl_dc,
+
     else:
-        print ('Something went wrong!')
+        raise ValueError('_kernel_deriv: no derivatives for {0}'.format(kern))
 
 
-def _grad_mulAux(kern,x,y,yerr,original_kernel):
+def check_derivatives(kern, x, h=1e-6):
     """
-        __grad_mulAux() its necesary when we are dealing with multiple terms of 
-    sums and multiplications, example: ES*ESS + ES*ESS*WN + RQ*ES*WN and not
-    having everything breaking apart
+        check_derivatives() compares the analytic log-derivatives of a
+    kernel with central finite differences of the kernel itself
 
         Parameters
-    kern = kernel in use
+    kern = kernel to check, a single kernel or any sum and product
+    x = range of values of the independent variable (usually time)
+    h = step in log(parameters)
+
+        Returns
+    errors = array with the largest absolute error of each derivative, in
+            the same order as kern.pars, for value_and_derivatives() and,
+            for a single kernel, also for each of its derivative methods
+    """
+    r = _lags.Lags(x)
+    pars = _np.log(kern.get_parameter_vector(include_frozen=True))
+    numerical = []
+    for i in range(pars.size):
+        step = h * (_np.arange(pars.size) == i)
+        numerical.append((new_kernel(kern, _np.exp(pars + step))(r) \
+                          - new_kernel(kern, _np.exp(pars - step))(r)) / (2*h))
+    dK = kern.value_and_derivatives(r)[1]
+    errors = _np.array([_np.max(_np.abs(a - b)) for a, b in zip(dK, numerical)])
+    if not isinstance(kern, _kernels._operator):
+        methods = _np.array([_np.max(_np.abs(f(r) - b))
+                             for f, b in zip(_kernel_deriv(kern), numerical)])
+        errors = _np.maximum(errors, methods)
+    return errors
+
+
+def check_gradient(kern, x, y, yerr, h=1e-6):
+    """
+        check_gradient() compares the analytic gradient of the log
+    likelihood with central finite differences, to check new kernels (or
+    their compositions) before trusting them to gradient based optimizers
+
+        Parameters
+    kern = kernel to check
     x = range of values of the independent variable (usually time)
     y = range of values of te dependent variable (the measurments)
     yerr = error in the measurments
-    original_kernel = original kernel (original sum) being used
+    h = step in log(parameters)
 
         Returns
-    See _grad_mul(kernel,x,y,yerr) for more info
-    """  
-    original_kernel = original_kernel 
-    cov_matrix = build_matrix(original_kernel,x,yerr)
-    listof__kernels = [kern.__dict__["k2"]] #to put each kernel separately
-    kernel_k1 = kern.__dict__["k1"]
-
-    while len(kernel_k1.__dict__) == 2:
-        listof__kernels.insert(0,kernel_k1.__dict__["k2"])
-        kernel_k1=kernel_k1.__dict__["k1"]
-
-    listof__kernels.insert(0,kernel_k1) #each kernel is now separated
-
-    kernelaux1 = []; kernelaux2 = []
-    for i, e in enumerate(listof__kernels):
-        kernelaux1.append(listof__kernels[i])
-        kernelaux2.append(_kernel_deriv(listof__kernels[i]))
-
-    grad_result = []
-    kernelaux11 = kernelaux1; kernelaux22 = kernelaux2
-    ii = 0
-    while ii<len(listof__kernels):
-        kernelaux11 = kernelaux1[:ii] + kernelaux1[ii+1 :]
-        _kernels = _np.prod(_np.array(kernelaux11))
-        for ij, e in enumerate(kernelaux22[ii]):
-            result = _grad_lp(kernelaux2[ii][ij]*_kernels,x,y,yerr,cov_matrix)
-            grad_result.insert(0,result)
-        kernelaux11 = kernelaux1;kernelaux22=kernelaux2
-        ii = ii+1
-
-    grad_result = grad_result[::-1]
-    return grad_result
-
-
-def compute_kernel(kernel, x, new_x, y, yerr):
+    grad = analytic gradient, see likelihood_gradient()
+    numerical = gradient from finite differences
+    """
+    grad = likelihood_gradient(kern, x, y, yerr)[1]
+    pars = _np.log(kern.get_parameter_vector(include_frozen=True))
+    numerical = _np.empty(pars.size)
+    for i in range(pars.size):
+        step = h * (_np.arange(pars.size) == i)
+        numerical[i] = (likelihood(new_kernel(kern, _np.exp(pars + step)),
+                                   x, y, yerr) \
+                        - likelihood(new_kernel(kern, _np.exp(pars - step)),
+                                     x, y, yerr)) / (2*h)
+    return grad, numerical
+
+
+def compute_kernel(kernel, x, new_x, y, yerr, return_cov=False, chunk=1000):
     """
         compute_kenrel() makes the necessary calculations to allow the user to 
     create pretty graphics in the end, the ones that includes the mean and 
     standard deviation.
-    
-        I'm not sure if multiplication will work properly
+
+        The covariance matrix is factorized once and the new points are 
+    processed in chunks of fixed size, each with a single triangular solve,
+    so the memory needed stays bounded by N*chunk. WhiteNoise enters the
+    covariance matrix of the measurments but not the predictions.
 
         Parameters
     kernel = kernel in use
     x = range of values of the independent variable (usually time)
-    xcalc = new range of values to calculate the means and standard deviation, in
-            other words, to predict value of the kernel between measurments, as
-            such we should have xcalc >> x
+    new_x = new range of values to calculate the means and standard deviation,
+            in other words, to predict value of the kernel between 
+            measurments, as such we should have new_x >> x
     y = range of values of te dependent variable (the measurments)
     yerr = error in the measurments
+    return_cov = True to return the full covariance matrix of the 
+                predictions instead of the standard deviation (needs memory
+                for len(new_x)**2 values, not chunked)
+    chunk = number of new points processed at a time
 
         Returns
     y_mean,y_std = mean, standard deviation
+    or y_mean,y_cov = mean, covariance matrix if return_cov is True
     """
-    #To deal with the white noise problem in sums
-    if isinstance(kernel, _kernels.Sum):
-        if isinstance(kernel.k2, _kernels.WhiteNoise):
-            WN_pars = kernel.k2.pars[0]**2
-            kernel = kernel.k1
-            K = build_matrix(kernel, x, yerr) 
-            K = K + WN_pars*_np.diag(_np.diag(K))
-            L1 = _cho_factor(K)
-        elif isinstance(kernel.k1, _kernels.WhiteNoise):
-            WN_pars = kernel.k1.pars[0]**2
-            kernel = kernel.k2
-            K = build_matrix(kernel, x, yerr) 
-            K = K + WN_pars*_np.diag(_np.diag(K))
-            L1 = _cho_factor(K)
-        else:
-            K = build_matrix(kernel, x, yerr)
-            L1 = _cho_factor(K)
-
-    #To deal with the white noise problem in multiplications
-    if isinstance(kernel, _kernels.Product):
-        if isinstance(kernel.k2, _kernels.WhiteNoise):
-            WN_pars = kernel.k2.pars[0]**2
-            kernel = kernel.k1
-            K = build_matrix(kernel, x, yerr) 
-            K = _np.dot(K, WN_pars*_np.diag(_np.diag(K)))
-            L1 = _cho_factor(K)
-        if isinstance(kernel.k1, _kernels.WhiteNoise):
-            WN_pars = kernel.k1.pars[0]**2
-            kernel = kernel.k2
-            K = build_matrix(kernel, x, yerr) 
-            K = _np.dot(K, WN_pars*_np.diag(_np.diag(K)))
-            L1 = _cho_factor(K)
-        else:
-            K = build_matrix(kernel, x, yerr)
-            L1 = _cho_factor(K)
-
-    else:
-        K = build_matrix(kernel, x, yerr)
-        L1 = _cho_factor(K)
-
-    sol = _cho_solve(L1, y)
-    kfinal = K
-
-    new_r = new_x[:, None] - x[None, :]
-    new_lines = kernel(new_r)
-    kfinal=_np.vstack([kfinal,new_lines])
-
-    new_r = new_x[:,None] - new_x[None,:]
-    new_columns = kernel(new_r)
-    print('K =', new_columns)
-    kcolumns = _np.vstack([new_lines.T, new_columns])
-    kfinal = _np.hstack([kfinal, kcolumns])
-
-    y_mean = [] #mean = K*.K-1.y  
-    for i, e in enumerate(new_x):
-        y_mean.append(_np.dot(new_lines[i,:], sol))
-    
-    y_var=[] #var=  K** - K*.K-1.K*.T
-    diag=_np.diagonal(new_columns)
-    for i, e in enumerate(new_x):
-        #K**=diag[i]; K*=new_lines[i]
-        a=diag[i]
-        newsol = _cho_solve(L1, new_lines[i])
-        d=_np.dot(new_lines[i,:],newsol)
-        result=a-d      
-        y_var.append(result)
-
-    y_std = _np.sqrt(y_var) #standard deviation
-    return _np.array(y_mean), y_std
+    K = build_matrix(kernel, x, yerr)
+    tic = _profiling.tic()
+    L = _cholesky(K, lower=True)
+    _profiling.toc('cholesky', tic)
+    del K
+    x = _lags.times(x)
+    new_x = _np.asarray(new_x, dtype=float)
+    tic = _profiling.tic()
+    alpha = _solve_triangular(L, _solve_triangular(L, y, lower=True),
+                              lower=True, trans='T')
+    _profiling.toc('solve', tic)
+
+    if return_cov:
+        kstar = _evaluate(kernel, _lags.Lags(new_x, other=x))
+        tic = _profiling.tic()
+        v = _solve_triangular(L, kstar.T, lower=True)
+        _profiling.toc('solve', tic)
+        y_cov = _evaluate(kernel, _lags.Lags(new_x, other=new_x)) \
+                - _np.dot(v.T, v)
+        return _np.dot(kstar, alpha), y_cov
+
+    #prior variance, k(0) without the WhiteNoise
+    stationary = _kernels.is_stationary(kernel)
+    k0 = kernel(_lags.Lags(_np.zeros(1), other=_np.zeros(1)))[0, 0]
+    y_mean = _np.empty(new_x.size)
+    y_var = _np.empty(new_x.size)
+    for start in range(0, new_x.size, chunk):
+        part = slice(start, start + chunk)
+        if not stationary:
+            k0 = _np.diag(_evaluate(kernel, _lags.Lags(new_x[part],
+                                                       other=new_x[part])))
+        kstar = _evaluate(kernel, _lags.Lags(new_x[part], other=x)) #K*
+        y_mean[part] = _np.dot(kstar, alpha) #mean = K*.K-1.y
+        tic = _profiling.tic()
+        v = _solve_triangular(L, kstar.T, lower=True)
+        _profiling.toc('solve', tic)
+        y_var[part] = k0 - _np.sum(v**2, axis=0) #var = K** - K*.K-1.K*.T
+    y_std = _np.sqrt(_np.maximum(y_var, 0)) #standard deviation
+    return y_mean, y_std
 
 
 ##### END
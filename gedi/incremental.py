@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Gaussian process with fixed hyperparameters that is updated when new
+observations arrive, extending the Cholesky factor by blocks instead of
+factorizing everything again: adding k points to N costs O(N**2*k) instead
+of O((N+k)**3).
+"""
+import numpy as _np
+from scipy.linalg import cholesky as _cholesky
+from scipy.linalg import solve_triangular as _solve_triangular
+
+from gedi import kernels as _kernels
+from gedi import lags as _lags
+
+
+class IncrementalGP(object):
+    """
+        Gaussian process whose Cholesky factor, whitened data, log
+    likelihood and predictions are updated as observations are added.
+
+        Parameters
+    kern = kernel in use, its hyperparameters stay fixed
+    x = range of values of the independent variable (usually time)
+    y = range of values of te dependent variable (the measurments)
+    yerr = error in the measurments
+    """
+    def __init__(self, kern, x, y, yerr):
+        self.kern = kern
+        self.x = _np.zeros(0)
+        self.y = _np.zeros(0)
+        self.L = _np.zeros((0, 0))
+        self._z = _np.zeros(0) #whitened data L^-1.y
+        self._alpha = None
+        self._quad = 0.
+        self._log_det = 0.
+        self.add(x, y, yerr)
+
+    def add(self, new_x, new_y, new_yerr):
+        """
+            add() includes new observations, extending the Cholesky factor
+        L of the covariance matrix by a block
+            [[L11,   0],
+             [L21, L22]], with L21 = K21.L11^-T and
+        L22 = chol(K22 - L21.L21^T)
+
+            Parameters
+        new_x = times of the new observations
+        new_y = new measurements
+        new_yerr = errors of the new measurements
+        """
+        new_x = _np.atleast_1d(_np.asarray(new_x, dtype=float))
+        new_y = _np.atleast_1d(_np.asarray(new_y, dtype=float))
+        new_yerr = _np.broadcast_to(_np.asarray(new_yerr, dtype=float),
+                                    new_x.shape)
+        n, k = self.x.size, new_x.size
+
+        K22 = self.kern(_lags.Lags(new_x)) + _np.diag(new_yerr**2)
+        if n:
+            K21 = self.kern(_lags.Lags(new_x, other=self.x))
+            L21 = _solve_triangular(self.L, K21.T, lower=True).T
+            K22 = K22 - _np.dot(L21, L21.T)
+            z2 = new_y - _np.dot(L21, self._z)
+        else:
+            L21 = _np.zeros((k, 0))
+            z2 = new_y
+        L22 = _cholesky(K22, lower=True)
+        z2 = _solve_triangular(L22, z2, lower=True)
+
+        L = _np.zeros((n + k, n + k))
+        L[:n, :n] = self.L
+        L[n:, :n] = L21
+        L[n:, n:] = L22
+        self.L = L
+        self.x = _np.concatenate([self.x, new_x])
+        self.y = _np.concatenate([self.y, new_y])
+        self._z = _np.concatenate([self._z, z2])
+        self._quad += _np.dot(z2, z2)
+        self._log_det += 2*_np.sum(_np.log(_np.diag(L22)))
+        self._alpha = None
+
+    @property
+    def alpha(self):
+        """ K^-1.y, one back substitution from the whitened data """
+        if self._alpha is None:
+            self._alpha = _solve_triangular(self.L, self._z, lower=True,
+                                            trans='T')
+        return self._alpha
+
+    def log_likelihood(self):
+        """ Marginal log likelihood of all the observations so far """
+        return -0.5*self._quad - 0.5*self._log_det \
+               - self.y.size*0.5*_np.log(2*_np.pi)
+
+    def predict(self, new_x, return_var=True):
+        """
+            predict() calculates the predictive mean and standard deviation
+
+            Parameters
+        new_x = values where to predict
+        return_var = False to only calculate the mean
+
+            Returns
+        y_mean, y_std = mean and standard deviation (only y_mean if
+                        return_var is False)
+        """
+        new_x = _np.atleast_1d(_np.asarray(new_x, dtype=float))
+        kstar = self.kern(_lags.Lags(new_x, other=self.x))
+        y_mean = _np.dot(kstar, self.alpha)
+        if not return_var:
+            return y_mean
+        v = _solve_triangular(self.L, kstar.T, lower=True)
+        #prior variance without the WhiteNoise, per point if not stationary
+        if _kernels.is_stationary(self.kern):
+            k0 = self.kern(_lags.Lags(_np.zeros(1), other=_np.zeros(1)))[0, 0]
+        else:
+            k0 = _np.diag(self.kern(_lags.Lags(new_x, other=new_x)))
+        y_var = k0 - _np.sum(v**2, axis=0)
+        return y_mean, _np.sqrt(_np.maximum(y_var, 0))
+
+
+##### END
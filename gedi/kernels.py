@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import inspect as _inspect
+
 import numpy as _np
 
+from gedi import lags as _lags
+from gedi import profiling as _profiling
+
 class kernel(object):
     """ 
         Definition the kernels and its properties, 
@@ -11,11 +16,121 @@ class kernel(object):
         """ puts all Kernel arguments in an array pars """
         self.pars = _np.array(args)
         self.kerneltype = 'simple'
+        self.frozen = _np.zeros(len(args), dtype=bool)
 
     def __call__(self, r):
         raise NotImplementedError
         #return self.k1(x1, x2, i, j) * self.k2(x1, x2, i, j)
 
+    def value_and_derivatives(self, r):
+        """
+            Evaluates the kernel and all its log-derivatives in one go, 
+        sharing the terms common to all of them
+
+            Returns
+        K = kernel evaluated at r
+        dK = array with dK[i] the log-derivative in order to pars[i]
+        """
+        raise NotImplementedError
+
+    def lag_derivatives(self, r):
+        """
+            Evaluates the kernel and its first two derivatives in order to
+        the time difference r, as needed for the covariances of the time
+        derivative of a Gaussian process (see gedi.multioutput)
+
+            Returns
+        K, dK, d2K = kernel and its derivatives dK/dr and d2K/dr2
+        """
+        raise NotImplementedError('{0} has no derivatives in order to r, '
+                                  'it is not smooth enough'.format(
+                                      type(self).__name__))
+
+    def evaluate_into(self, r, out, work):
+        """
+            Evaluates the kernel into the preallocated array out, using work
+        as scratch space if needed, see Compiled
+
+            Returns
+        out = kernel evaluated at r
+        """
+        out[...] = self(r)
+        return out
+
+    def compile(self):
+        """ Returns the kernel compiled into a Compiled program """
+        return Compiled(self)
+
+    @property
+    def npars(self):
+        """ Number of hyperparameters, frozen ones included """
+        return len(self.pars)
+
+    @property
+    def parameter_names(self):
+        """ Names of the hyperparameters, in the order of pars """
+        return list(_inspect.signature(type(self).__init__).parameters)[1:]
+
+    def _set_pars(self, values):
+        """ Writes all the hyperparameters, in the order of pars """
+        self.pars = _np.array(values)
+        for name, value in zip(self.parameter_names, self.pars):
+            setattr(self, name, value)
+
+    def get_parameter_vector(self, log=False, include_frozen=False):
+        """
+            get_parameter_vector() returns the hyperparameters, in the order
+        of pars
+
+            Parameters
+        log = True to return log(hyperparameters)
+        include_frozen = True to also return the frozen hyperparameters
+
+            Returns
+        vector = array with the hyperparameters
+        """
+        vector = _np.asarray(self.pars, dtype=float)
+        if not include_frozen:
+            vector = vector[~self.frozen]
+        return _np.log(vector) if log else vector
+
+    def set_parameter_vector(self, vector, log=False, include_frozen=False):
+        """
+            set_parameter_vector() updates the hyperparameters in place, to
+        be used by optimizers and samplers instead of building a new kernel
+        on every step
+
+            Parameters
+        vector = new hyperparameters, in the order of get_parameter_vector()
+        log = True if vector has log(hyperparameters)
+        include_frozen = True if vector also has the frozen hyperparameters
+        """
+        vector = _np.asarray(vector, dtype=float)
+        if log:
+            vector = _np.exp(vector)
+        expected = self.npars - (0 if include_frozen else self.frozen.sum())
+        if len(vector) != expected:
+            raise ValueError('set_parameter_vector: expected {0} parameters, '
+                             'got {1}'.format(expected, len(vector)))
+        if not include_frozen:
+            full = _np.array(self.pars, dtype=float)
+            full[~self.frozen] = vector
+            vector = full
+        self._set_pars(vector)
+
+    def freeze_parameter(self, index):
+        """ Keeps the hyperparameter pars[index] out of the vectors """
+        self._freeze(index, True)
+
+    def thaw_parameter(self, index):
+        """ Puts the hyperparameter pars[index] back in the vectors """
+        self._freeze(index, False)
+
+    def _freeze(self, index, value):
+        if not -self.npars <= index < self.npars:
+            raise IndexError('kernel has {0} parameters'.format(self.npars))
+        self.frozen[index] = value
+
     def __add__(self, b):
         return Sum(self, b)
     def __radd__(self, b):
@@ -43,6 +158,45 @@ class _operator(kernel):
     def pars(self):
         return _np.append(self.k1.pars, self.k2.pars)
 
+    @property
+    def npars(self):
+        return self.k1.npars + self.k2.npars
+
+    @property
+    def parameter_names(self):
+        return self.k1.parameter_names + self.k2.parameter_names
+
+    @property
+    def frozen(self):
+        return _np.append(self.k1.frozen, self.k2.frozen)
+
+    def _set_pars(self, values):
+        self.k1._set_pars(values[:self.k1.npars])
+        self.k2._set_pars(values[self.k1.npars:])
+
+    def _freeze(self, index, value):
+        if not -self.npars <= index < self.npars:
+            raise IndexError('kernel has {0} parameters'.format(self.npars))
+        index = index % self.npars
+        if index < self.k1.npars:
+            self.k1._freeze(index, value)
+        else:
+            self.k2._freeze(index - self.k1.npars, value)
+
+    def _program(self):
+        """ Compiled program of the kernel, rebuilt if its structure changed """
+        structure = _structure(self)
+        cached = self.__dict__.get('_compiled')
+        if cached is None or cached[0] != structure:
+            cached = self._compiled = (structure, Compiled(self))
+        return cached[1]
+
+    def __getstate__(self):
+        #copies and pickles leave the program and its buffers behind
+        state = self.__dict__.copy()
+        state.pop('_compiled', None)
+        return state
+
 
 class Sum(_operator):
     """ To allow the sum of kernels """
@@ -50,7 +204,16 @@ class Sum(_operator):
         return "{0} + {1}".format(self.k1, self.k2)
 
     def __call__(self, r):
-        return self.k1(r) + self.k2(r)
+        return self._program().evaluate(r)
+
+    def value_and_derivatives(self, r):
+        K1, dK1 = self.k1.value_and_derivatives(r)
+        K2, dK2 = self.k2.value_and_derivatives(r)
+        return K1 + K2, _np.concatenate([dK1, dK2])
+
+    def lag_derivatives(self, r):
+        return tuple(a + b for a, b in zip(self.k1.lag_derivatives(r),
+                                           self.k2.lag_derivatives(r)))
 
     def __type__(self):
         return 'stationary' #temporary fix
@@ -61,12 +224,156 @@ class Product(_operator):
         return "{0} * {1}".format(self.k1, self.k2)
 
     def __call__(self, r):
-        return self.k1(r) * self.k2(r)
+        return self._program().evaluate(r)
+
+    def value_and_derivatives(self, r):
+        K1, dK1 = self.k1.value_and_derivatives(r)
+        K2, dK2 = self.k2.value_and_derivatives(r)
+        return K1 * K2, _np.concatenate([dK1 * K2, K1 * dK2])
+
+    def lag_derivatives(self, r):
+        K1, dK1, d2K1 = self.k1.lag_derivatives(r)
+        K2, dK2, d2K2 = self.k2.lag_derivatives(r)
+        return K1 * K2, dK1*K2 + K1*dK2, d2K1*K2 + 2*dK1*dK2 + K1*d2K2
 
     def __type__(self):
         return 'stationary' #temporary fix
 
 
+def _flatten(kern, operator):
+    """ Terms of a chain of sums (or products) of kernels """
+    if isinstance(kern, operator):
+        return _flatten(kern.k1, operator) + _flatten(kern.k2, operator)
+    return [kern]
+
+
+def _structure(kern):
+    """ Tree of the kernels of an expression, to tell when it changes """
+    if isinstance(kern, _operator):
+        return (type(kern), _structure(kern.k1), _structure(kern.k2))
+    return id(kern) #the program holds the kernel, so its id is not reused
+
+
+def is_stationary(kern):
+    """ True if the kernel (or all kernels of a Sum/Product) is stationary """
+    if isinstance(kern, _operator):
+        return is_stationary(kern.k1) and is_stationary(kern.k2)
+    return getattr(kern, 'type', None) == 'stationary'
+
+
+def _broadcast_shape(shapes):
+    """ Shape of the broadcast of arrays with these shapes """
+    ndim = max(len(shape) for shape in shapes)
+    out = []
+    for sizes in zip(*[(1,)*(ndim - len(shape)) + tuple(shape)
+                       for shape in shapes]):
+        sizes = set(sizes) - set([1])
+        if len(sizes) > 1:
+            raise ValueError('shapes {0} cannot be broadcast'.format(shapes))
+        out.append(sizes.pop() if sizes else 1)
+    return tuple(out)
+
+
+class Compiled(object):
+    """
+        Kernel expression compiled into a linear program of operations that
+    evaluate into preallocated buffers. Chains of sums and of products are
+    flattened and every operation works in place, so the number of full
+    size buffers grows with the nesting of sums inside products, and not
+    with the number of kernels, e.g.
+        ExpSquared*ExpSineSquared + Exponential + WhiteNoise
+    needs three buffers. The buffers are reused while r keeps its shape.
+    Sum and Product keep their program between calls and compile it again
+    only when the kernels that form them change.
+
+        Parameters
+    kern = kernel to compile, the program follows later changes of the
+          hyperparameters of its kernels but not of its structure
+
+        Example
+    program = kern.compile()
+    K = program(r)  #overwritten by the next call, unless out is given
+    """
+    def __init__(self, kern):
+        self.kern = kern
+        self.program = []
+        #the last buffer is the scratch space of the kernels
+        self.nbuffers = self._emit(kern, 0) + 2
+        self._buffers = []
+
+    def _emit(self, kern, dst):
+        """
+            _emit() appends the operations that evaluate kern into the
+        buffer dst, returning the highest buffer used
+        """
+        if not isinstance(kern, _operator):
+            self.program.append(('eval', kern, dst))
+            return dst
+        op = 'add' if isinstance(kern, Sum) else 'mul'
+        terms = _flatten(kern, type(kern))
+        top = self._emit(terms[0], dst)
+        for term in terms[1:]:
+            top = max(top, self._emit(term, dst + 1))
+            self.program.append((op, dst, dst + 1))
+        return top
+
+    def _layout(self, r):
+        """ Shape and dtype of the kernel evaluated at r """
+        #hyperparameters given as arrays add leading dimensions
+        shape = _broadcast_shape([_np.shape(_lags.signed(r))]
+                                 + [_np.shape(p) for op, kern, dst
+                                    in self.program if op == 'eval'
+                                    for p in kern.pars])
+        return shape, _np.result_type(_lags.signed(r), 1.)
+
+    def evaluate(self, r):
+        """
+            Evaluates the kernel into a new array, reusing only the
+        intermediate buffers, so the result is not overwritten by the next
+        call (Sum and Product are evaluated this way)
+
+            Parameters
+        r = time differences or Lags object
+
+            Returns
+        K = kernel evaluated at r
+        """
+        shape, dtype = self._layout(r)
+        return self(r, out=_np.empty(shape, dtype))
+
+    def __call__(self, r, out=None):
+        """
+            Evaluates the kernel
+
+            Parameters
+        r = time differences or Lags object
+        out = array where to write the result, an internal buffer if None
+
+            Returns
+        K = kernel evaluated at r
+        """
+        shape, dtype = self._layout(r)
+        if not self._buffers or self._buffers[-1].shape != shape \
+                or self._buffers[-1].dtype != dtype:
+            self._buffers = [_np.empty(shape, dtype)
+                             for i in range(self.nbuffers)]
+        buffers = self._buffers if out is None else [out] + self._buffers[1:]
+        work = buffers[-1]
+        for op, a, b in self.program:
+            if op == 'eval':
+                start = _profiling.tic()
+                a.evaluate_into(r, buffers[b], work)
+                _profiling.toc('kernel:' + type(a).__name__, start)
+            elif op == 'add':
+                _np.add(buffers[a], buffers[b], out=buffers[a])
+            else:
+                _np.multiply(buffers[a], buffers[b], out=buffers[a])
+        return buffers[0]
+
+    def __repr__(self):
+        return "Compiled({0}, {1} buffers)".format(self.kern, self.nbuffers)
+
+
 class ExpSquared(kernel):
     """
         Definition of the exponential squared kernel and its derivatives,
@@ -92,21 +399,38 @@ class ExpSquared(kernel):
     def __call__(self, r):
         f1 = self.ES_theta**2
         f2 = self.ES_l**2
-        f3 = (r)**2
+        f3 = _lags.squared(r)
         return f1 * _np.exp(-0.5* f3/f2)
 
+    def evaluate_into(self, r, out, work):
+        _np.multiply(_lags.squared(r), -0.5/self.ES_l**2, out=out)
+        _np.exp(out, out=out)
+        out *= self.ES_theta**2
+        return out
+
+    def value_and_derivatives(self, r):
+        f1 = _lags.squared(r) / self.ES_l**2
+        K = self.ES_theta**2 * _np.exp(-0.5*f1)
+        return K, _np.array([2*K, f1*K])
+
+    def lag_derivatives(self, r):
+        r = _lags.signed(r)
+        f1 = 1 / self.ES_l**2
+        K = self.ES_theta**2 * _np.exp(-0.5*r**2*f1)
+        return K, -r*f1*K, (r**2*f1 - 1)*f1*K
+
     def des_dtheta(self, r):
         """ Log-derivative in order to theta """
         f1 = self.ES_theta**2
         f2 = self.ES_l**2
-        f3 = (r)**2
+        f3 = _lags.squared(r)
         return  2 * f1 * _np.exp(-0.5*f3/f2)
 
     def des_dl(self, r):
         """ Log-derivative in order to l """
         f1 = self.ES_theta**2
         f2 = self.ES_l
-        f3 = (r)**2
+        f3 = _lags.squared(r)
         f4 = self.ES_l**3    
         return f1 * (f3/f4) * _np.exp(-0.5*f3/f2**2) *f2
 
@@ -138,16 +462,41 @@ class ExpSineSquared(kernel):
     def __call__(self, r):
         f1 = self.ESS_theta**2
         f2 = self.ESS_l**2
-        f3 = _np.abs(r)
+        f3 = _lags.absolute(r)
         f4 = self.ESS_P
         return f1 * _np.exp((-2/f2) * (_np.sin(_np.pi*f3/f4))**2)
 
+    def evaluate_into(self, r, out, work):
+        _np.multiply(_lags.absolute(r), _np.pi/self.ESS_P, out=out)
+        _np.sin(out, out=out)
+        _np.square(out, out=out)
+        out *= -2/self.ESS_l**2
+        _np.exp(out, out=out)
+        out *= self.ESS_theta**2
+        return out
+
+    def value_and_derivatives(self, r):
+        f1 = _np.pi * _lags.absolute(r) / self.ESS_P
+        f2 = self.ESS_l**2
+        f3 = _np.sin(f1)
+        K = self.ESS_theta**2 * _np.exp((-2/f2) * f3**2)
+        return K, _np.array([2*K, (4/f2)*f3**2*K,
+                             (4/f2)*f1*f3*_np.cos(f1)*K])
+
+    def lag_derivatives(self, r):
+        f1 = 2 * _np.pi * _lags.signed(r) / self.ESS_P
+        f2 = 2 * _np.pi / (self.ESS_P * self.ESS_l**2)
+        K = self.ESS_theta**2 * _np.exp((-1/self.ESS_l**2) * (1 - _np.cos(f1)))
+        g1 = -f2 * _np.sin(f1)
+        g2 = -2*_np.pi/self.ESS_P * f2 * _np.cos(f1)
+        return K, g1*K, (g2 + g1**2)*K
+
     def dess_dtheta(self,r):
         """ Log-derivative in order to theta """
         f1 = self.ESS_theta**2
         f2 = self.ESS_l**2
         f3 = _np.pi/self.ESS_P
-        f4 = _np.abs(r)
+        f4 = _lags.absolute(r)
         return 2 * f1 * _np.exp(-(2.0/f2) * _np.sin(f3*f4)**2)
 
     def dess_dl(self, r):
@@ -155,7 +504,7 @@ class ExpSineSquared(kernel):
         f1 = self.ESS_theta**2
         f2 = self.ESS_l**3
         f3 = _np.pi/self.ESS_P
-        f4 = _np.abs(r)
+        f4 = _lags.absolute(r)
         f5 = self.ESS_l**2
         f6 = self.ESS_l
         return (4*f1/f2) * (_np.sin(f3*f4)**2) * _np.exp((-2./f5) * _np.sin(f3*f4)**2) \
@@ -166,7 +515,7 @@ class ExpSineSquared(kernel):
         f1 = self.ESS_theta**2
         f2 = self.ESS_l**2
         f3 = _np.pi/self.ESS_P
-        f5 = _np.abs(r)
+        f5 = _lags.absolute(r)
         return f1 * (4./f2) * f3 * f5 * _np.cos(f3*f5) * _np.sin(f3*f5) \
                 * _np.exp((-2.0/f2) * _np.sin(f3*f5)**2)
 
@@ -203,17 +552,49 @@ class QuasiPeriodic(kernel):
         f1 = self.QP_theta**2
         f2 = self.QP_l1**2
         ff2 = self.QP_l2**2
-        f3 = _np.abs(r)
+        f3 = _lags.absolute(r)
         f4 = self.QP_P
         return f1 * _np.exp((-2/f2) * ((_np.sin(_np.pi*f3/f4))**2) \
                             - (0.5 * f3 * f3 / ff2))
 
+    def evaluate_into(self, r, out, work):
+        _np.multiply(_lags.absolute(r), _np.pi/self.QP_P, out=out)
+        _np.sin(out, out=out)
+        _np.square(out, out=out)
+        out *= -2/self.QP_l1**2
+        _np.multiply(_lags.squared(r), -0.5/self.QP_l2**2, out=work)
+        out += work
+        _np.exp(out, out=out)
+        out *= self.QP_theta**2
+        return out
+
+    def value_and_derivatives(self, r):
+        f1 = _lags.absolute(r)
+        f2 = self.QP_l1**2
+        ff2 = f1 * f1 / self.QP_l2**2
+        f3 = _np.pi * f1 / self.QP_P
+        f4 = _np.sin(f3)
+        K = self.QP_theta**2 * _np.exp((-2/f2) * f4**2 - 0.5*ff2)
+        return K, _np.array([2*K, (4/f2)*f4**2*K, ff2*K,
+                             (4/f2)*f3*f4*_np.cos(f3)*K])
+
+    def lag_derivatives(self, r):
+        r = _lags.signed(r)
+        f1 = 2 * _np.pi * r / self.QP_P
+        f2 = 2 * _np.pi / (self.QP_P * self.QP_l1**2)
+        f3 = 1 / self.QP_l2**2
+        K = self.QP_theta**2 * _np.exp((-1/self.QP_l1**2) * (1 - _np.cos(f1))
+                                       - 0.5*r**2*f3)
+        g1 = -f2 * _np.sin(f1) - r*f3
+        g2 = -2*_np.pi/self.QP_P * f2 * _np.cos(f1) - f3
+        return K, g1*K, (g2 + g1**2)*K
+
     def dqp_dtheta(self, r):
         """ Log-derivative in order to theta """
         f1 = self.QP_theta**2
         f2 = self.QP_l1**2
         ff2 = self.QP_l2**2
-        f3 = _np.abs(r)
+        f3 = _lags.absolute(r)
         f4 = self.QP_P
         return 2 * f1 * _np.exp((-2/f2) * ((_np.sin(_np.pi*f3/f4))**2) \
                                 -(0.5 * f3 * f3 / ff2))
@@ -223,7 +604,7 @@ class QuasiPeriodic(kernel):
         f1 = self.QP_theta**2
         f2 = self.QP_l1**2
         ff2 = self.QP_l2**2
-        f3 = _np.abs(r)
+        f3 = _lags.absolute(r)
         f4 = self.QP_P
         return 4 * f1 * _np.sin(_np.pi*f3/f4)**2 / f2 \
                 * _np.exp((-2/f2) * _np.sin(_np.pi*f3/f4)**2 \
@@ -234,7 +615,7 @@ class QuasiPeriodic(kernel):
         f1 = self.QP_theta**2
         f2 = self.QP_l1**2
         ff2 = self.QP_l2**2
-        f3 = _np.abs(r)
+        f3 = _lags.absolute(r)
         f4 = self.QP_P
         return f1 * f3 * f3 / ff2 \
                 * _np.exp((-2/f2) * _np.sin(_np.pi*f3/f4)**2 \
@@ -245,9 +626,9 @@ class QuasiPeriodic(kernel):
         f1 = self.QP_theta**2
         f2 = self.QP_l1**2
         ff2 = self.QP_l2**2
-        f3 = _np.abs(r)
+        f3 = _lags.absolute(r)
         f4 = self.QP_P
-        return 4 * _np.pi * f1 * _np.cos(_np.pi*f3/f4) \
+        return 4 * _np.pi * f1 * f3 * _np.cos(_np.pi*f3/f4) \
                 * _np.sin(_np.pi *f3 /f4 )/ (f2 * f4) \
                 *_np.exp((-2/f2) * _np.sin(_np.pi*f3/f4)**2 \
                          - (0.5 * f3 *f3 / ff2))
@@ -279,14 +660,38 @@ class RatQuadratic(kernel):
     def __call__(self, r):
         f1 = self.RQ_theta**2
         f2 = self.RQ_l**2
-        f3 = (r)**2
+        f3 = _lags.squared(r)
         f4 = self.RQ_alpha
         return f1 *(1 + (0.5 * f3 / ( f4 * f2))) ** (-f4)
 
+    def evaluate_into(self, r, out, work):
+        _np.multiply(_lags.squared(r), 0.5/(self.RQ_alpha*self.RQ_l**2),
+                     out=out)
+        out += 1
+        _np.power(out, -self.RQ_alpha, out=out)
+        out *= self.RQ_theta**2
+        return out
+
+    def value_and_derivatives(self, r):
+        f1 = _lags.squared(r) / self.RQ_l**2
+        f2 = self.RQ_alpha
+        f3 = 1.0 + f1 / (2.0 * f2)
+        K = self.RQ_theta**2 * f3 ** (-f2)
+        return K, _np.array([2*K, (f1/(2.0*f3) - f2*_np.log(f3))*K,
+                             f1/f3*K])
+
+    def lag_derivatives(self, r):
+        r = _lags.signed(r)
+        f1 = 1 / self.RQ_l**2
+        f2 = 1 + 0.5*r**2*f1/self.RQ_alpha
+        K = self.RQ_theta**2 * f2**(-self.RQ_alpha)
+        dK = -r*f1*K/f2
+        return K, dK, -f1*K/f2**2 * (f2 - (1 + 1/self.RQ_alpha)*r**2*f1)
+
     def drq_dtheta(self, r):
         """ Log-derivative in order to theta """
         f1 = self.RQ_theta**2
-        f2 = (r)**2
+        f2 = _lags.squared(r)
         f3 = self.RQ_alpha
         f4 = self.RQ_l**2
         return 2 * f1 * (1.0 + f2 / (2.0 * f3 * f4)) ** (-f3)
@@ -294,7 +699,7 @@ class RatQuadratic(kernel):
     def drq_dl(self, r):
         """ Log-derivatives in order to l """
         f1 = self.RQ_theta**2
-        f2 = (r)**2
+        f2 = _lags.squared(r)
         f3 = self.RQ_alpha
         f4 = self.RQ_l**2
         return ( f1 * f2 / f4) * (1.0 + f2 / (2.0 * f3 * f4)) ** (-1.0 - f3)
@@ -302,7 +707,7 @@ class RatQuadratic(kernel):
     def drq_dalpha(self, r):
         """ Log-derivative in order to alpha """
         f1 = self.RQ_theta**2
-        f2 = (r)**2
+        f2 = _lags.squared(r)
         f3 = self.RQ_alpha
         f4 = self.RQ_l**2
         func0 = 1.0 + f2/(2.0*f3*f4)
@@ -331,13 +736,20 @@ class WhiteNoise(kernel):
 
     def __call__(self, r):
         f1 = self.WN_theta**2
-        f2 = _np.diag(_np.diag(_np.ones_like(r)))
+        f2 = _lags.identity(r)
         return f1 * f2 
 
+    def evaluate_into(self, r, out, work):
+        return _lags.fill_identity(r, out, self.WN_theta**2)
+
+    def value_and_derivatives(self, r):
+        K = self.WN_theta**2 * _lags.identity(r)
+        return K, _np.array([2*K])
+
     def dwn_dtheta(self, r):
         """ Log-derivative in order to theta """
         f1 = self.WN_theta**2
-        f2 = _np.diag(_np.diag(_np.ones_like(r)))
+        f2 = _lags.identity(r)
         return 2 * f1 * f2
 
 
@@ -364,14 +776,25 @@ class Exponential(kernel):
         self.type = 'stationary'
         
     def __call__(self, r):
-        f1 = _np.abs(r)
+        f1 = _lags.absolute(r)
         f2 = self.Exp_l
         f3 = self.Exp_theta**2
         return f3 * _np.exp(-f1 / f2)
 
+    def evaluate_into(self, r, out, work):
+        _np.multiply(_lags.absolute(r), -1/self.Exp_l, out=out)
+        _np.exp(out, out=out)
+        out *= self.Exp_theta**2
+        return out
+
+    def value_and_derivatives(self, r):
+        f1 = _lags.absolute(r) / self.Exp_l
+        K = self.Exp_theta**2 * _np.exp(-f1)
+        return K, _np.array([2*K, f1*K])
+
     def dexp_dtheta(self, r):
         """ Log-derivative in order to theta """
-        f1 = _np.abs(r)
+        f1 = _lags.absolute(r)
         f2 = self.Exp_l
         f3 = self.Exp_theta**2
         return 2 * f3 * _np.exp(-f1 / f2)
@@ -379,7 +802,7 @@ class Exponential(kernel):
     def dexp_dl(self, r):
         """ Log-derivative in order to l """
         f1 = self.Exp_theta**2
-        f2 = _np.abs(r)
+        f2 = _lags.absolute(r)
         f3 = self.Exp_l
         return (f1 * f2 / f3) * _np.exp(-f2 / f3)
 
@@ -407,14 +830,29 @@ class Matern32(kernel):
         self.type = 'stationary'
 
     def __call__(self, r):
-        f1 = _np.sqrt(3.0)*_np.abs(r)
+        f1 = _np.sqrt(3.0)*_lags.absolute(r)
         f2 = self.M32_l
         f3 = self.M32_theta**2
         return f3 * (1.0 + f1 / f2) * _np.exp(-f1 / f2)
 
+    def evaluate_into(self, r, out, work):
+        _np.multiply(_lags.absolute(r), _np.sqrt(3.0)/self.M32_l, out=out)
+        _np.negative(out, out=work)
+        _np.exp(work, out=work)
+        out += 1
+        out *= work
+        out *= self.M32_theta**2
+        return out
+
+    def value_and_derivatives(self, r):
+        f1 = _np.sqrt(3.0) * _lags.absolute(r) / self.M32_l
+        f2 = self.M32_theta**2 * _np.exp(-f1)
+        K = (1.0 + f1) * f2
+        return K, _np.array([2*K, f1*f1*f2])
+
     def dm32_dtheta(self, r):
         """ Log-derivative in order to theta """
-        f1 = _np.sqrt(3.0) * _np.abs(r) 
+        f1 = _np.sqrt(3.0) * _lags.absolute(r) 
         f2 = self.M32_l
         f3 = self.M32_theta**2
         return 2 * f3 * (1.0 + f1 / f2) * _np.exp(-f1 / f2)
@@ -422,7 +860,7 @@ class Matern32(kernel):
     def dm32_dl(self, r):
         """ Log-derivative in order to l """
         f1 = self.M32_theta**2
-        f2 = _np.sqrt(3.0)*_np.abs(r)
+        f2 = _np.sqrt(3.0)*_lags.absolute(r)
         f3 = self.M32_l
         f4 = self.M32_l**2
         return f3 * f1 * (f2 / f4) * (1 + f2 / f3) * _np.exp(-f2 / f3) \
@@ -452,20 +890,47 @@ class Matern52(kernel):
         self.type = 'stationary'
 
     def __call__(self, r):
-        f1 = _np.sqrt(5.0) * _np.abs(r)
-        f2 = (_np.abs(r))**2
+        f1 = _np.sqrt(5.0) * _lags.absolute(r)
+        f2 = _lags.squared(r)
         f3 = self.M52_l
         f4 = self.M52_l**2
         f5 = self.M52_theta**2
         return f5 * (1.0 + f1 / f3 + (5.0 * f2) / (3.0 * f4)) * _np.exp(-f1 / f3)
 
+    def evaluate_into(self, r, out, work):
+        _np.multiply(_lags.absolute(r), _np.sqrt(5.0)/self.M52_l, out=work)
+        _np.square(work, out=out)
+        out *= 1/3.0
+        out += work
+        out += 1
+        _np.negative(work, out=work)
+        _np.exp(work, out=work)
+        out *= work
+        out *= self.M52_theta**2
+        return out
+
+    def value_and_derivatives(self, r):
+        f1 = _np.sqrt(5.0) * _lags.absolute(r) / self.M52_l
+        f2 = self.M52_theta**2 * _np.exp(-f1)
+        f3 = f1 * f1 / 3.0
+        K = (1.0 + f1 + f3) * f2
+        return K, _np.array([2*K, f3*(1.0 + f1)*f2])
+
+    def lag_derivatives(self, r):
+        r = _lags.signed(r)
+        f1 = _np.sqrt(5.0) * _np.abs(r) / self.M52_l
+        f2 = self.M52_theta**2 * _np.exp(-f1)
+        f3 = 5 / (3 * self.M52_l**2)
+        return (1.0 + f1 + f1*f1/3.0)*f2, -f3*r*(1 + f1)*f2, \
+               -f3*(1 + f1 - f1*f1)*f2
+
     def dm52_dtheta(self, r):
         """ Log-derivative in order to theta """
         f1 = self.M52_theta**2
         f2 = self.M52_l
         f3 = 3*(self.M52_l)**2
-        f4 = _np.sqrt(5)*_np.abs(r)
-        f5 = 5*_np.abs(r)**2
+        f4 = _np.sqrt(5)*_lags.absolute(r)
+        f5 = 5*_lags.squared(r)
         return 2 * f1 * (f5 / f3 + f4 / f2 +1) * _np.exp(-f4 / f2)
 
     def dm52_dl(self, r):
@@ -473,9 +938,9 @@ class Matern52(kernel):
         f1 = self.M52_theta**2
         f2 = self.M52_l
         f3 = self.M52_l**2
-        f4 = _np.abs(r)
-        f5 = _np.abs(r)**2
-        return 2 * f1 * ((5 * f2 * f5 + _np.sqrt(5**3) * f5 * f4) / (3 * f3 * f2) \
+        f4 = _lags.absolute(r)
+        f5 = _lags.squared(r)
+        return f1 * ((5 * f2 * f5 + _np.sqrt(5**3) * f5 * f4) / (3 * f3 * f2) \
                 *_np.exp(-_np.sqrt(5) * f4 / f2))
 
 
@@ -508,57 +973,85 @@ class RQP(kernel):
 
     def __call__(self, r):
         f1 = self.RQP_theta**2
-        f2 = _np.exp((-2*_np.sin(((_np.pi)*_np.abs(r))/self.RQP_P)**2)/self.RQP_l2**2)
-        f3 = (1 + r**2 / (2*self.RQP_a*self.RQP_l1**2) )**(-self.RQP_a)
+        f2 = _np.exp((-2*_np.sin(((_np.pi)*_lags.absolute(r))/self.RQP_P)**2)/self.RQP_l2**2)
+        f3 = (1 + _lags.squared(r) / (2*self.RQP_a*self.RQP_l1**2) )**(-self.RQP_a)
         return f1 * f2 * f3
 
+    def evaluate_into(self, r, out, work):
+        _np.multiply(_lags.absolute(r), _np.pi/self.RQP_P, out=out)
+        _np.sin(out, out=out)
+        _np.square(out, out=out)
+        out *= -2/self.RQP_l2**2
+        _np.exp(out, out=out)
+        _np.multiply(_lags.squared(r), 1/(2*self.RQP_a*self.RQP_l1**2),
+                     out=work)
+        work += 1
+        _np.power(work, -self.RQP_a, out=work)
+        out *= work
+        out *= self.RQP_theta**2
+        return out
+
+    def value_and_derivatives(self, r):
+        f1 = _lags.squared(r) / self.RQP_l1**2
+        f2 = 1 + f1 / (2*self.RQP_a)
+        f3 = _np.pi * _lags.absolute(r) / self.RQP_P
+        f4 = _np.sin(f3)
+        f5 = self.RQP_l2**2
+        K = self.RQP_theta**2 * _np.exp(-2*f4**2/f5) * f2**(-self.RQP_a)
+        return K, _np.array([2*K, f1/f2*K,
+                             (f1/(2*f2) - self.RQP_a*_np.log(f2))*K,
+                             (4/f5)*f4**2*K, (4/f5)*f3*f4*_np.cos(f3)*K])
+
 
     def drqp_dtheta(self,r):
         """ Log-derivative in order to theta """
-        f1 = _np.exp(-(2*_np.sin(((_np.pi)*_np.abs(r))/self.RQP_P)**2)/self.RQP_l2**2)
-        f2 = (1+r**2/(2*self.RQP_a*self.RQP_l1**2))**self.RQP_a
+        f1 = _np.exp(-(2*_np.sin(((_np.pi)*_lags.absolute(r))/self.RQP_P)**2)/self.RQP_l2**2)
+        f2 = (1+_lags.squared(r)/(2*self.RQP_a*self.RQP_l1**2))**self.RQP_a
         return 2* f1/f2 * self.RQP_theta**2
 
     def drqp_dl1(self, r):
         """ Log-derivatives in order to l1 """
-        f1 = r**2
-        f2 = (1+r**2/(2*self.RQP_a*self.RQP_l1**2))**(-1-self.RQP_a)
+        f1 = _lags.squared(r)
+        f2 = (1+_lags.squared(r)/(2*self.RQP_a*self.RQP_l1**2))**(-1-self.RQP_a)
         f3 = self.RQP_theta**2
-        f4 = _np.exp(-(2*_np.sin(((_np.pi)*_np.abs(r))/self.RQP_P)**2)/self.RQP_l2**2)
+        f4 = _np.exp(-(2*_np.sin(((_np.pi)*_lags.absolute(r))/self.RQP_P)**2)/self.RQP_l2**2)
         f5 = self.RQP_l1**3
-        return self.RQP_l1 * f1 * f2 * f3 * f4 *f5
+        return self.RQP_l1 * f1 * f2 * f3 * f4 / f5
 
     def drqp_da(self, r):
-        f1 = r**2/(2*self.RQP_a*(r**2/(2*self.RQP_a*self.RQP_l1**2)+1)*self.RQP_l1**2)
-        f2 = _np.log(r**2/(2*self.RQP_a*self.RQP_l1**2)+1)
+        f1 = _lags.squared(r)/(2*self.RQP_a*(_lags.squared(r)/(2*self.RQP_a*self.RQP_l1**2)+1)*self.RQP_l1**2)
+        f2 = _np.log(_lags.squared(r)/(2*self.RQP_a*self.RQP_l1**2)+1)
         f3 = self.RQP_theta**2
-        f4 = _np.exp(-(2*_np.sin(((_np.pi)*_np.abs(r))/self.RQP_P)**2)/self.RQP_l2**2)
-        f5 = (1+r**2/(2*self.RQP_a*self.RQP_l1**2))**self.RQP_a
+        f4 = _np.exp(-(2*_np.sin(((_np.pi)*_lags.absolute(r))/self.RQP_P)**2)/self.RQP_l2**2)
+        f5 = (1+_lags.squared(r)/(2*self.RQP_a*self.RQP_l1**2))**self.RQP_a
         """ Log-derivative in order to alpha """
         return self.RQP_a * (f1 - f2) * f3 * f4 / f5
 
     def drqp_dl2(self, r):
         """ Log-derivatives in order to l2 """
         f1 = 4*self.RQP_theta**2
-        f2 = _np.sin((_np.pi)*_np.abs(r)/self.RQP_P)**2
-        f3 = _np.exp(-(2*_np.sin(((_np.pi)*_np.abs(r))/self.RQP_P)**2)/self.RQP_l2**2)
-        f4 = (1+r**2/(2*self.RQP_a*self.RQP_l1**2))**self.RQP_a
+        f2 = _np.sin((_np.pi)*_lags.absolute(r)/self.RQP_P)**2
+        f3 = _np.exp(-(2*_np.sin(((_np.pi)*_lags.absolute(r))/self.RQP_P)**2)/self.RQP_l2**2)
+        f4 = (1+_lags.squared(r)/(2*self.RQP_a*self.RQP_l1**2))**self.RQP_a
         f5 = self.RQP_l2**2
         return f1 * f2 * f3 / (f4 * f5)
 
     def drqp_dlP(self, r):
         """ Log-derivatives in order to P """
-        f1 = 4*(_np.pi)*r*self.RQP_theta**2
-        f2 = _np.cos(((_np.pi)*_np.abs(r))/self.RQP_P)
-        f3 = _np.sin(((_np.pi)*_np.abs(r))/self.RQP_P)
-        f4 = _np.exp(-(2*_np.sin(((_np.pi)*_np.abs(r)/self.RQP_P)**2)/self.RQP_l2**2))
-        f5 = (1+r**2/(2*self.RQP_a*self.RQP_l1**2))**self.RQP_a
+        f1 = 4*(_np.pi)*_lags.absolute(r)*self.RQP_theta**2
+        f2 = _np.cos(((_np.pi)*_lags.absolute(r))/self.RQP_P)
+        f3 = _np.sin(((_np.pi)*_lags.absolute(r))/self.RQP_P)
+        f4 = _np.exp(-(2*_np.sin(((_np.pi)*_lags.absolute(r))/self.RQP_P)**2)/self.RQP_l2**2)
+        f5 = (1+_lags.squared(r)/(2*self.RQP_a*self.RQP_l1**2))**self.RQP_a
         f6 = self.RQP_l2**2*self.RQP_P
         return f1 * f2 * f3 * f4 /(f5 * f6)
 
 class Linear(kernel):
     """
-        Definition of the linear kernel
+        Definition of the linear kernel, k(x_i, x_j) = c**2 * x_i * x_j, the
+    only non-stationary kernel: it needs the times themselves and not only
+    their differences, so it has to be evaluated on a Lags object (the
+    functions of calc take care of that)
 
         Important
     The derivative should be in respect to log(parameter)
@@ -577,11 +1070,19 @@ class Linear(kernel):
 
     def __call__(self, r):
         f1 = self.c**2
-        f2 = r
+        f2 = _lags.products(r)
         return f1 * f2
 
+    def evaluate_into(self, r, out, work):
+        _np.multiply(_lags.products(r), self.c**2, out=out)
+        return out
+
+    def value_and_derivatives(self, r):
+        K = self.c**2 * _lags.products(r)
+        return K, _np.array([2*K])
+
     def dl_dc(self, r):
-        """ Log-derivatives in order to P """
+        """ Log-derivatives in order to c """
         f1 = self.c**2
-        f2 = r
+        f2 = _lags.products(r)
         return 2 * f1 * f2
\ No newline at end of file
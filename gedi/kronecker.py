@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Kronecker path for S instruments observing the same M epochs
+(simultaneous spectrographs). The measurements form an S x M array Y and,
+ordering them instrument by instrument, the covariance matrix is
+    C = B (x) K + D (x) I
+with B the S x S covariance between instruments, K the M x M matrix of the
+kernel on the common times and D diagonal with the white noise of each
+instrument, jitter**2 + yerr**2. With the eigendecompositions
+    D^-1/2.B.D^-1/2 = U.diag(s).U^T,   K = V.diag(k).V^T
+C is diagonal in the basis D^1/2.U (x) V, so
+    log(det(C)) = sum_ij log(s_i*k_j + 1) + M*sum_i log(D_i)
+    Y^T.C^-1.Y  = sum_ij Z_ij**2 / (s_i*k_j + 1),  Z = U^T.D^-1/2.Y.V
+in O(M**3 + S**3 + S*M**2) time and O(M**2) memory instead of O((S*M)**3)
+and O((S*M)**2) for the dense matrix. The error of each instrument needs to
+be the same on every epoch, the jitter usually dominates; otherwise use
+calc.likelihood() or multioutput.likelihood().
+"""
+import numpy as _np
+
+from gedi import calc as _calc
+from gedi import profiling as _profiling
+
+
+def _noise(yerr, jitter, shape):
+    """ White noise variance D of each instrument """
+    S, M = shape
+    yerr = _np.asarray(yerr, dtype=float)
+    if yerr.ndim == 2:
+        if not _np.all(yerr == yerr[:, :1]):
+            raise ValueError('kronecker: yerr needs to be the same on every '
+                             'epoch of an instrument')
+        yerr = yerr[:, 0]
+    D = _np.broadcast_to(yerr, (S,))**2
+    if jitter is not None:
+        D = D + _np.broadcast_to(_np.asarray(jitter, dtype=float), (S,))**2
+    if _np.any(D <= 0):
+        raise ValueError('kronecker: the white noise of every instrument '
+                         'needs to be positive')
+    return D
+
+
+def _decompose(kern, x, yerr, instruments, jitter):
+    """ Eigendecompositions of the whitened instrument matrix and of K """
+    B = _np.atleast_2d(_np.asarray(instruments, dtype=float))
+    D = _noise(yerr, jitter, (B.shape[0], _np.size(x)))
+    start = _profiling.tic()
+    s, U = _np.linalg.eigh(B / _np.sqrt(_np.outer(D, D)))
+    k, V = _np.linalg.eigh(_calc.build_matrix(kern, x, 0.))
+    _profiling.toc('eigh', start)
+    #rounding errors of positive semidefinite matrices
+    return _np.maximum(s, 0), U, _np.maximum(k, 0), V, D
+
+
+def likelihood(kern, x, y, yerr, instruments, offsets=None, jitter=None):
+    """
+        likelihood() calculates the marginal log likelihood of S instruments
+    observing the same epochs
+
+        Parameters
+    kern = kernel in use for the times, without WhiteNoise (use jitter)
+    x = the M common epochs
+    y = S x M array with the measurements of each instrument
+    yerr = errors of each instrument, S values or an S x M array constant
+            along each row
+    instruments = S x S covariance matrix between instruments, for example
+                np.outer(a, a) for the same signal with amplitudes a
+    offsets = S offsets subtracted from the measurements of each instrument
+    jitter = S values added in quadrature to the errors of each instrument
+
+        Returns
+    log_like = marginal log likelihood
+    """
+    _profiling.count('likelihood')
+    Y = _np.atleast_2d(_np.asarray(y, dtype=float))
+    if offsets is not None:
+        Y = Y - _np.asarray(offsets, dtype=float)[:, None]
+    s, U, k, V, D = _decompose(kern, x, yerr, instruments, jitter)
+    if Y.shape != (s.size, k.size):
+        raise ValueError('kronecker: y needs to be an array of {0} '
+                         'instruments x {1} epochs'.format(s.size, k.size))
+    start = _profiling.tic()
+    Z = _np.dot(U.T, Y / _np.sqrt(D)[:, None]).dot(V)
+    eig = _np.outer(s, k) + 1
+    log_like = -0.5*_np.sum(Z**2 / eig) \
+               - 0.5*(_np.sum(_np.log(eig)) + k.size*_np.sum(_np.log(D))) \
+               - Y.size*0.5*_np.log(2*_np.pi)
+    _profiling.toc('solve', start)
+    return log_like
+
+
+##### END
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Prepared inputs for the kernels: the time differences r = x_i - x_j, |r|
+and r**2 do not depend on the hyperparameters, so a Lags object computes
+them once and they are reused on every kernel evaluation.
+
+    With compact=True only the upper triangle (diagonal included) is kept,
+as a flat array, which halves the memory and the work of evaluating the
+kernels, the symmetric matrix being rebuilt by full().
+
+    Lags(x, other=new_x) holds the differences x_i - new_x_j between two
+different sets of observations, used for cross covariances (e.g.
+predictions), where WhiteNoise does not contribute.
+
+    Every function of calc that receives x also accepts a Lags object, e.g.
+        lags = Lags(x)
+        calc.likelihood(kernel, lags, y, yerr)
+"""
+import numpy as _np
+
+
+class Lags(object):
+    """
+        Time differences of a set of observations and their absolute values
+    and squares, computed only once.
+
+        Parameters
+    x = range of values of the independent variable (usually time)
+    compact = True to store only the upper triangle of the matrices
+    other = second set of times to get the cross differences x_i - other_j
+    """
+    def __init__(self, x, compact=False, other=None):
+        self.x = _np.asarray(x, dtype=float)
+        self.compact = compact
+        self.other = other
+        if other is not None:
+            if compact:
+                raise ValueError('Lags: cross differences cannot be compact')
+            self.other = _np.asarray(other, dtype=float)
+            self.r = self.x[:, None] - self.other[None, :]
+        elif compact:
+            self.upper = _np.triu(_np.ones((self.x.size, self.x.size),
+                                           dtype=bool))
+            rows, cols = _np.nonzero(self.upper)
+            self.r = self.x[rows] - self.x[cols]
+            del rows, cols
+        else:
+            self.r = self.x[:, None] - self.x[None, :]
+        self.abs = _np.abs(self.r)
+        self.sq = self.r**2
+
+    def __len__(self):
+        return self.x.size
+
+    def __repr__(self):
+        if self.other is not None:
+            return "Lags({0} x {1} points)".format(self.x.size, self.other.size)
+        return "Lags({0} points{1})".format(self.x.size,
+                                            ", compact" if self.compact else "")
+
+
+def differences(x, times=False):
+    """
+        Returns x if it is a Lags object, the matrix x_i - x_j otherwise, or
+    a Lags object if times is True, for the kernels that need the times
+    themselves (Linear)
+    """
+    if isinstance(x, Lags):
+        return x
+    if times:
+        return Lags(x)
+    return x[:, None] - x[None, :]
+
+
+def times(x):
+    """ Returns the times of a Lags object, or x itself """
+    if isinstance(x, Lags):
+        return x.x
+    return x
+
+
+def signed(r):
+    """ Time differences r """
+    if isinstance(r, Lags):
+        return r.r
+    return r
+
+
+def absolute(r):
+    """ Absolute value of the time differences |r| """
+    if isinstance(r, Lags):
+        return r.abs
+    return _np.abs(r)
+
+
+def squared(r):
+    """ Square of the time differences r**2 """
+    if isinstance(r, Lags):
+        return r.sq
+    return r**2
+
+
+def products(r):
+    """ Products of the times x_i * x_j, as used by Linear """
+    if not isinstance(r, Lags):
+        raise ValueError('products: the times are needed, use a Lags object')
+    if r.other is not None:
+        return r.x[:, None] * r.other[None, :]
+    if r.compact:
+        return _np.outer(r.x, r.x)[r.upper]
+    return _np.outer(r.x, r.x)
+
+
+def identity(r):
+    """ Identity matrix with the shape of r, as used by WhiteNoise """
+    if isinstance(r, Lags):
+        if r.other is not None:
+            return _np.zeros(r.r.shape)
+        if r.compact:
+            return _np.identity(len(r))[r.upper]
+        return _np.identity(len(r))
+    if _np.ndim(r) == 2:
+        return _np.eye(*_np.shape(r))
+    return _np.diag(_np.diag(_np.ones_like(r)))
+
+
+def fill_identity(r, out, value):
+    """ Writes value times identity(r) into out, without building it """
+    if not isinstance(r, Lags) and _np.ndim(r) != 2:
+        out[...] = value * identity(r)
+        return out
+    out[...] = 0
+    if isinstance(r, Lags) and r.other is not None:
+        return out
+    value = _np.asarray(value)
+    if isinstance(r, Lags) and r.compact:
+        i = _np.arange(len(r))
+        out[..., i*len(r) - i*(i-1)//2] = value
+    else:
+        i = _np.arange(min(out.shape[-2:]))
+        #hyperparameters given as arrays end with two unit dimensions
+        out[..., i, i] = value[..., 0] if value.ndim >= 2 else value
+    return out
+
+
+def full(r, K):
+    """
+        full() returns the full symmetric matrices of a kernel evaluated on
+    compact lags, K can have leading dimensions (e.g. derivatives)
+    """
+    if not (isinstance(r, Lags) and r.compact):
+        return K
+    n = len(r)
+    out = _np.empty(K.shape[:-1] + (n, n))
+    out[..., r.upper] = K
+    _np.swapaxes(out, -1, -2)[..., r.upper] = K
+    return out
+
+
+def weights(r, A):
+    """
+        weights() returns the symmetric matrix A as weights of the kernel
+    entries, so that sum_ij dK[..., i, j] * A[i, j] is the sum of dK times
+    the weights: A itself, or for compact lags its upper triangle with the
+    off-diagonal entries doubled
+    """
+    if not (isinstance(r, Lags) and r.compact):
+        return A
+    n = len(r)
+    w = 2*A[r.upper]
+    i = _np.arange(n)
+    w[i*n - i*(i-1)//2] -= _np.diag(A)
+    return w
+
+
+def contract(r, dK, A):
+    """
+        contract() calculates sum_ij dK[..., i, j] * A[i, j] for a symmetric
+    A, working directly on the upper triangle for compact lags
+    """
+    w = weights(r, A)
+    return _np.tensordot(dK, w, axes=w.ndim)
+
+
+##### END
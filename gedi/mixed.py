@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Mixed precision log likelihood: the kernels are evaluated and the
+covariance matrix is stored and factorized in float32, which halves the
+memory and the memory traffic, while a few steps of iterative refinement
+recover an accurate solve. The residuals of the refinement use the float64
+kernel, evaluated a few rows at a time so it is never stored. The log
+likelihood and its gradient are accumulated in float64, and a bound of the
+error introduced by the float32 matrix is returned with them.
+"""
+import copy as _copy
+
+import numpy as _np
+from scipy.linalg import cho_solve as _cho_solve
+from scipy.linalg import cholesky as _cholesky
+
+from gedi import kernels as _kernels
+from gedi import lags as _lags
+
+
+def _matvec(A, v, chunk=1024):
+    """ A.v in float64 for a float32 A, converting only a few rows at a time """
+    out = _np.empty(A.shape[0])
+    for start in range(0, A.shape[0], chunk):
+        out[start:start+chunk] = _np.dot(A[start:start+chunk].astype(_np.float64),
+                                         v)
+    return out
+
+
+class _Float64Matrix(object):
+    """
+        Float64 covariance matrix that is never stored, its products with
+    vectors evaluate the kernel a few rows at a time
+    """
+    def __init__(self, kern, x, yerr, chunk=1024):
+        self.kern = kern
+        self.x = _np.asarray(_lags.times(x), dtype=_np.float64)
+        zero = _np.zeros(1)
+        #WhiteNoise and errors only on the diagonal
+        self.diag = _np.broadcast_to(_np.asarray(yerr, _np.float64)**2,
+                                     self.x.shape) \
+                    + kern(_lags.Lags(zero))[0, 0] \
+                    - kern(_lags.Lags(zero, other=zero))[0, 0]
+        self.chunk = chunk
+
+    def dot(self, v):
+        out = self.diag * v
+        for start in range(0, self.x.size, self.chunk):
+            rows = self.kern(_lags.Lags(self.x[start:start+self.chunk],
+                                        other=self.x))
+            out[start:start+self.chunk] += _np.dot(rows, v)
+        return out
+
+
+def _build(kern, x, yerr, derivatives=False):
+    """ Covariance matrix (and derivatives) evaluated in float32 """
+    r = _lags.differences(x, not _kernels.is_stationary(kern))
+    if not isinstance(r, _lags.Lags):
+        r = r.astype(_np.float32)
+    else:
+        r = _copy.copy(r)
+        r.r, r.abs, r.sq = [e.astype(_np.float32) for e in (r.r, r.abs, r.sq)]
+    if derivatives:
+        K, dK = kern.value_and_derivatives(r)
+        dK = _lags.full(r, dK).astype(_np.float32, copy=False)
+    else:
+        K = kern(r)
+    K = _lags.full(r, K).astype(_np.float32, copy=False)
+    yerr = _np.broadcast_to(_np.asarray(yerr, dtype=_np.float32), K.shape[:1])
+    K[_np.diag_indices_from(K)] += yerr**2
+    if derivatives:
+        return K, dK
+    return K
+
+
+def _solve(K64, L, y, refine, tol):
+    """
+        _solve() solves K.alpha = y with the float32 Cholesky factor L,
+    refining the solution with the residuals of the float64 matrix K64
+
+        Returns
+    alpha = solution in float64
+    residual = final residual y - K64.alpha
+    """
+    alpha = _cho_solve((L, True), y.astype(_np.float32)).astype(_np.float64)
+    residual = y - K64.dot(alpha)
+    for i in range(refine):
+        if _np.linalg.norm(residual) <= tol*_np.linalg.norm(y):
+            break
+        alpha += _cho_solve((L, True),
+                            residual.astype(_np.float32)).astype(_np.float64)
+        residual = y - K64.dot(alpha)
+    return alpha, residual
+
+
+def _factor(K, K64, y, refine, tol, probes):
+    """ Float32 Cholesky, refined solve and float64 log likelihood """
+    L = _cholesky(K, lower=True)
+    del K
+    alpha, residual = _solve(K64, L, y, refine, tol)
+    log_det = 2*_np.sum(_np.log(_np.diag(L).astype(_np.float64)))
+    log_like = -0.5*_np.dot(y, alpha) - 0.5*log_det \
+               - y.size*0.5*_np.log(2*_np.pi)
+
+    #error of y.K^-1.y from the residual, and of log(det(K)) from the
+    #difference between the float32 factorization and the float64 matrix,
+    #tr(K^-1.(L.L^T - K)), estimated with random probe vectors; the bound
+    #adds 3 standard errors of the estimate, a single estimate with a few
+    #probes is often below the real error
+    if probes < 2:
+        raise ValueError('mixed: at least 2 probes are needed to bound the '
+                         'error of the log determinant')
+    samples = _np.empty(probes)
+    rng = _np.random.RandomState(0)
+    for i in range(probes):
+        z = rng.choice([-1., 1.], size=y.size)
+        ez = _matvec(L, _matvec(L.T, z)) - K64.dot(z)
+        samples[i] = _np.dot(z, _solve(K64, L, ez, refine, tol)[0])
+    error = {'quad': abs(_np.dot(alpha, residual)),
+             'log_det': abs(_np.mean(samples))
+                        + 3*_np.std(samples, ddof=1)/_np.sqrt(probes),
+             'residual': _np.linalg.norm(residual) / _np.linalg.norm(y)}
+    error['log_like'] = 0.5*error['quad'] + 0.5*error['log_det']
+    return log_like, alpha, L, error
+
+
+def likelihood(kern, x, y, yerr, refine=3, tol=1e-10, probes=8):
+    """
+        likelihood() calculates the marginal log likelihood in mixed
+    precision, the equivalent of calc.likelihood()
+
+        Parameters
+    kern = kernel in use
+    x = range of values of the independent variable (usually time)
+    y = range of values of te dependent variable (the measurments)
+    yerr = error in the measurments
+    refine = maximum number of iterative refinement steps, each one
+            evaluating the float64 kernel once, in chunks of rows
+    tol = relative residual at which the refinement stops
+    probes = number of random vectors to estimate the log determinant error,
+            at least 2, each one costs a refined solve
+
+        Returns
+    log_like = marginal log likelihood
+    error = dictionary with the bounds of the absolute errors of the
+            quadratic term ('quad'), of the log determinant ('log_det', the
+            estimate plus 3 of its standard errors) and of the log
+            likelihood ('log_like'), and the relative residual of the solve
+            ('residual')
+    """
+    y = _np.asarray(y, dtype=_np.float64)
+    K64 = _Float64Matrix(kern, x, yerr)
+    log_like, alpha, L, error = _factor(_build(kern, x, yerr), K64, y,
+                                        refine, tol, probes)
+    return log_like, error
+
+
+def likelihood_gradient(kern, x, y, yerr, refine=3, tol=1e-10, probes=8):
+    """
+        likelihood_gradient() calculates the marginal log likelihood and its
+    gradient in mixed precision, the equivalent of
+    calc.likelihood_gradient(). The derivative matrices and K^-1 are kept
+    in float32 and the trace terms are summed in float64.
+
+        Parameters
+    kern = kernel in use
+    x = range of values of the independent variable (usually time)
+    y = range of values of te dependent variable (the measurments)
+    yerr = error in the measurments
+    refine = maximum number of iterative refinement steps
+    tol = relative residual at which the refinement stops
+    probes = number of random vectors to estimate the log determinant error,
+            at least 2, each one costs a refined solve
+
+        Returns
+    log_like = marginal log likelihood
+    grad = array with the derivatives in order to the log(parameters)
+    error = dictionary with the error bounds, see likelihood()
+    """
+    y = _np.asarray(y, dtype=_np.float64)
+    K, dK = _build(kern, x, yerr, derivatives=True)
+    K64 = _Float64Matrix(kern, x, yerr)
+    log_like, alpha, L, error = _factor(K, K64, y, refine, tol, probes)
+    del K
+    kinv = _cho_solve((L, True), _np.identity(y.size, dtype=_np.float32))
+    grad = _np.empty(dK.shape[0])
+    for i, e in enumerate(dK):
+        grad[i] = 0.5*_np.dot(alpha, _matvec(e, alpha)) \
+                  - 0.5*_np.sum(e * kinv, dtype=_np.float64)
+    return log_like, grad, error
+
+
+##### END
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Multi-output Gaussian process for the radial velocities together with
+activity indicators (FWHM, BIS, log R'HK, ...), following Rajpaul et al.
+(2015). Q latent processes G_q, each with its own kernel, are shared by the
+S series, and series s is the combination
+    y_s(t) = sum_q a_qs*G_q(t) + b_qs*dG_q/dt(t)
+so the covariance between point i of series s and point j of series u,
+with r = t_i - t_j, is
+    sum_q a_qs*a_qu*K_q + (b_qs*a_qu - a_qs*b_qu)*K_q' - b_qs*b_qu*K_q''
+with K_q' and K_q'' the derivatives in order to r (kernel.lag_derivatives).
+
+    The latent kernels and their derivatives are evaluated once, on the
+distinct times of all the series (the indicators are usually measured on
+the same spectra as the radial velocities), and each term is weighted by
+the per point amplitudes in a single work array and added to the full
+matrix, without building the S*S blocks one by one. The derivative terms
+are skipped for the latent processes with no derivative coupling. With N
+points in total and M distinct times the cost is
+    memory ~ 2*N**2 (full matrix and work array) + N*M + 3*M**2 (latent
+             matrices, one q at a time) and another N**2 for the Cholesky
+             factor in likelihood()
+    time   ~ Q*M**2 kernel evaluations + Q*N**2 products + N**3/3 (Cholesky)
+so for S series on the same M times, N = S*M, the kernels cost as much as
+for a single series but the memory is O((S*M)**2), as for the dense
+matrix of calc.likelihood(), and the factorization of the S*M x S*M matrix
+dominates the time.
+"""
+import numpy as _np
+
+from gedi import calc as _calc
+from gedi import profiling as _profiling
+
+
+def _stack(x_list, yerr_list):
+    """ Times, errors and series index of all the points, concatenated """
+    x = _np.concatenate([_np.asarray(e, dtype=float) for e in x_list])
+    yerr = _np.concatenate([_np.broadcast_to(_np.asarray(e, dtype=float),
+                                             _np.shape(t))
+                            for e, t in zip(yerr_list, x_list)])
+    series = _np.concatenate([_np.full(_np.size(t), i, dtype=int)
+                              for i, t in enumerate(x_list)])
+    return x, yerr, series
+
+
+def _add_term(K, work, Kq, inverse, u, v, sign=1):
+    """ K += sign*outer(u, v)*Kq[inverse][:, inverse], through work """
+    _np.take(Kq[inverse], inverse, axis=1, out=work)
+    work *= u[:, None]
+    work *= v
+    if sign > 0:
+        K += work
+    else:
+        K -= work
+
+
+def covariance(kernels, x_list, yerr_list, amplitudes,
+               derivative_amplitudes=None, jitter=None):
+    """
+        covariance() builds the covariance matrix of all the series,
+    concatenated in the order of x_list
+
+        Parameters
+    kernels = list of the Q kernels of the latent processes, without
+            WhiteNoise (use jitter instead)
+    x_list = list of the S arrays of times, one per series
+    yerr_list = list of the S arrays of errors
+    amplitudes = Q x S array with the amplitudes a_qs of the latent
+                processes in each series
+    derivative_amplitudes = Q x S array with the amplitudes b_qs of their
+                            time derivatives, no derivatives if None
+    jitter = S values added in quadrature to the errors of each series
+
+        Returns
+    K = covariance matrix
+    """
+    x, yerr, series = _stack(x_list, yerr_list)
+    a = _np.atleast_2d(_np.asarray(amplitudes, dtype=float))
+    b = _np.zeros_like(a) if derivative_amplitudes is None else \
+        _np.atleast_2d(_np.asarray(derivative_amplitudes, dtype=float))
+    if a.shape != (len(kernels), len(x_list)) or b.shape != a.shape:
+        raise ValueError('the amplitudes must be arrays of {0} latent '
+                         'processes x {1} series'.format(len(kernels),
+                                                         len(x_list)))
+    start = _profiling.tic()
+    times, inverse = _np.unique(x, return_inverse=True)
+    r = times[:, None] - times[None, :]
+    K = _np.zeros((x.size, x.size))
+    work = _np.empty_like(K)
+    for q, kern in enumerate(kernels):
+        #amplitudes of each point
+        aq, bq = a[q][series], b[q][series]
+        if _np.any(bq):
+            Kq, dKq, d2Kq = kern.lag_derivatives(r)
+            _add_term(K, work, Kq, inverse, aq, aq)
+            _add_term(K, work, dKq, inverse, bq, aq)
+            _add_term(K, work, dKq, inverse, aq, bq, -1)
+            _add_term(K, work, d2Kq, inverse, bq, bq, -1)
+        else:
+            _add_term(K, work, kern(r), inverse, aq, aq)
+    diag = yerr**2
+    if jitter is not None:
+        diag = diag + _np.asarray(jitter, dtype=float)[series]**2
+    K[_np.diag_indices_from(K)] += diag
+    _profiling.toc('build_matrix', start)
+    return K
+
+
+def likelihood(kernels, x_list, y_list, yerr_list, amplitudes,
+               derivative_amplitudes=None, jitter=None):
+    """
+        likelihood() calculates the marginal log likelihood of all the
+    series together, with a single Cholesky factorization of the full
+    N x N matrix of the N points of all the series, so the memory is
+    O(N**2) as in calc.likelihood() (see the cost above)
+
+        Parameters
+    kernels = list of the Q kernels of the latent processes
+    x_list = list of the S arrays of times, one per series
+    y_list = list of the S arrays of measurements, with the means (the
+            keplerians of the radial velocities, offsets, ...) subtracted
+    yerr_list = list of the S arrays of errors
+    amplitudes = Q x S array with the amplitudes of the latent processes
+    derivative_amplitudes = Q x S array with the amplitudes of their time
+                            derivatives, no derivatives if None
+    jitter = S values added in quadrature to the errors of each series
+
+        Returns
+    log_like = marginal log likelihood
+    """
+    _profiling.count('likelihood')
+    K = covariance(kernels, x_list, yerr_list, amplitudes,
+                   derivative_amplitudes, jitter)
+    y = _np.concatenate([_np.asarray(e, dtype=float) for e in y_list])
+    return _calc._log_likelihood(K, y)
+
+
+##### END
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Maximum likelihood hyperparameters: L-BFGS-B on the log(parameters)
+with the analytic gradient, restarted from several random points, the
+restarts running at the same time on a pool of processes since the
+likelihood surface has many local maxima (e.g. in the period of the
+QuasiPeriodic kernel).
+"""
+import copy as _copy
+import time as _time
+from multiprocessing import Pool as _Pool
+
+import numpy as _np
+from scipy.optimize import minimize as _minimize
+
+from gedi import calc as _calc
+
+
+def _objective(log_pars, kern, x, y, yerr):
+    """ -log likelihood and its gradient, kern is updated in place """
+    kern.set_parameter_vector(log_pars, log=True)
+    try:
+        value, grad = _calc.minus_likelihood_gradient(kern, x, y, yerr)
+    except _np.linalg.LinAlgError:
+        return 1e25, _np.zeros_like(log_pars)
+    if not _np.isfinite(value):
+        return 1e25, _np.zeros_like(log_pars)
+    return value, grad
+
+
+def _run_start(args):
+    """ One L-BFGS-B run, inside a worker of the pool or serially """
+    kern, x, y, yerr, start, bounds, options = args
+    begin = _time.time()
+    result = _minimize(_objective, start, args=(kern, x, y, yerr),
+                       jac=True, method='L-BFGS-B', bounds=bounds,
+                       options=options)
+    return {'start': _np.exp(start),
+            'pars': _np.exp(result.x),
+            'log_like': -result.fun,
+            'nfev': result.nfev,
+            'nit': result.nit,
+            'success': result.success,
+            'message': str(result.message),
+            'time': _time.time() - begin}
+
+
+def _log_bounds(bounds, size):
+    """ Bounds of the log(parameters), None where there is no bound """
+    if bounds is None:
+        return [(None, None)] * size
+    if len(bounds) != size:
+        raise ValueError('optimize: expected {0} bounds, got {1}'.format(
+                         size, len(bounds)))
+    return [tuple(None if b is None else _np.log(b) for b in pair)
+            for pair in bounds]
+
+
+def starting_points(kern, starts, bounds=None, scale=1.0, seed=None):
+    """
+        starting_points() draws the log(parameters) where each run starts,
+    the first one being the current hyperparameters of the kernel
+
+        Parameters
+    kern = kernel in use
+    starts = number of starting points
+    bounds = (lower, upper) of each free hyperparameter, the points are
+            drawn uniformly in log between them when both are given
+    scale = standard deviation in log of the points drawn around the
+            current hyperparameters, for the parameters without both bounds
+    seed = seed of the random numbers
+
+        Returns
+    points = array (starts, P) with the log(parameters)
+    """
+    rng = _np.random.RandomState(seed)
+    current = kern.get_parameter_vector(log=True)
+    log_bounds = _log_bounds(bounds, current.size)
+    points = _np.empty((starts, current.size))
+    points[0] = current
+    for i, (lower, upper) in enumerate(log_bounds):
+        if lower is not None and upper is not None:
+            points[1:, i] = rng.uniform(lower, upper, starts - 1)
+        else:
+            points[1:, i] = current[i] + scale*rng.randn(starts - 1)
+            if lower is not None:
+                points[1:, i] = _np.maximum(points[1:, i], lower)
+            if upper is not None:
+                points[1:, i] = _np.minimum(points[1:, i], upper)
+    return points
+
+
+def optimize(kern, x, y, yerr, bounds=None, starts=1, processes=None,
+             seed=None, scale=1.0, maxiter=1000):
+    """
+        optimize() finds the hyperparameters that maximize the log
+    likelihood, running L-BFGS-B from several starting points, see
+    starting_points(). The frozen hyperparameters are kept fixed.
+
+        Parameters
+    kern = kernel in use, it is not changed
+    x = range of values of the independent variable (usually time)
+    y = range of values of te dependent variable (the measurments)
+    yerr = error in the measurments
+    bounds = list of (lower, upper) for each free hyperparameter, None for
+            no bound
+    starts = number of starting points
+    processes = number of processes running the starts at the same time,
+                None uses all cpus and 1 runs them one after the other
+    seed = seed of the random starting points
+    scale = spread in log of the starting points without bounds
+    maxiter = maximum number of iterations of each run
+
+        Returns
+    best = copy of the kernel with the best hyperparameters
+    runs = list with a dictionary for each start with the initial and
+            final hyperparameters ('start', 'pars'), the log likelihood,
+            the number of evaluations and iterations ('nfev', 'nit'), the
+            status ('success', 'message') and the wall time ('time')
+    """
+    points = starting_points(kern, starts, bounds, scale, seed)
+    log_bounds = _log_bounds(bounds, points.shape[1])
+    tasks = [(_copy.deepcopy(kern), x, y, yerr, start, log_bounds,
+              {'maxiter': maxiter}) for start in points]
+    if processes == 1 or starts == 1:
+        runs = [_run_start(task) for task in tasks]
+    else:
+        with _Pool(processes) as pool:
+            runs = pool.map(_run_start, tasks)
+
+    best = _copy.deepcopy(kern)
+    best.set_parameter_vector(max(runs, key=lambda run: run['log_like'])['pars'])
+    return best, runs
+
+
+##### END
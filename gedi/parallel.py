@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Process pool evaluation of the log likelihood, made for emcee ensembles.
+
+    The data (x, y, yerr) and the matrix of time differences are published
+once through multiprocessing.shared_memory (python >= 3.8), and the kernel
+is sent once to each worker when the pool starts, so each task only carries
+a vector of hyperparameters.
+"""
+import numpy as _np
+from multiprocessing import Pool as _Pool
+
+from gedi import calc as _calc
+from gedi import kernels as _kernels
+from gedi import rvfunction as _rvfunction
+
+#state of each worker process, filled by _init_worker()
+_worker = {}
+
+
+class PoolLikelihood(object):
+    """
+        Log likelihood evaluated on a pool of processes with the data in
+    shared memory. Calling it with a (B, P) array returns the B log
+    likelihoods, as emcee expects with vectorize=True:
+        with PoolLikelihood(kernel, x, y, yerr, processes=32) as loglike:
+            sampler = emcee.EnsembleSampler(nwalkers, ndim, loglike,
+                                            vectorize=True)
+
+        Parameters
+    kern = kernel in use, only its structure matters
+    x = range of values of the independent variable (usually time)
+    y = range of values of te dependent variable (the measurments)
+    yerr = error in the measurments
+    processes = number of worker processes, None uses all cpus
+    kepler = True to include a keplerian mean function, in which case each
+            parameter vector ends with [Period, rvAmplitude, ecc, w, t0]
+    precompute = True to also share the matrix of time differences,
+                computed only once, instead of each worker building it
+    """
+    def __init__(self, kern, x, y, yerr, processes=None, kepler=False,
+                 precompute=True):
+        self.kern = kern
+        self.kepler = kepler
+        self._pool, self._shm = None, []
+        SharedMemory = _shared_memory().SharedMemory
+        yerr = _np.broadcast_to(_np.asarray(yerr, dtype=float), _np.shape(x))
+        arrays = {'x': x, 'y': y, 'yerr': yerr}
+        #the time differences are not enough for non-stationary kernels
+        if precompute and _kernels.is_stationary(kern):
+            x = _np.asarray(x, dtype=float)
+            arrays['r'] = x[:, None] - x[None, :]
+
+        specs = {}
+        for key, value in arrays.items():
+            value = _np.ascontiguousarray(value, dtype=float)
+            shm = SharedMemory(create=True, size=max(value.nbytes, 1))
+            _np.ndarray(value.shape, dtype=float, buffer=shm.buf)[...] = value
+            self._shm.append(shm)
+            specs[key] = (shm.name, value.shape)
+        self._pool = _Pool(processes, initializer=_init_worker,
+                           initargs=(kern, specs, kepler))
+
+    def __call__(self, pars):
+        pars = _np.atleast_2d(pars)
+        return _np.array(self._pool.map(_worker_likelihood, list(pars)))
+
+    def close(self):
+        """ Stops the workers and frees the shared memory """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        for shm in self._shm:
+            shm.close()
+            shm.unlink()
+        self._shm = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        raise TypeError('PoolLikelihood cannot be sent to other processes')
+
+
+def _shared_memory():
+    """ multiprocessing.shared_memory, imported when first needed """
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        raise ImportError('PoolLikelihood needs multiprocessing.shared_memory '
+                          '(python >= 3.8)')
+    return shared_memory
+
+
+def _attach(name):
+    """ Attaches to a shared memory block created by the parent process """
+    try:
+        return _shared_memory().SharedMemory(name=name, track=False)
+    except TypeError:
+        #python < 3.13, workers share the resource tracker of the parent
+        #process, so registering the block again does nothing
+        return _shared_memory().SharedMemory(name=name)
+
+
+def _init_worker(kern, specs, kepler):
+    """ Runs once in each worker, attaching to the shared data """
+    _worker.clear()
+    _worker['kern'] = kern
+    _worker['kepler'] = kepler
+    _worker['shm'] = []
+    for key, (name, shape) in specs.items():
+        shm = _attach(name)
+        _worker['shm'].append(shm)
+        _worker[key] = _np.ndarray(shape, dtype=float, buffer=shm.buf)
+
+
+def _worker_likelihood(pars):
+    """ Log likelihood of one parameter vector inside a worker """
+    kern, x, y, yerr = [_worker[key] for key in ('kern', 'x', 'y', 'yerr')]
+    npars = kern.npars
+    if _worker['kepler']:
+        Pk, Krv, e, w, T = pars[npars:]
+        y = y - _rvfunction.kepler(P=Pk, K=Krv, e=e, w=w, T=T, t=x)[1]
+    kern.set_parameter_vector(pars[:npars], include_frozen=True)
+    if 'r' in _worker:
+        K = kern(_worker['r']) + yerr**2*_np.identity(len(x))
+    else:
+        K = _calc.build_matrix(kern, x, yerr)
+    try:
+        return _calc._log_likelihood(K, y)
+    except _np.linalg.LinAlgError:
+        return -_np.inf
+
+
+##### END
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Periodogram of the radial velocities with the correlated noise of a
+Gaussian process of fixed hyperparameters. The covariance matrix does not
+change with the trial frequency, only the mean does, so it is factorized
+once, K = L.L^T, and the data and the sinusoids of each frequency are
+whitened with L^-1 (one triangular solve with many right hand sides per
+chunk of frequencies). The amplitudes being linear, the best fit at each
+frequency is a small least squares problem, and the improvement of the
+fit over a constant is
+    delta_chi2 = chi2(constant) - chi2(constant + sinusoid)
+with chi2 = r^T.K^-1.r. With harmonics > 1 the sinusoids of 2f, 3f, ...
+are fitted as well, the first terms of the Fourier series of an eccentric
+keplerian orbit.
+"""
+import numpy as _np
+from scipy.linalg import cholesky as _cholesky
+from scipy.linalg import solve_triangular as _solve_triangular
+
+from gedi import calc as _calc
+from gedi import lags as _lags
+from gedi import profiling as _profiling
+
+
+def frequency_grid(x, fmin=None, fmax=None, oversample=5):
+    """
+        frequency_grid() returns evenly spaced frequencies
+
+        Parameters
+    x = range of values of the independent variable (usually time)
+    fmin = lowest frequency, 1/(time span) if None
+    fmax = highest frequency, half the inverse of the median time step if
+            None
+    oversample = number of frequencies within the width 1/(time span) of
+                a peak
+
+        Returns
+    frequencies = array of frequencies, in 1/(units of x)
+    """
+    x = _np.sort(_np.asarray(_lags.times(x), dtype=float))
+    span = x[-1] - x[0]
+    fmin = 1/span if fmin is None else fmin
+    fmax = 0.5/_np.median(_np.diff(x)) if fmax is None else fmax
+    return _np.arange(fmin, fmax, 1/(oversample*span))
+
+
+def stream(kern, x, y, yerr, frequencies, harmonics=1, chunk=500):
+    """
+        stream() calculates the periodogram a chunk of frequencies at a
+    time, after factorizing the covariance matrix once
+
+        Parameters
+    kern = kernel in use, its hyperparameters stay fixed
+    x = range of values of the independent variable (usually time)
+    y = range of values of te dependent variable (the measurments)
+    yerr = error in the measurments
+    frequencies = trial frequencies, in 1/(units of x), not 0
+    harmonics = number of harmonics of each frequency fitted together
+    chunk = number of frequencies in each chunk
+
+        Yields
+    frequencies = frequencies of the chunk
+    delta_chi2 = improvement of chi2 by the sinusoids, over a constant
+    log_like = marginal log likelihood of the best fit at each frequency
+    """
+    K = _calc.build_matrix(kern, x, yerr)
+    start = _profiling.tic()
+    L = _cholesky(K, lower=True)
+    _profiling.toc('cholesky', start)
+    del K
+    t = _np.asarray(_lags.times(x), dtype=float)
+    y = _np.asarray(y, dtype=float)
+    #whitened data and constant
+    z, one = _solve_triangular(L, _np.column_stack([y, _np.ones_like(y)]),
+                               lower=True).T
+    chi2_constant = _np.dot(z, z) - _np.dot(one, z)**2 / _np.dot(one, one)
+    log_norm = -_np.sum(_np.log(_np.diag(L))) - y.size*0.5*_np.log(2*_np.pi)
+
+    frequencies = _np.atleast_1d(_np.asarray(frequencies, dtype=float))
+    m = 1 + 2*harmonics
+    for begin in range(0, frequencies.size, chunk):
+        f = frequencies[begin:begin + chunk]
+        phase = 2*_np.pi*t[:, None, None]*f[None, :, None] \
+                * _np.arange(1, harmonics + 1)
+        basis = _np.concatenate([_np.cos(phase), _np.sin(phase)], axis=2)
+        start = _profiling.tic()
+        W = _solve_triangular(L, basis.reshape(t.size, -1), lower=True)
+        _profiling.toc('solve', start)
+        W = _np.concatenate([_np.broadcast_to(one[:, None, None],
+                                              (t.size, f.size, 1)),
+                             W.reshape(t.size, f.size, m - 1)], axis=2)
+        #normal equations of each frequency
+        G = _np.einsum('nfi,nfj->fij', W, W)
+        b = _np.einsum('nfi,n->fi', W, z)
+        fit = _np.einsum('fi,fi->f', b,
+                         _np.einsum('fij,fj->fi', _np.linalg.pinv(G), b))
+        chi2 = _np.dot(z, z) - fit
+        yield f, chi2_constant - chi2, log_norm - 0.5*chi2
+
+
+def periodogram(kern, x, y, yerr, frequencies, harmonics=1, chunk=500):
+    """
+        periodogram() calculates the periodogram on all the frequencies,
+    see stream()
+
+        Returns
+    delta_chi2 = improvement of chi2 by the sinusoids, over a constant
+    log_like = marginal log likelihood of the best fit at each frequency
+    """
+    chunks = list(stream(kern, x, y, yerr, frequencies, harmonics, chunk))
+    if not chunks:
+        return _np.zeros(0), _np.zeros(0)
+    return _np.concatenate([e[1] for e in chunks]), \
+           _np.concatenate([e[2] for e in chunks])
+
+
+##### END
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Opt-in timers and counters of the stages of the calculations (matrix
+builds, kernel evaluations of each class, factorizations, solves, gradient
+traces, keplerian). Nothing is recorded unless a Profile is active, and
+then only by the innermost one:
+    with calc.Profile() as profile:
+        calc.likelihood(kernel, x, y, yerr)
+    print(profile)
+    profile.save('profile.json')
+When no profile is active each instrumented stage only costs a check of a
+global variable, so the hooks can stay in production runs.
+"""
+import json as _json
+import time as _time
+
+#profile that records the stages, None when profiling is off
+_active = None
+
+
+class Profile(object):
+    """
+        Registry of the time spent in each stage of the calculations and of
+    counters (e.g. likelihood evaluations, Kepler iterations), active
+    inside a with block.
+    """
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        self._previous = None
+
+    def __enter__(self):
+        global _active
+        self._previous, _active = _active, self
+        return self
+
+    def __exit__(self, *args):
+        global _active
+        _active, self._previous = self._previous, None
+
+    def add_time(self, name, seconds):
+        """ Adds one call of the stage name, lasting seconds """
+        timer = self.timers.setdefault(name, [0, 0.])
+        timer[0] += 1
+        timer[1] += seconds
+
+    def count(self, name, n=1):
+        """ Adds n to the counter name """
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def reset(self):
+        """ Clears all timers and counters """
+        self.timers.clear()
+        self.counters.clear()
+
+    def report(self):
+        """
+            report() returns the timers and counters
+
+            Returns
+        report = dictionary with 'timers', {stage: {'calls', 'seconds'}},
+                and 'counters', {name: value}
+        """
+        return {'timers': dict((name, {'calls': calls, 'seconds': seconds})
+                               for name, (calls, seconds)
+                               in self.timers.items()),
+                'counters': dict((name, int(value)) for name, value
+                                 in self.counters.items())}
+
+    def save(self, path):
+        """ Writes report() to a JSON file """
+        with open(path, 'w') as f:
+            _json.dump(self.report(), f, indent=1)
+
+    def __str__(self):
+        lines = ['{0:32s} {1:>8s} {2:>12s}'.format('stage', 'calls',
+                                                   'seconds')]
+        for name, (calls, seconds) in sorted(self.timers.items(),
+                                             key=lambda e: -e[1][1]):
+            lines.append('{0:32s} {1:8d} {2:12.6f}'.format(name, calls,
+                                                           seconds))
+        for name, value in sorted(self.counters.items()):
+            lines.append('{0:32s} {1:8d}'.format(name, int(value)))
+        return '\n'.join(lines)
+
+
+def tic():
+    """ Start time of a stage, None when no profile is active """
+    if _active is None:
+        return None
+    return _time.perf_counter()
+
+
+def toc(name, start):
+    """ Adds the time since start to the stage name of the active profile """
+    if start is not None and _active is not None:
+        _active.add_time(name, _time.perf_counter() - start)
+
+
+def count(name, n=1):
+    """ Adds n to the counter name of the active profile """
+    if _active is not None:
+        _active.count(name, n)
+
+
+##### END
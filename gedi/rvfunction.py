@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
+import warnings as _warnings
+
 import  numpy as _np
 
+from gedi import profiling as _profiling
+
 ##### RV functions #####
 def circular(P=365, K=0.1, T=0, gamma=0, t=None):
     """
@@ -51,33 +55,171 @@ def kepler(P=365, K=.1, e=0,  w=_np.pi, T=0, phi=None, gamma=0, t=None):
     	print('Time needed')
 
     #mean anomaly
-    if phi is None:
-        mean_anom = [2*_np.pi*(x1-T)/P  for x1 in t]
-    else:
+    if phi is not None:
         T = t[0] - (P*phi)/(2.*_np.pi)
-        mean_anom = [2*_np.pi*(x1-T)/P  for x1 in t]
-
-    #eccentric anomaly -> E0=M + e*sin(M) + 0.5*(e**2)*sin(2*M)
-    E0 = [x + e*_np.sin(x)  + 0.5*(e**2)*_np.sin(2*x) for x in mean_anom]
-    #mean anomaly -> M0=E0 - e*sin(E0)
-    M0 = [x - e*_np.sin(x) for x in E0]
-
-    i = 0
-    while i < 1000:
-        #[x + y for x, y in zip(first, second)]
-        calc_aux = [x2-y for x2,y in zip(mean_anom, M0)]    
-        E1 = [x3 + y/(1-e*_np.cos(x3)) for x3,y in zip(E0, calc_aux)]
-        M1 = [x4 - e*_np.sin(x4) for x4 in E0]   
-        i += 1
-        E0 = E1
-        M0 = M1
-
-    nu = [2*_np.arctan(_np.sqrt((1+e)/(1-e))*_np.tan(x5/2)) for x5 in E0]
-    RV = [ gamma + K*(e*_np.cos(w)+_np.cos(w+x6)) for x6 in nu]
-    RV = [x for x in RV] #m/s 
+    mean_anom = 2*_np.pi*(_np.asarray(t, dtype=float) - T)/P
+
+    E, _ = eccentric_anomaly(mean_anom, e)
+    nu = true_anomaly(E, e)
+    RV = gamma + K*(e*_np.cos(w) + _np.cos(w + nu)) #m/s
     return t, RV
 
 
+def eccentric_anomaly(M, e, tol=1e-12, maxiter=100):
+    """
+        eccentric_anomaly() solves Kepler's equation M = E - e*sin(E) with 
+    Newton's method, vectorized over M and stopping separately for each 
+    element once its correction is below tol.
+
+        Parameters:
+    M = mean anomaly, float or array
+    e = eccentricity, float or array broadcasting with M
+    tol = tolerance in the eccentric anomaly
+    maxiter = maximum number of iterations
+
+        Returns:
+    E = eccentric anomaly, in [0, 2*pi), with the shape of M (a RuntimeWarning
+        is issued for the values not converged after maxiter iterations)
+    niter = number of iterations each element needed
+    """
+    M = _np.mod(_np.asarray(M, dtype=float), 2*_np.pi)
+    shape = _np.broadcast(M, e).shape
+    M = _np.atleast_1d(_np.broadcast_to(M, shape))
+    niter = _np.zeros(M.shape, dtype=int)
+    if not _np.any(e):
+        return M.reshape(shape), niter.reshape(shape)
+    e = _np.atleast_1d(_np.broadcast_to(e, shape))
+
+    #starting point that converges for all eccentricities (Danby 1987)
+    E = M + 0.85*e*_np.where(_np.sin(M) < 0, -1., 1.)
+    active = _np.ones(M.shape, dtype=bool)
+    sweeps = 0
+    while active.any() and sweeps < maxiter:
+        Ea, ea = E[active], e[active]
+        dE = (Ea - ea*_np.sin(Ea) - M[active]) / (1 - ea*_np.cos(Ea))
+        E[active] = Ea - dE
+        niter[active] += 1
+        active[active] = _np.abs(dE) > tol
+        sweeps += 1
+    _profiling.count('kepler_solves')
+    _profiling.count('kepler_iterations', sweeps)
+    if active.any():
+        _warnings.warn('eccentric_anomaly: {0} values did not converge in '
+                       '{1} iterations'.format(active.sum(), maxiter),
+                       RuntimeWarning)
+    return E.reshape(shape), niter.reshape(shape)
+
+
+def true_anomaly(E, e):
+    """
+        true_anomaly() calculates the true anomaly from the eccentric anomaly
+
+        Parameters:
+    E = eccentric anomaly
+    e = eccentricity
+
+        Returns:
+    nu = true anomaly
+    """
+    return 2*_np.arctan2(_np.sqrt(1+e)*_np.sin(E/2), _np.sqrt(1-e)*_np.cos(E/2))
+
+
+##### Multi-planet keplerian #####
+class Keplerian(object):
+    """
+        Radial velocity of several planets in keplerian orbits, the mean
+    function of a joint GP and orbits fit, evaluated on fixed times with
+    all the planets at once.
+
+        The eccentric and true anomalies and their sines and cosines only
+    depend on P, e and T, they are kept for each planet and Kepler's
+    equation is only solved again for the planets whose P, e or T changed.
+
+        Parameters
+    t = time of measurements
+    planets = array (k, 5) with [P, K, e, w, T] of each planet, as in
+            kepler(), or a flat list with 5*k values
+    gamma = constant system RV
+    """
+    def __init__(self, t, planets, gamma=0.):
+        self.t = _np.asarray(t, dtype=float)
+        self.planets = _np.zeros((len(_np.ravel(planets)) // 5, 5))
+        self._orbit_pars = _np.full((self.planets.shape[0], 3), _np.nan)
+        shape = (self.planets.shape[0], self.t.size)
+        self._M, self._E, self._nu = [_np.empty(shape) for i in range(3)]
+        self.set_parameter_vector(_np.append(_np.ravel(planets), gamma))
+
+    def __repr__(self):
+        return "Keplerian({0} planets, gamma={1})".format(
+            self.planets.shape[0], self.gamma)
+
+    def get_parameter_vector(self):
+        """ Returns [P, K, e, w, T] of each planet followed by gamma """
+        return _np.append(self.planets.ravel(), self.gamma)
+
+    def set_parameter_vector(self, vector):
+        """ Updates [P, K, e, w, T] of each planet and gamma, in place """
+        vector = _np.asarray(vector, dtype=float)
+        if vector.size != self.planets.size + 1:
+            raise ValueError('Keplerian: expected {0} parameters, got '
+                             '{1}'.format(self.planets.size + 1, vector.size))
+        planets = vector[:-1].reshape(self.planets.shape)
+        if _np.any((planets[:, 2] < 0) | (planets[:, 2] >= 1)):
+            raise ValueError('Keplerian: eccentricities must be in [0, 1)')
+        self.planets[...] = planets
+        self.gamma = vector[-1]
+
+    def _update(self):
+        """ Solves Kepler's equation for the planets whose P, e or T changed """
+        orbit_pars = self.planets[:, [0, 2, 4]]
+        stale = _np.any(orbit_pars != self._orbit_pars, axis=1)
+        if not stale.any():
+            return
+        P, e, T = [e[:, None] for e in orbit_pars[stale].T]
+        self._M[stale] = 2*_np.pi*(self.t - T)/P
+        self._E[stale] = eccentric_anomaly(self._M[stale], e)[0]
+        self._nu[stale] = true_anomaly(self._E[stale], e)
+        self._orbit_pars[stale] = orbit_pars[stale]
+
+    def planet_rv(self):
+        """ Returns the array (k, N) with the radial velocity of each planet """
+        self._update()
+        K, e, w = [e[:, None] for e in self.planets[:, 1:4].T]
+        return K*(e*_np.cos(w) + _np.cos(w + self._nu))
+
+    def rv(self):
+        """ Returns the radial velocity of the star, gamma included """
+        return self.gamma + _np.sum(self.planet_rv(), axis=0)
+
+    def gradient(self):
+        """
+            gradient() calculates the derivatives of rv() in order to each
+        parameter
+
+            Returns
+        grad = array (5*k + 1, N) in the order of get_parameter_vector()
+        """
+        self._update()
+        P, K, e, w, T = [e[:, None] for e in self.planets.T]
+        sinE, cosE = _np.sin(self._E), _np.cos(self._E)
+        wnu = w + self._nu
+        root = _np.sqrt(1 - e**2)
+        denom = 1 - e*cosE
+        #derivatives of the true anomaly, M = 2*pi*(t - T)/P
+        dnu_dM = root / denom**2
+        dnu_de = sinE/(denom*root) + root*sinE/denom**2
+        drv_dnu = -K*_np.sin(wnu)
+
+        grad = _np.empty((self.planets.shape[0], 5, self.t.size))
+        grad[:, 0] = drv_dnu * dnu_dM * (-self._M/P)
+        grad[:, 1] = e*_np.cos(w) + _np.cos(wnu)
+        grad[:, 2] = K*_np.cos(w) + drv_dnu*dnu_de
+        grad[:, 3] = -K*(e*_np.sin(w) + _np.sin(wnu))
+        grad[:, 4] = drv_dnu * dnu_dM * (-2*_np.pi/P)
+        return _np.concatenate([grad.reshape(-1, self.t.size),
+                                _np.ones((1, self.t.size))])
+
+
 ##### Semi amplitude calculation #####
 def semi_amplitude(period, Mplanet, Mstar, ecc):
     """
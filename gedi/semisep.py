@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Semiseparable ("celerite-style") representation of the kernels, allowing
+the log likelihood to be computed in O(N*J**2) operations, with J the number
+of semiseparable terms, instead of the O(N**3) of the dense calc.likelihood().
+
+    Each term has the form
+        k(r) = exp(-c*|r|) * (a*cos(d*|r|) + b*sin(d*|r|))
+and the kernels are represented as sums of these terms:
+    Exponential -> one exact term
+    Matern32 -> one term, approximate in the limit d = eps*c -> 0
+    ExpSineSquared -> Fourier-Bessel series truncated to nharm harmonics
+    ExpSquared -> cosine series, accurate to tol on the time span of the data
+    QuasiPeriodic -> ExpSineSquared series times the ExpSquared series
+    WhiteNoise -> goes to the diagonal
+    Sum and Product of the above are also supported.
+
+    The ExpSquared envelope has no exact representation with these terms.
+It is replaced by the Fourier series of its periodic extension with a
+period 2*T long enough for the copies to be below tol on |r| <= span, so the
+kernel values differ from the exact ones by less than ~2*tol*amplitude over
+the span of the data, and the log likelihood agrees with the dense one to
+~1e-6 relative for the default tol = 1e-8 (fits of the exponentials with a
+few terms leave errors of ~0.01 in the kernel, which shift the log
+likelihood by hundreds for well sampled data). The series needs about
+span/l + 6 terms for tol = 1e-8, times the number of harmonics of the
+periodic part for QuasiPeriodic, so for long time spans the J**2 of the
+semiseparable solver can exceed the N**2 of the dense one.
+"""
+import numpy as _np
+from scipy.special import ive as _ive
+
+from gedi import kernels as _kernels
+
+
+def kernel_terms(kern, nharm=None, eps=0.01, tol=1e-8, span=None):
+    """
+        kernel_terms() decomposes a kernel into semiseparable terms
+
+        Parameters
+    kern = kernel in use
+    nharm = number of harmonics used in periodic kernels, if None it is
+            chosen so that the neglected weight is below tol
+    eps = d/c ratio used to approximate the Matern 3/2 kernel
+    tol = relative tolerance of the periodic and ExpSquared series, used to
+        choose nharm and the number of terms of the envelope
+    span = largest time difference where the ExpSquared series needs to be
+            accurate, max(x) - min(x), needed by ExpSquared and QuasiPeriodic
+
+        Returns
+    coeffs = array (J, 4) with the a, b, c, d coefficients of each term
+    white = value to add to the diagonal of the covariance matrix
+    """
+    if isinstance(kern, _kernels.Exponential):
+        return _np.array([[kern.Exp_theta**2, 0., 1./kern.Exp_l, 0.]]), 0.
+
+    elif isinstance(kern, _kernels.Matern32):
+        return _matern32_terms(kern.M32_theta**2, _np.sqrt(3.0)/kern.M32_l,
+                               eps), 0.
+
+    elif isinstance(kern, _kernels.ExpSineSquared):
+        return _periodic_terms(kern.ESS_theta**2, kern.ESS_l, kern.ESS_P,
+                               nharm, tol), 0.
+
+    elif isinstance(kern, _kernels.ExpSquared):
+        return _expsquared_terms(kern.ES_theta**2, kern.ES_l, span, tol), 0.
+
+    elif isinstance(kern, _kernels.QuasiPeriodic):
+        periodic = _periodic_terms(kern.QP_theta**2, kern.QP_l1, kern.QP_P,
+                                   nharm, tol)
+        envelope = _expsquared_terms(1., kern.QP_l2, span, tol)
+        return _product_terms(periodic, envelope), 0.
+
+    elif isinstance(kern, _kernels.WhiteNoise):
+        return _np.zeros((0, 4)), kern.WN_theta**2
+
+    elif isinstance(kern, _kernels.Sum):
+        coeffs1, white1 = kernel_terms(kern.k1, nharm, eps, tol, span)
+        coeffs2, white2 = kernel_terms(kern.k2, nharm, eps, tol, span)
+        return _np.vstack([coeffs1, coeffs2]), white1 + white2
+
+    elif isinstance(kern, _kernels.Product):
+        coeffs1, white1 = kernel_terms(kern.k1, nharm, eps, tol, span)
+        coeffs2, white2 = kernel_terms(kern.k2, nharm, eps, tol, span)
+        #(k1 + w1*delta)(k2 + w2*delta), with k(0) = sum(a)
+        white = white1 * _np.sum(coeffs2[:, 0]) \
+                + white2 * _np.sum(coeffs1[:, 0]) + white1 * white2
+        return _product_terms(coeffs1, coeffs2), white
+
+    else:
+        raise ValueError('kernel_terms: {0} has no semiseparable '
+                         'representation'.format(kern.__class__.__name__))
+
+
+def _matern32_terms(amp, c, eps):
+    """ Matern 3/2 as the d = eps*c -> 0 limit of a complex term """
+    return _np.array([[amp, amp/eps, c, eps*c]])
+
+
+def _expsquared_terms(amp, l, span, tol):
+    """
+        Cosine series of the exponential squared kernel, the Fourier series
+    of sum_m exp(-0.5*(r + 2*m*T)**2/l**2), which differs from the kernel by
+    less than tol*amp for |r| <= span
+    """
+    if span is None:
+        raise ValueError('kernel_terms: the ExpSquared series needs the time '
+                         'span of the data')
+    width = _np.sqrt(2*_np.log(1./tol))
+    T = 0.5*(span + width*l)
+    step = _np.pi / T
+    n = _np.arange(int(_np.ceil(width / (l*step))) + 1)
+    coeffs = _np.zeros((n.size, 4))
+    coeffs[:, 0] = amp * l*_np.sqrt(2*_np.pi)/(2*T) * _np.where(n == 0, 1., 2.) \
+                   * _np.exp(-0.5*(n*step*l)**2)
+    coeffs[:, 3] = n * step
+    return coeffs
+
+
+def _periodic_terms(amp, l, P, nharm, tol):
+    """
+        Fourier-Bessel series of the exponential sine squared kernel
+    exp(-2*sin(pi*r/P)**2/l**2) = sum_n w_n*ive(n, 1/l**2)*cos(2*pi*n*r/P)
+    """
+    z = 1. / l**2
+    if nharm is None:
+        nharm = 0
+        while 2*_ive(nharm + 1, z) > tol and nharm < 100:
+            nharm += 1
+    n = _np.arange(nharm + 1)
+    weights = _np.where(n == 0, 1., 2.) * _ive(n, z)
+    coeffs = _np.zeros((nharm + 1, 4))
+    coeffs[:, 0] = amp * weights
+    coeffs[:, 3] = 2 * _np.pi * n / P
+    return coeffs
+
+
+def _product_terms(coeffs1, coeffs2):
+    """ Product of two sets of terms, it is again a set of terms """
+    a1, b1, c1, d1 = [e[:, None] for e in coeffs1.T]
+    a2, b2, c2, d2 = [e[None, :] for e in coeffs2.T]
+    c = (c1 + c2).ravel()
+    #frequency d1+d2
+    plus = _np.column_stack([(0.5*(a1*a2 - b1*b2)).ravel(),
+                             (0.5*(a1*b2 + b1*a2)).ravel(),
+                             c, (d1 + d2).ravel()])
+    #frequency d1-d2, made positive with sin(-x) = -sin(x)
+    dminus = (d1 - d2).ravel()
+    sign = _np.where(dminus < 0, -1., 1.)
+    minus = _np.column_stack([(0.5*(a1*a2 + b1*b2)).ravel(),
+                              sign * (0.5*(b1*a2 - a1*b2)).ravel(),
+                              c, _np.abs(dminus)])
+    return _np.vstack([plus, minus])
+
+
+def factor(x, diag, coeffs):
+    """
+        factor() computes the semiseparable Cholesky-like factorization
+    K = L.D.L^T of the covariance matrix
+
+        Parameters
+    x = sorted range of values of the independent variable (usually time)
+    diag = diagonal of the covariance matrix
+    coeffs = terms of the kernel, see kernel_terms()
+
+        Returns
+    factorization = (P, U, W, D) tuple to use in solve() and log_determinant()
+    """
+    x = _np.asarray(x, dtype=float)
+    if _np.any(_np.diff(x) < 0):
+        raise ValueError('factor: x needs to be sorted')
+    a, b, c, d = coeffs.T
+    real = d == 0
+    cos = _np.cos(d[None, ~real] * x[:, None])
+    sin = _np.sin(d[None, ~real] * x[:, None])
+    ac, bc = a[~real], b[~real]
+
+    U = _np.hstack([_np.broadcast_to(a[real], (x.size, real.sum())),
+                    ac*cos + bc*sin, ac*sin - bc*cos])
+    V = _np.hstack([_np.ones((x.size, real.sum())), cos, sin])
+    c = _np.concatenate([c[real], c[~real], c[~real]])
+    P = _np.exp(-c[None, :] * _np.diff(x)[:, None])
+
+    D = _np.array(diag, dtype=float)
+    W = V.copy()
+    S = _np.zeros((c.size, c.size))
+    if D[0] <= 0:
+        raise _np.linalg.LinAlgError('factor: matrix not positive definite')
+    W[0] /= D[0]
+    for n in range(1, x.size):
+        S = P[n-1][:, None] * (S + D[n-1]*_np.outer(W[n-1], W[n-1])) \
+            * P[n-1][None, :]
+        tmp = _np.dot(U[n], S)
+        W[n] -= tmp
+        D[n] -= _np.dot(tmp, U[n])
+        if D[n] <= 0:
+            raise _np.linalg.LinAlgError('factor: matrix not positive definite')
+        W[n] /= D[n]
+    return P, U, W, D
+
+
+def solve(factorization, y):
+    """
+        solve() solves K.sol = y using the semiseparable factorization
+
+        Parameters
+    factorization = result of factor()
+    y = right hand side, shape (N,) or (N, k)
+
+        Returns
+    sol = solution of the linear system
+    """
+    P, U, W, D = factorization
+    Z = _np.array(y, dtype=float)
+    extra = (1,) * (Z.ndim - 1)
+    F = _np.zeros((U.shape[1],) + Z.shape[1:])
+    for n in range(1, Z.shape[0]):
+        F = P[n-1].reshape((-1,) + extra) \
+            * (F + _np.multiply.outer(W[n-1], Z[n-1]))
+        Z[n] -= _np.dot(U[n], F)
+    Z /= D.reshape((-1,) + extra)
+    F = _np.zeros((U.shape[1],) + Z.shape[1:])
+    for n in range(Z.shape[0] - 2, -1, -1):
+        F = P[n].reshape((-1,) + extra) \
+            * (F + _np.multiply.outer(U[n+1], Z[n+1]))
+        Z[n] -= _np.dot(W[n], F)
+    return Z
+
+
+def log_determinant(factorization):
+    """
+        log_determinant() returns log(det(K)) of a factorized matrix
+
+        Parameters
+    factorization = result of factor()
+
+        Returns
+    log_det = logarithm of the determinant
+    """
+    return _np.sum(_np.log(factorization[3]))
+
+
+def likelihood(kern, x, y, yerr, nharm=None, eps=0.01, tol=1e-8):
+    """
+        likelihood() calculates the marginal log likelihood with the
+    semiseparable solver, the equivalent of calc.likelihood()
+
+        Parameters
+    kern = kernel in use
+    x = range of values of the independent variable (usually time)
+    y = range of values of te dependent variable (the measurments)
+    yerr = error in the measurments
+    nharm = number of harmonics of the periodic kernels, see kernel_terms()
+    eps = parameter of the Matern 3/2 approximation, see kernel_terms()
+    tol = tolerance of the periodic and ExpSquared series, see kernel_terms()
+
+        Returns
+    log_like = marginal log likelihood
+    """
+    x = _np.asarray(x, dtype=float)
+    order = _np.argsort(x, kind='mergesort')
+    x = x[order]
+    y = _np.asarray(y, dtype=float)[order]
+    yerr = _np.broadcast_to(_np.asarray(yerr, dtype=float),
+                            order.shape)[order]
+
+    coeffs, white = kernel_terms(kern, nharm, eps, tol, x[-1] - x[0])
+    diag = yerr**2 + white + _np.sum(coeffs[:, 0])
+    factorization = factor(x, diag, coeffs)
+    sol = solve(factorization, y)
+    n = y.size
+    log_like = -0.5*_np.dot(y, sol) \
+              - 0.5*log_determinant(factorization) \
+              - n*0.5*_np.log(2*_np.pi)
+    return log_like
+
+
+##### END
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Sparse approximation of the Gaussian process with M inducing points xu
+placed on the time axis, for data sets too large for the dense matrices of
+calc.likelihood(). The covariance matrix is replaced by
+    Qff + Lambda,  Qff = Kfu.Kuu^-1.Kuf
+with Lambda diagonal:
+    'fitc' -> Lambda = yerr**2 + diag(Kff - Qff)
+    'vfe'  -> Lambda = yerr**2, plus the trace term -0.5*tr(Kff - Qff)/yerr**2
+                of the variational bound (Titsias 2009)
+and the log likelihood, its gradient and the predictions cost O(N*M**2)
+time and O(N*M) memory. A WhiteNoise term of the kernel goes to Lambda.
+The diagonal of Kff is evaluated once for stationary kernels and a few
+points at a time for the others (Linear), whose prior variance changes
+with x.
+"""
+import numpy as _np
+from scipy.linalg import cholesky as _cholesky
+from scipy.linalg import solve_triangular as _solve_triangular
+
+from gedi import kernels as _kernels
+from gedi import lags as _lags
+
+
+def inducing_points(x, M, method='quantile'):
+    """
+        inducing_points() places the inducing points on the time axis
+
+        Parameters
+    x = range of values of the independent variable (usually time)
+    M = number of inducing points
+    method = 'quantile' to follow the density of the observations, which
+            leaves no inducing points in the gaps between seasons, or
+            'uniform' to spread them evenly between min(x) and max(x)
+
+        Returns
+    xu = times of the inducing points
+    """
+    x = _np.sort(_np.asarray(x, dtype=float))
+    if method == 'quantile':
+        return _np.unique(_np.interp(_np.linspace(0, 1, M),
+                                     _np.linspace(0, 1, x.size), x))
+    elif method == 'uniform':
+        return _np.linspace(x[0], x[-1], M)
+    else:
+        raise ValueError('inducing_points: unknown method {0}'.format(method))
+
+
+def _diagonal(kern, x, derivatives=False, chunk=256):
+    """
+        _diagonal() evaluates the prior variance of each point, without
+    WhiteNoise, once for stationary kernels and otherwise a few points at a
+    time, O(N*chunk) operations
+
+        Returns
+    kd = array (N,) with the prior variances
+    (and the array (P, N) of their derivatives, if derivatives is True)
+    """
+    if _kernels.is_stationary(kern):
+        points = [_np.zeros(1)]
+    else:
+        points = [x[start:start + chunk] for start in range(0, x.size, chunk)]
+    values, gradients = [], []
+    for p in points:
+        r = _lags.Lags(p, other=p)
+        if derivatives:
+            K, dK = kern.value_and_derivatives(r)
+            gradients.append(_np.diagonal(dK, axis1=1, axis2=2))
+        else:
+            K = kern(r)
+        values.append(_np.diag(K))
+    kd = _np.broadcast_to(_np.concatenate(values), x.shape)
+    if derivatives:
+        dkd = _np.concatenate(gradients, axis=1)
+        return kd, _np.broadcast_to(dkd, (dkd.shape[0],) + x.shape)
+    return kd
+
+
+def _kernel_terms(kern, x, xu, jitter, derivatives=False):
+    """
+        _kernel_terms() evaluates the kernel on the inducing points, the
+    cross covariance and the prior variance of each point, with or without
+    the derivatives
+
+        Returns
+    k0 = prior variances, WhiteNoise included
+    kd = prior variances, without WhiteNoise
+    Kuu, Kuf = kernel matrices of the inducing points
+    (and the derivatives of each of them, if derivatives is True)
+    """
+    #WhiteNoise only enters the kernel of a point with itself
+    zero = _np.zeros(1)
+    lags = [_lags.Lags(zero), _lags.Lags(zero, other=zero),
+            _lags.Lags(xu, other=xu), _lags.Lags(xu, other=x)]
+    diagonal = _np.arange(xu.size)
+    if derivatives:
+        (w0, dw0), (wd, dwd), (Kuu, dKuu), (Kuf, dKuf) = \
+            [kern.value_and_derivatives(r) for r in lags]
+        kd, dkd = _diagonal(kern, x, derivatives=True)
+        k0 = kd + (w0[0, 0] - wd[0, 0])
+        dk0 = dkd + (dw0[:, 0, :] - dwd[:, 0, :])
+        Kuu[diagonal, diagonal] *= 1 + jitter
+        dKuu[:, diagonal, diagonal] *= 1 + jitter
+        return k0, kd, Kuu, Kuf, dk0, dkd, dKuu, dKuf
+    w0, wd, Kuu, Kuf = [kern(r) for r in lags]
+    kd = _diagonal(kern, x)
+    k0 = kd + (w0[0, 0] - wd[0, 0])
+    Kuu[diagonal, diagonal] *= 1 + jitter
+    return k0, kd, Kuu, Kuf
+
+
+def _factor(k0, kd, Kuu, Kuf, y, yerr, method):
+    """ Factorization shared by the likelihood, gradient and predictions """
+    if method not in ('fitc', 'vfe'):
+        raise ValueError('unknown sparse method {0}'.format(method))
+    Luu = _cholesky(Kuu, lower=True)
+    V = _solve_triangular(Luu, Kuf, lower=True)
+    Qd = _np.sum(V**2, axis=0)
+    if method == 'fitc':
+        Lam = yerr**2 + k0 - Qd
+    else:
+        Lam = yerr**2 + (k0 - kd)
+    Vl = V / Lam
+    LA = _cholesky(_np.identity(V.shape[0]) + _np.dot(Vl, V.T), lower=True)
+    c = _solve_triangular(LA, _np.dot(Vl, y), lower=True)
+    return Luu, V, Qd, Lam, LA, c
+
+
+def likelihood(kern, x, y, yerr, xu, method='vfe', jitter=1e-8):
+    """
+        likelihood() calculates the sparse approximation of the marginal
+    log likelihood, the equivalent of calc.likelihood()
+
+        Parameters
+    kern = kernel in use
+    x = range of values of the independent variable (usually time)
+    y = range of values of te dependent variable (the measurments)
+    yerr = error in the measurments
+    xu = times of the inducing points, see inducing_points()
+    method = 'vfe' or 'fitc'
+    jitter = added to the diagonal of Kuu, relative to the kernel variance
+
+        Returns
+    log_like = approximate marginal log likelihood
+    """
+    x, y, xu = [_np.asarray(e, dtype=float) for e in (x, y, xu)]
+    yerr = _np.broadcast_to(_np.asarray(yerr, dtype=float), x.shape)
+    k0, kd, Kuu, Kuf = _kernel_terms(kern, x, xu, jitter)
+    Luu, V, Qd, Lam, LA, c = _factor(k0, kd, Kuu, Kuf, y, yerr, method)
+    log_like = -0.5*(_np.sum(y**2 / Lam) - _np.dot(c, c)) \
+               - 0.5*_np.sum(_np.log(Lam)) \
+               - _np.sum(_np.log(_np.diag(LA))) \
+               - y.size*0.5*_np.log(2*_np.pi)
+    if method == 'vfe':
+        log_like -= 0.5*_np.sum((kd - Qd) / Lam)
+    return log_like
+
+
+def likelihood_gradient(kern, x, y, yerr, xu, method='vfe', jitter=1e-8):
+    """
+        likelihood_gradient() calculates the sparse approximation of the
+    marginal log likelihood and its gradient in order to the
+    log(parameters), the equivalent of calc.likelihood_gradient()
+
+        Parameters
+    kern = kernel in use
+    x = range of values of the independent variable (usually time)
+    y = range of values of te dependent variable (the measurments)
+    yerr = error in the measurments
+    xu = times of the inducing points, they are kept fixed
+    method = 'vfe' or 'fitc'
+    jitter = added to the diagonal of Kuu, relative to the kernel variance
+
+        Returns
+    log_like = approximate marginal log likelihood
+    grad = array with the derivatives in the same order as kern.pars
+    """
+    x, y, xu = [_np.asarray(e, dtype=float) for e in (x, y, xu)]
+    yerr = _np.broadcast_to(_np.asarray(yerr, dtype=float), x.shape)
+    k0, kd, Kuu, Kuf, dk0, dkd, dKuu, dKuf = \
+        _kernel_terms(kern, x, xu, jitter, derivatives=True)
+    Luu, V, Qd, Lam, LA, c = _factor(k0, kd, Kuu, Kuf, y, yerr, method)
+    log_like = -0.5*(_np.sum(y**2 / Lam) - _np.dot(c, c)) \
+               - 0.5*_np.sum(_np.log(Lam)) \
+               - _np.sum(_np.log(_np.diag(LA))) \
+               - y.size*0.5*_np.log(2*_np.pi)
+
+    #Sigma = Qff + Lambda, alpha = Sigma^-1.y, B = Kuu^-1.Kuf
+    beta = _solve_triangular(LA, c, lower=True, trans='T')
+    alpha = (y - _np.dot(beta, V)) / Lam
+    B = _solve_triangular(Luu, V, lower=True, trans='T')
+    E = _solve_triangular(LA, V / Lam, lower=True)
+    #G = B.(alpha.alpha^T - Sigma^-1), without building N x N matrices
+    BSinv = B / Lam - _np.dot(_solve_triangular(LA, _np.dot(B / Lam, V.T).T,
+                                                lower=True).T, E)
+    G = _np.outer(_np.dot(B, alpha), alpha) - BSinv
+    GB = _np.dot(G, B.T)
+    wdiag = alpha**2 - (1 / Lam - _np.sum(E**2, axis=0))
+
+    grad = _np.empty(dk0.shape[0])
+    for i in range(dk0.shape[0]):
+        trace = 2*_np.sum(G * dKuf[i]) - _np.sum(GB * dKuu[i])
+        dQd = 2*_np.sum(dKuf[i] * B, axis=0) \
+              - _np.sum(B * _np.dot(dKuu[i], B), axis=0)
+        if method == 'fitc':
+            dLam = dk0[i] - dQd
+        else:
+            dLam = (dk0[i] - dkd[i]) * _np.ones_like(Lam)
+        grad[i] = 0.5*(trace + _np.dot(wdiag, dLam))
+        if method == 'vfe':
+            grad[i] += -0.5*_np.sum((dkd[i] - dQd) / Lam) \
+                       + 0.5*_np.sum((kd - Qd) / Lam**2 * dLam)
+    if method == 'vfe':
+        log_like -= 0.5*_np.sum((kd - Qd) / Lam)
+    return log_like, grad
+
+
+def predict(kern, x, new_x, y, yerr, xu, method='vfe', jitter=1e-8,
+            chunk=1000):
+    """
+        predict() calculates the predictive mean and standard deviation of
+    the sparse approximation, the equivalent of calc.compute_kernel()
+
+        Parameters
+    kern = kernel in use
+    x = range of values of the independent variable (usually time)
+    new_x = values where to predict
+    y = range of values of te dependent variable (the measurments)
+    yerr = error in the measurments
+    xu = times of the inducing points
+    method = 'vfe' or 'fitc'
+    jitter = added to the diagonal of Kuu, relative to the kernel variance
+    chunk = number of new points processed at a time
+
+        Returns
+    y_mean, y_std = mean and standard deviation
+    """
+    x, y, xu = [_np.asarray(e, dtype=float) for e in (x, y, xu)]
+    new_x = _np.asarray(new_x, dtype=float)
+    yerr = _np.broadcast_to(_np.asarray(yerr, dtype=float), x.shape)
+    k0, kd, Kuu, Kuf = _kernel_terms(kern, x, xu, jitter)
+    Luu, V, Qd, Lam, LA, c = _factor(k0, kd, Kuu, Kuf, y, yerr, method)
+    beta = _solve_triangular(LA, c, lower=True, trans='T')
+
+    y_mean = _np.empty(new_x.size)
+    y_var = _np.empty(new_x.size)
+    for start in range(0, new_x.size, chunk):
+        part = slice(start, start + chunk)
+        Ws = _solve_triangular(Luu, kern(_lags.Lags(xu, other=new_x[part])),
+                               lower=True)
+        y_mean[part] = _np.dot(beta, Ws)
+        y_var[part] = _diagonal(kern, new_x[part]) - _np.sum(Ws**2, axis=0) \
+                      + _np.sum(_solve_triangular(LA, Ws, lower=True)**2,
+                                axis=0)
+    return y_mean, _np.sqrt(_np.maximum(y_var, 0))
+
+
+##### END
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Out of core log likelihood for exact answers with more points than fit
+in memory. The lower triangle of the covariance matrix is built tile by
+tile into a numpy.memmap on disk and factorized in place with a blocked
+right looking Cholesky algorithm: for each column k of tiles
+    L_kk = cholesky(A_kk)
+    L_ik = A_ik.L_kk^-T                  for i > k
+    A_ij = A_ij - L_ik.L_jk^T            for i >= j > k
+so at most four tiles of size tile x tile are in memory at a time (the
+page cache of the operating system keeps more when there is room). The
+tiles are stored one after the other, only those of the lower triangle,
+so the file takes about 4*N**2 bytes, 40 GB for N = 100000. The last tile
+is padded with the identity, which changes neither the factorization nor
+the log determinant. The cost is the N**3/3 flops of the dense Cholesky,
+plus reading and writing each tile O(N/tile) times.
+"""
+import os as _os
+import tempfile as _tempfile
+
+import numpy as _np
+from scipy.linalg import cholesky as _cholesky
+from scipy.linalg import solve_triangular as _solve_triangular
+
+from gedi import lags as _lags
+from gedi import profiling as _profiling
+
+
+def _index(i, j):
+    """ Position in the file of the tile (i, j) of the lower triangle """
+    return i*(i + 1)//2 + j
+
+
+def build_tiles(kern, x, yerr, filename, tile=2048):
+    """
+        build_tiles() writes the lower triangle of the covariance matrix to
+    disk, tile by tile
+
+        Parameters
+    kern = kernel in use
+    x = range of values of the independent variable (usually time)
+    yerr = error in the measurments
+    filename = file of the numpy.memmap
+    tile = size of the tiles
+
+        Returns
+    A = numpy.memmap of shape (number of tiles, tile, tile), with the tile
+        (i, j), j <= i, of the matrix at A[i*(i+1)//2 + j]
+    """
+    start = _profiling.tic()
+    x = _np.asarray(x, dtype=float)
+    yerr = _np.broadcast_to(_np.asarray(yerr, dtype=float), x.shape)
+    n = -(-x.size // tile)
+    A = _np.memmap(filename, dtype=_np.float64, mode='w+',
+                   shape=(n*(n + 1)//2, tile, tile))
+    parts = [slice(i*tile, min((i + 1)*tile, x.size)) for i in range(n)]
+    for i, rows in enumerate(parts):
+        for j, cols in enumerate(parts[:i + 1]):
+            block = A[_index(i, j)]
+            if i == j:
+                #WhiteNoise only on the diagonal tiles
+                K = kern(_lags.Lags(x[rows]))
+                K[_np.diag_indices_from(K)] += yerr[rows]**2
+            else:
+                K = kern(_lags.Lags(x[rows], other=x[cols]))
+            block[:K.shape[0], :K.shape[1]] = K
+            if K.shape[0] < tile:
+                block[K.shape[0]:, :] = 0
+                block[:, K.shape[1]:] = 0
+                if i == j:
+                    pad = _np.arange(K.shape[0], tile)
+                    block[pad, pad] = 1
+    A.flush()
+    _profiling.toc('build_matrix', start)
+    return A
+
+
+def cholesky(A):
+    """
+        cholesky() factorizes in place the matrix of build_tiles(), which is
+    left with the tiles of the lower triangular factor L
+
+        Parameters
+    A = numpy.memmap of build_tiles()
+    """
+    start = _profiling.tic()
+    n = int(round((_np.sqrt(8*A.shape[0] + 1) - 1) / 2))
+    for k in range(n):
+        Lkk = _cholesky(A[_index(k, k)], lower=True)
+        A[_index(k, k)] = Lkk
+        for i in range(k + 1, n):
+            A[_index(i, k)] = _solve_triangular(Lkk, A[_index(i, k)].T,
+                                                lower=True).T
+        for i in range(k + 1, n):
+            Lik = _np.array(A[_index(i, k)])
+            for j in range(k + 1, i + 1):
+                A[_index(i, j)] -= _np.dot(Lik, A[_index(j, k)].T)
+    A.flush()
+    _profiling.toc('cholesky', start)
+
+
+def solve(L, y, trans=False):
+    """
+        solve() solves L.z = y (or L^T.z = y) with the tiles of cholesky()
+
+        Parameters
+    L = numpy.memmap factorized by cholesky()
+    y = right hand side, padded to a multiple of the tile size
+    trans = True to solve with L^T
+
+        Returns
+    z = solution
+    """
+    tile = L.shape[1]
+    n = y.size // tile
+    z = _np.array(y, dtype=float)
+    part = lambda i: slice(i*tile, (i + 1)*tile)
+    order = range(n - 1, -1, -1) if trans else range(n)
+    for i in order:
+        if trans:
+            for j in range(i + 1, n):
+                z[part(i)] -= _np.dot(L[_index(j, i)].T, z[part(j)])
+            z[part(i)] = _solve_triangular(L[_index(i, i)], z[part(i)],
+                                           lower=True, trans='T')
+        else:
+            for j in range(i):
+                z[part(i)] -= _np.dot(L[_index(i, j)], z[part(j)])
+            z[part(i)] = _solve_triangular(L[_index(i, i)], z[part(i)],
+                                           lower=True)
+    return z
+
+
+def likelihood(kern, x, y, yerr, tile=2048, directory=None, filename=None):
+    """
+        likelihood() calculates the marginal log likelihood with the
+    covariance matrix and its factorization on disk, the equivalent of
+    calc.likelihood() for N too large for the memory
+
+        Parameters
+    kern = kernel in use
+    x = range of values of the independent variable (usually time)
+    y = range of values of te dependent variable (the measurments)
+    yerr = error in the measurments
+    tile = size of the tiles, 8*tile**2 bytes each
+    directory = where to write the temporary file, a local disk is best
+    filename = file to keep the factorization in, a temporary file that is
+                deleted at the end if None
+
+        Returns
+    log_like = marginal log likelihood
+    alpha = K^-1.y
+    log_det = log(det(K))
+    """
+    _profiling.count('likelihood')
+    y = _np.asarray(y, dtype=float)
+    temporary = filename is None
+    if temporary:
+        handle, filename = _tempfile.mkstemp(suffix='.gedi', dir=directory)
+        _os.close(handle)
+    try:
+        L = build_tiles(kern, x, yerr, filename, tile)
+        cholesky(L)
+        start = _profiling.tic()
+        padded = _np.zeros(-(-y.size // tile) * tile)
+        padded[:y.size] = y
+        z = solve(L, padded)
+        alpha = solve(L, z, trans=True)[:y.size]
+        n = padded.size // tile
+        log_det = 0.
+        for i in range(n):
+            log_det += 2*_np.sum(_np.log(_np.diag(L[_index(i, i)])))
+        _profiling.toc('solve', start)
+        del L
+    finally:
+        if temporary:
+            _os.remove(filename)
+    log_like = -0.5*_np.dot(z, z) - 0.5*log_det \
+               - y.size*0.5*_np.log(2*_np.pi)
+    return log_like, alpha, log_det
+
+
+##### END
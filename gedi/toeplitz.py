@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Toeplitz fast path for regularly sampled time series.
+
+    For stationary kernels on a uniform time grid, with the same error on
+every point, the covariance matrix is Toeplitz and it is defined by its
+first row. The log likelihood is then computed with the Levinson-Durbin 
+recursion in O(N**2) time and O(N) memory, instead of the O(N**3) time and
+O(N**2) memory of the Cholesky factorization.
+"""
+import numpy as _np
+from scipy.linalg import solve_toeplitz as _solve_toeplitz
+
+from gedi import kernels as _kernels
+from gedi import lags as _lags
+
+
+def is_uniform(x, rtol=1e-8):
+    """
+        is_uniform() checks if x is a regularly sampled grid
+
+        Parameters
+    x = range of values of the independent variable (usually time)
+    rtol = relative tolerance on the spacing
+
+        Returns
+    True if the spacing between consecutive points is constant
+    """
+    dx = _np.diff(_np.asarray(x, dtype=float))
+    if dx.size == 0:
+        return True
+    return dx[0] > 0 and _np.allclose(dx, dx[0], rtol=rtol, atol=0)
+
+
+def first_row(kern, x, yerr):
+    """
+        first_row() evaluates the kernel only on the first row of the 
+    covariance matrix, all the other rows are shifted copies of it
+
+        Parameters
+    kern = kernel in use
+    x = uniform range of values of the independent variable (usually time)
+    yerr = error in the measurments, the same on every point
+
+        Returns
+    c = first row of the covariance matrix
+    """
+    x = _np.asarray(x, dtype=float)
+    if not is_uniform(x):
+        raise ValueError('first_row: x is not regularly sampled')
+    if not _kernels.is_stationary(kern):
+        raise ValueError('first_row: {0} is not stationary'.format(kern))
+    yerr = _np.asarray(yerr, dtype=float)
+    if yerr.ndim > 0 and not _np.all(yerr == yerr.flat[0]):
+        raise ValueError('first_row: yerr needs to be the same on every point')
+    c = kern((x - x[0])[None, :])[0]
+    c[0] += yerr.flat[0]**2
+    return c
+
+
+def levinson(c, y):
+    """
+        levinson() runs the Levinson-Durbin recursion on the symmetric 
+    Toeplitz matrix with first row c, whitening y at the same time
+
+        Parameters
+    c = first row of the matrix
+    y = vector to whiten
+
+        Returns
+    quad = y.K^-1.y
+    log_det = logarithm of the determinant of K
+    """
+    n = c.size
+    v = c[0]
+    if v <= 0:
+        raise _np.linalg.LinAlgError('levinson: matrix not positive definite')
+    phi = _np.zeros(0)
+    quad = y[0]**2 / v
+    log_det = _np.log(v)
+    for k in range(1, n):
+        #phi predicts point k from the k previous ones
+        kappa = (c[k] - _np.dot(phi, c[k-1:0:-1])) / v
+        phi = _np.append(phi - kappa*phi[::-1], kappa)
+        v = v * (1 - kappa**2)
+        if v <= 0:
+            raise _np.linalg.LinAlgError('levinson: matrix not positive '
+                                         'definite')
+        quad += (y[k] - _np.dot(phi, y[k-1::-1]))**2 / v
+        log_det += _np.log(v)
+    return quad, log_det
+
+
+def likelihood(kern, x, y, yerr):
+    """
+        likelihood() calculates the marginal log likelihood of regularly
+    sampled data, the equivalent of calc.likelihood()
+
+        Parameters
+    kern = kernel in use
+    x = uniform range of values of the independent variable (usually time)
+    y = range of values of te dependent variable (the measurments)
+    yerr = error in the measurments, the same on every point
+
+        Returns
+    log_like = marginal log likelihood
+    """
+    y = _np.asarray(y, dtype=float)
+    c = first_row(kern, x, yerr)
+    quad, log_det = levinson(c, y)
+    return -0.5*quad - 0.5*log_det - y.size*0.5*_np.log(2*_np.pi)
+
+
+def predict(kern, x, new_x, y, yerr, return_var=True):
+    """
+        predict() calculates the predictive mean and standard deviation on
+    new_x using the Toeplitz structure of the covariance matrix, the 
+    equivalent of calc.compute_kernel()
+
+        Parameters
+    kern = kernel in use
+    x = uniform range of values of the independent variable (usually time)
+    new_x = values where to predict, they need not be uniform
+    y = range of values of te dependent variable (the measurments)
+    yerr = error in the measurments, the same on every point
+    return_var = False to only calculate the mean
+
+        Returns
+    y_mean, y_std = mean and standard deviation (only y_mean if return_var
+                    is False)
+    """
+    x = _np.asarray(x, dtype=float)
+    new_x = _np.asarray(new_x, dtype=float)
+    c = first_row(kern, x, yerr)
+    #cross covariance and prior variance without the WhiteNoise
+    kstar = kern(_lags.Lags(new_x, other=x))
+    y_mean = _np.dot(kstar, _solve_toeplitz(c, y))
+    if not return_var:
+        return y_mean
+    y_var = kern(_lags.Lags(_np.zeros(1), other=_np.zeros(1)))[0, 0] \
+            - _np.sum(kstar * _solve_toeplitz(c, kstar.T).T, axis=1)
+    return y_mean, _np.sqrt(_np.maximum(y_var, 0))
+
+
+##### END
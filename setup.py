@@ -12,6 +12,7 @@ setup(	name = 'gedi',
 	url = 'https://github.com/jdavidrcamacho/Gedi', 
 	keywords = ['Gaussian', 'process','radial','velocity','exoplanet'],
 	classifiers = ['License :: OSI Approved :: MIT License'],
+	python_requires='>=3.6',
 	install_requires=[
         'numpy',
         'scipy',
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import gedi
 import gedi.calc as calc
 import gedi.kernels as kernels
+import gedi.rvfunction as rvfunction
 import numpy as np
 
 def test_gedi():
@@ -17,3 +19,500 @@ def test_gedi():
     loglike = calc.likelihood(kernel0, x, y, yerr, kepler = False)
     loglike2 = calc.likelihood(kernel0,x, y, yerr, kepler = True, kepler_params=[1, 1, 0.5, 50, 0])
     return loglike, loglike2
+
+def test_semisep():
+    #data, fixed as the approximations are compared with a tolerance
+    rng = np.random.RandomState(0)
+    x = 10 * np.sort(rng.rand(101))
+    yerr = 0.2 * np.ones_like(x)
+    y = np.sin(x) + yerr * rng.randn(len(x))
+
+    #exact semiseparable representations against the dense likelihood
+    kernel1 = kernels.Exponential(1,1) + kernels.WhiteNoise(0.1)
+    kernel2 = kernels.ExpSineSquared(1,1,2) * kernels.Exponential(1,5)
+    for kernel in [kernel1, kernel2]:
+        dense = calc.likelihood(kernel, x, y, yerr)
+        semisep = calc.likelihood(kernel, x, y, yerr, solver = 'semisep')
+        assert np.allclose(dense, semisep, rtol=1e-6)
+
+    #Matern 3/2 and quasi periodic kernels are approximations
+    dense = calc.likelihood(kernels.Matern32(1,1), x, y, yerr)
+    semisep = calc.likelihood(kernels.Matern32(1,1), x, y, yerr,
+                              solver = 'semisep')
+    #the eps=0.01 approximation moves the log likelihood by ~1e-3
+    assert np.allclose(dense, semisep, rtol=0, atol=5e-3)
+    kernel3 = kernels.QuasiPeriodic(1,1,5,2)
+    coeffs, white = gedi.semisep.kernel_terms(kernel3, span=10)
+    r = np.linspace(0, 10, 100)[:, None]
+    approx = np.exp(-coeffs[:,2]*r) * (coeffs[:,0]*np.cos(coeffs[:,3]*r) \
+                                       + coeffs[:,1]*np.sin(coeffs[:,3]*r))
+    assert np.max(np.abs(approx.sum(axis=1) - kernel3(r[:,0]))) < 1e-7
+    for kernel in [kernel3, kernels.QuasiPeriodic(1,0.7,10,3),
+                   kernels.ExpSquared(1,2) + kernels.WhiteNoise(0.1)]:
+        dense = calc.likelihood(kernel, x, y, yerr)
+        semisep = calc.likelihood(kernel, x, y, yerr, solver = 'semisep')
+        assert np.allclose(dense, semisep, rtol=1e-5)
+
+def test_likelihood_gradient():
+    #data
+    x = 10 * np.sort(np.random.rand(51))
+    yerr = 0.2 * np.ones_like(x)
+    y = np.sin(x) + yerr * np.random.randn(len(x))
+
+    kernel0 = kernels.QuasiPeriodic(1,1,5,2) + kernels.WhiteNoise(0.1)
+    loglike, grad = calc.likelihood_gradient(kernel0, x, y, yerr)
+    assert np.allclose(loglike, calc.likelihood(kernel0, x, y, yerr))
+
+    #finite differences in order to log(parameters)
+    pars, h = np.log(kernel0.pars), 1e-6
+    for i, e in enumerate(pars):
+        step = h * (np.arange(pars.size) == i)
+        up = calc.new_kernel(kernel0, np.exp(pars + step))
+        down = calc.new_kernel(kernel0, np.exp(pars - step))
+        numerical = (calc.likelihood(up, x, y, yerr) \
+                     - calc.likelihood(down, x, y, yerr)) / (2*h)
+        assert np.allclose(grad[i], numerical, rtol=1e-4, atol=1e-4)
+
+def test_value_and_derivatives():
+    x = 10 * np.sort(np.random.rand(21))
+    r = x[:, None] - x[None, :]
+    kernel0 = kernels.QuasiPeriodic(1,1,5,2) * kernels.RatQuadratic(1,2,3) \
+              + kernels.RQP(1,2,3,1,2)
+    K, dK = kernel0.value_and_derivatives(r)
+    assert np.allclose(K, kernel0(r))
+    assert dK.shape == (kernel0.pars.size,) + r.shape
+    assert np.allclose(dK[0], kernel0.k1.k1.dqp_dtheta(r) * kernel0.k1.k2(r))
+
+def test_kepler():
+    M = np.linspace(-10, 10, 1001)
+    for e in [0, 0.3, 0.9, 0.99]:
+        E, niter = rvfunction.eccentric_anomaly(M, e)
+        residual = np.mod(E - e*np.sin(E) - M + np.pi, 2*np.pi) - np.pi
+        assert np.allclose(residual, 0, atol=1e-10)
+        assert niter.max() < 100
+    #scalar mean anomaly
+    E, niter = rvfunction.eccentric_anomaly(1.0, 0.5)
+    assert np.ndim(E) == 0 and np.allclose(E - 0.5*np.sin(E), 1.0)
+    #circular orbit
+    t = np.linspace(0, 100, 101)
+    _, RV = rvfunction.kepler(P=10, K=2, e=0, w=0, T=0, t=t)
+    assert np.allclose(RV, 2*np.cos(2*np.pi*t/10))
+
+def test_batch_likelihood():
+    x = 10 * np.sort(np.random.rand(51))
+    yerr = 0.2 * np.ones_like(x)
+    y = np.sin(x) + yerr * np.random.randn(len(x))
+
+    kernel0 = kernels.ExpSquared(10,1) * kernels.ExpSineSquared(1,1,5) \
+              + kernels.WhiteNoise(0.1)
+    pars = kernel0.pars * np.exp(0.1 * np.random.randn(8, kernel0.pars.size))
+    loglikes = calc.batch_likelihood(kernel0, pars, x, y, yerr)
+    for p, loglike in zip(pars, loglikes):
+        kernel = calc.new_kernel(kernel0, p)
+        assert np.allclose(loglike, calc.likelihood(kernel, x, y, yerr))
+
+def test_pool_likelihood():
+    import pytest
+    pytest.importorskip('multiprocessing.shared_memory')
+    x = 10 * np.sort(np.random.rand(51))
+    yerr = 0.2 * np.ones_like(x)
+    y = np.sin(x) + yerr * np.random.randn(len(x))
+
+    kernel0 = kernels.ExpSquared(10,1) + kernels.WhiteNoise(0.1)
+    pars = kernel0.pars * np.exp(0.1 * np.random.randn(4, kernel0.pars.size))
+    with gedi.parallel.PoolLikelihood(kernel0, x, y, yerr, processes=2) as f:
+        loglikes = f(pars)
+    for p, loglike in zip(pars, loglikes):
+        kernel = calc.new_kernel(kernel0, p)
+        assert np.allclose(loglike, calc.likelihood(kernel, x, y, yerr))
+
+def test_lags():
+    x = 10 * np.sort(np.random.rand(51))
+    yerr = 0.2 * np.ones_like(x)
+    y = np.sin(x) + yerr * np.random.randn(len(x))
+
+    kernel0 = kernels.QuasiPeriodic(1,1,5,2) + kernels.WhiteNoise(0.1)
+    loglike, grad = calc.likelihood_gradient(kernel0, x, y, yerr)
+    for compact in [False, True]:
+        prepared = gedi.lags.Lags(x, compact = compact)
+        assert np.allclose(calc.build_matrix(kernel0, prepared, yerr),
+                           calc.build_matrix(kernel0, x, yerr))
+        loglike2, grad2 = calc.likelihood_gradient(kernel0, prepared, y, yerr)
+        assert np.allclose(loglike, loglike2) and np.allclose(grad, grad2)
+
+def test_toeplitz():
+    x = np.linspace(0, 10, 101)
+    yerr = 0.2 * np.ones_like(x)
+    y = np.sin(x) + yerr * np.random.randn(len(x))
+
+    kernel0 = kernels.QuasiPeriodic(1,1,5,2) + kernels.RatQuadratic(1,2,3)
+    dense = calc.likelihood(kernel0, x, y, yerr)
+    toeplitz = calc.likelihood(kernel0, x, y, yerr, solver = 'toeplitz')
+    assert np.allclose(dense, toeplitz)
+
+    new_x = np.linspace(0, 10, 17)
+    y_mean, y_std = gedi.toeplitz.predict(kernel0, x, new_x, y, yerr)
+    K = calc.build_matrix(kernel0, x, yerr)
+    kstar = kernel0(new_x[:, None] - x[None, :])
+    assert np.allclose(y_mean, np.dot(kstar, np.linalg.solve(K, y)))
+
+    kernel0 = kernels.ExpSquared(1, 2) + kernels.WhiteNoise(0.3)
+    y_mean, y_std = gedi.toeplitz.predict(kernel0, x, new_x, y, yerr)
+    dense_mean, dense_std = calc.compute_kernel(kernel0, x, new_x, y, yerr)
+    assert np.allclose(y_mean, dense_mean)
+    assert np.allclose(y_std, dense_std)
+
+def test_incremental():
+    x = 10 * np.sort(np.random.rand(61))
+    yerr = 0.2 * np.ones_like(x)
+    y = np.sin(x) + yerr * np.random.randn(len(x))
+
+    kernel0 = kernels.ExpSquared(10,1) + kernels.WhiteNoise(0.1)
+    gp = gedi.incremental.IncrementalGP(kernel0, x[:40], y[:40], yerr[:40])
+    gp.add(x[40:], y[40:], yerr[40:])
+    assert np.allclose(gp.log_likelihood(), 
+                       calc.likelihood(kernel0, x, y, yerr))
+    K = calc.build_matrix(kernel0, x, yerr)
+    assert np.allclose(gp.alpha, np.linalg.solve(K, y))
+
+    kernel0 = kernels.QuasiPeriodic(1, 1, 10, 3) * kernels.RatQuadratic(1, 2, 3) \
+              + kernels.WhiteNoise(0.3)
+    gp = gedi.incremental.IncrementalGP(kernel0, x[:40], y[:40], yerr[:40])
+    gp.add(x[40:], y[40:], yerr[40:])
+    new_x = np.linspace(0, 10, 17)
+    y_mean, y_std = gp.predict(new_x)
+    dense_mean, dense_std = calc.compute_kernel(kernel0, x, new_x, y, yerr)
+    assert np.allclose(y_mean, dense_mean)
+    assert np.allclose(y_std, dense_std)
+
+def test_compute_kernel():
+    x = 10 * np.sort(np.random.rand(51))
+    yerr = 0.2 * np.ones_like(x)
+    y = np.sin(x) + yerr * np.random.randn(len(x))
+    new_x = np.linspace(0, 10, 25)
+
+    kernel0 = kernels.ExpSquared(1,1)
+    y_mean, y_std = calc.compute_kernel(kernel0, x, new_x, y, yerr, chunk=7)
+    y_mean2, y_cov = calc.compute_kernel(kernel0, x, new_x, y, yerr,
+                                         return_cov = True)
+    K = calc.build_matrix(kernel0, x, yerr)
+    kstar = kernel0(new_x[:, None] - x[None, :])
+    assert np.allclose(y_mean, np.dot(kstar, np.linalg.solve(K, y)))
+    assert np.allclose(y_mean, y_mean2)
+    assert np.allclose(y_std, np.sqrt(np.diag(y_cov)))
+
+def test_sparse():
+    x = 10 * np.sort(np.random.rand(51))
+    yerr = 0.2 * np.ones_like(x)
+    y = np.sin(x) + yerr * np.random.randn(len(x))
+
+    kernel0 = kernels.ExpSquared(1,1) + kernels.WhiteNoise(0.1)
+    dense = calc.likelihood(kernel0, x, y, yerr)
+    for method in ['vfe', 'fitc']:
+        #with the inducing points on the data the approximation is exact
+        loglike = gedi.sparse.likelihood(kernel0, x, y, yerr, x, method,
+                                         jitter=1e-12)
+        assert np.allclose(loglike, dense, rtol=1e-6)
+
+        #finite differences in order to log(parameters)
+        xu = gedi.sparse.inducing_points(x, 10)
+        loglike, grad = gedi.sparse.likelihood_gradient(kernel0, x, y, yerr,
+                                                        xu, method)
+        pars, h = np.log(kernel0.pars), 1e-6
+        for i, e in enumerate(pars):
+            step = h * (np.arange(pars.size) == i)
+            up = calc.new_kernel(kernel0, np.exp(pars + step))
+            down = calc.new_kernel(kernel0, np.exp(pars - step))
+            numerical = (gedi.sparse.likelihood(up, x, y, yerr, xu, method) \
+                - gedi.sparse.likelihood(down, x, y, yerr, xu, method)) / (2*h)
+            assert np.allclose(grad[i], numerical, rtol=1e-4, atol=1e-4)
+
+    #non-stationary kernels, the prior variance changes with x
+    kernel0 = kernels.ExpSquared(1,1) + kernels.Linear(0.1) \
+              + kernels.WhiteNoise(0.1)
+    dense = calc.likelihood(kernel0, x, y, yerr)
+    new_x = np.linspace(0, 10, 13)
+    dense_mean, dense_std = calc.compute_kernel(kernel0, x, new_x, y, yerr)
+    for method in ['vfe', 'fitc']:
+        loglike, grad = gedi.sparse.likelihood_gradient(kernel0, x, y, yerr,
+                                                        x, method,
+                                                        jitter=1e-12)
+        assert np.allclose(loglike, dense, rtol=1e-6)
+        assert np.allclose(grad, calc.likelihood_gradient(kernel0, x, y,
+                                                          yerr)[1],
+                           rtol=1e-4, atol=1e-4)
+        y_mean, y_std = gedi.sparse.predict(kernel0, x, new_x, y, yerr, x,
+                                            method, jitter=1e-12)
+        assert np.allclose(y_mean, dense_mean, atol=1e-5)
+        assert np.allclose(y_std, dense_std, atol=1e-4)
+
+def test_mixed():
+    kernel0 = kernels.QuasiPeriodic(1, 1, 10, 3) + kernels.WhiteNoise(0.1)
+    #the error bound needs to hold for any data
+    for seed in range(5):
+        rng = np.random.RandomState(seed)
+        x = 10 * np.sort(rng.rand(rng.randint(50, 150)))
+        yerr = 0.2 * np.ones_like(x)
+        y = np.sin(x) + yerr * rng.randn(len(x))
+
+        dense, dense_grad = calc.likelihood_gradient(kernel0, x, y, yerr)
+        loglike, error = gedi.mixed.likelihood(kernel0, x, y, yerr)
+        assert np.allclose(loglike, dense, rtol=1e-5)
+        assert abs(loglike - dense) < error['log_like']
+        loglike, grad, error = gedi.mixed.likelihood_gradient(kernel0, x, y,
+                                                              yerr)
+        assert np.allclose(grad, dense_grad, rtol=5e-3, atol=5e-3)
+
+def test_compiled():
+    x = 10 * np.sort(np.random.rand(31))
+    r = x[:, None] - x[None, :]
+    k1, k2 = kernels.ExpSquared(1, 2), kernels.ExpSineSquared(1, 1, 3)
+    k3, k4 = kernels.Matern52(1, 2), kernels.WhiteNoise(0.1)
+    kernel0 = (k1 + k2) * k3 + k4
+    program = kernel0.compile()
+    assert np.allclose(program(r), (k1(r) + k2(r)) * k3(r) + k4(r))
+    #the buffers are reused while r keeps its shape
+    assert program(r) is program(r)
+    for lags in [gedi.lags.Lags(x, compact=True), gedi.lags.Lags(x, other=x[:5])]:
+        assert np.allclose(program(lags), (k1(lags) + k2(lags)) * k3(lags) + k4(lags))
+    #sums and products keep their program, repeated likelihoods reuse its buffers
+    y, yerr = np.sin(x), 0.2 * np.ones_like(x)
+    loglike = calc.likelihood(kernel0, x, y, yerr)
+    program = kernel0._program()
+    buffers = list(program._buffers)
+    assert np.allclose(calc.likelihood(kernel0, x, y, yerr), loglike)
+    assert kernel0._program() is program
+    assert all(a is b for a, b in zip(program._buffers, buffers))
+    assert kernel0(r) is not kernel0(r)
+    #and compile it again when their kernels change
+    kernel0.k2 = kernels.WhiteNoise(0.3)
+    assert kernel0._program() is not program
+    assert np.allclose(kernel0(r), kernel0.k1(r) + kernel0.k2(r))
+
+def test_parameter_vector():
+    kernel0 = (kernels.ExpSquared(1, 2) + kernels.RatQuadratic(1, 0.5, 3)) \
+        * kernels.WhiteNoise(0.1)
+    assert np.allclose(kernel0.get_parameter_vector(), [1, 2, 1, 0.5, 3, 0.1])
+    #updates in place, skipping the frozen alpha of RatQuadratic
+    kernel0.freeze_parameter(3)
+    kernel0.set_parameter_vector(np.log([2, 3, 4, 5, 6]), log=True)
+    assert np.allclose(kernel0.get_parameter_vector(include_frozen=True),
+                       [2, 3, 4, 0.5, 5, 6])
+    assert np.allclose([kernel0.k1.k2.RQ_theta, kernel0.k1.k2.RQ_l], [4, 5])
+    kernel1 = calc.new_kernel(kernel0, [1, 2, 3, 4, 5, 6])
+    assert np.allclose(kernel1.pars, [1, 2, 3, 4, 5, 6])
+    assert np.allclose(kernel0.pars, [2, 3, 4, 0.5, 5, 6])
+
+def test_gradient_tree():
+    x = 10 * np.sort(np.random.rand(41))
+    yerr = 0.2 * np.ones_like(x)
+    y = np.sin(x) + yerr * np.random.randn(len(x))
+
+    kernel0 = (kernels.ExpSquared(1, 3) + kernels.Matern32(0.5, 1)) \
+        * (kernels.ExpSineSquared(1, 1, 5) * kernels.RatQuadratic(1, 2, 4) \
+           + kernels.WhiteNoise(0.4)) + kernels.Exponential(0.3, 2)
+    grad = calc.gradient_likelihood(kernel0, x, y, yerr)
+    pars, h = np.log(kernel0.pars), 1e-6
+    for i, e in enumerate(pars):
+        step = h * (np.arange(pars.size) == i)
+        up = calc.new_kernel(kernel0, np.exp(pars + step))
+        down = calc.new_kernel(kernel0, np.exp(pars - step))
+        numerical = (calc.likelihood(up, x, y, yerr) \
+                     - calc.likelihood(down, x, y, yerr)) / (2*h)
+        assert np.allclose(grad[i], numerical, rtol=1e-4, atol=1e-4)
+
+def test_check_gradient():
+    x = 10 * np.sort(np.random.rand(31))
+    yerr = 0.2 * np.ones_like(x)
+    y = np.sin(x) + 0.1 * x + yerr * np.random.randn(len(x))
+
+    for kernel0 in [kernels.RQP(1, 3, 1.5, 0.8, 5), kernels.Linear(0.1),
+                    kernels.ExpSquared(1, 2), kernels.Matern52(1, 2)]:
+        assert np.all(calc.check_derivatives(kernel0, x) < 1e-6)
+    kernel0 = kernels.Linear(0.1) * kernels.RQP(1, 3, 1, 1, 5) \
+        + kernels.RQP(1, 3, 1.5, 0.8, 5) + kernels.WhiteNoise(0.1)
+    grad, numerical = calc.check_gradient(kernel0, x, y, yerr)
+    assert np.allclose(grad, numerical, rtol=1e-4, atol=1e-4)
+    y_mean, y_std = calc.compute_kernel(kernel0, x, x, y, yerr)
+    assert np.all(np.isfinite(y_std))
+
+def test_optimize():
+    x = 10 * np.sort(np.random.rand(41))
+    yerr = 0.2 * np.ones_like(x)
+    y = np.sin(x) + yerr * np.random.randn(len(x))
+
+    kernel0 = kernels.ExpSquared(1, 2) + kernels.WhiteNoise(0.1)
+    kernel0.freeze_parameter(2)
+    best, runs = gedi.optimize.optimize(kernel0, x, y, yerr, starts=3,
+                                        processes=2, seed=1,
+                                        bounds=[(0.1, 10), (0.1, 10)])
+    assert len(runs) == 3 and all(run['nfev'] > 0 for run in runs)
+    log_like = max(run['log_like'] for run in runs)
+    assert np.allclose(calc.likelihood(best, x, y, yerr), log_like)
+    assert log_like >= calc.likelihood(kernel0, x, y, yerr)
+    assert best.k2.WN_theta == 0.1 and kernel0.k1.ES_theta == 1
+
+def test_batch(tmp_path):
+    for i, n in enumerate([20, 40, 30]):
+        x = 10 * np.sort(np.random.rand(n))
+        np.savetxt(str(tmp_path / 'star{0}.txt'.format(i)),
+                   np.c_[x, np.sin(x) + 0.2*np.random.randn(n), 0.2*np.ones(n)])
+    output = str(tmp_path / 'results.jsonl')
+    kernel0 = kernels.ExpSquared(1, 2) + kernels.WhiteNoise(0.1)
+    results = gedi.batch.fit(kernel0, str(tmp_path), output, processes=1)
+    #largest first
+    assert [result['n'] for result in results] == [40, 30, 20]
+    assert all(result['status'] == 'ok' for result in results)
+    #nothing left to do when resuming
+    assert gedi.batch.fit(kernel0, str(tmp_path), output, processes=1) == []
+    assert len(gedi.batch.read_results(output)) == 3
+    #failed stars are retried
+    (tmp_path / 'star3.txt').write_text(u'not a number\n')
+    results = gedi.batch.fit(kernel0, str(tmp_path), output, processes=1)
+    assert [result['status'] for result in results] == ['failed']
+    assert gedi.batch.fit(kernel0, str(tmp_path), output, processes=1,
+                          retry_failed=False) == []
+    np.savetxt(str(tmp_path / 'star3.txt'), np.c_[x, np.sin(x), 0.2*np.ones(n)])
+    results = gedi.batch.fit(kernel0, str(tmp_path), output, processes=1)
+    assert [result['status'] for result in results] == ['ok']
+
+def test_benchmark():
+    import benchmark
+    report = benchmark.run([50, 100], ['likelihood', 'kepler'], repeat=1,
+                           verbose=False)
+    assert [result['status'] for result in report['results']] == ['ok']*4
+    assert set(benchmark.scaling(report)) == set(['likelihood', 'kepler'])
+    slower = {'results': [dict(result, seconds=result['seconds'] / 10.)
+                          for result in report['results']]}
+    assert benchmark.compare(report, report) == []
+    assert benchmark.compare(report, slower, min_seconds=0)
+
+def test_profiling():
+    x = 10 * np.sort(np.random.rand(31))
+    yerr = 0.2 * np.ones_like(x)
+    y = np.sin(x) + yerr * np.random.randn(len(x))
+
+    kernel0 = kernels.ExpSquared(1, 2) * kernels.ExpSineSquared(1, 1, 3)
+    with calc.Profile() as profile:
+        calc.likelihood(kernel0, x, y, yerr, True, [5, 1, 0.3, 1, 0])
+        calc.gradient_likelihood(kernel0, x, y, yerr)
+    report = profile.report()
+    for stage in ['build_matrix', 'cholesky', 'solve', 'gradient_trace',
+                  'kepler', 'kernel:ExpSquared', 'kernel:ExpSineSquared']:
+        assert report['timers'][stage]['calls'] > 0
+    assert report['counters']['likelihood'] == 1
+    assert report['counters']['kepler_iterations'] > 0
+    #nothing is recorded outside the with block
+    calc.likelihood(kernel0, x, y, yerr)
+    assert profile.report() == report
+
+def test_keplerian():
+    t = 100 * np.sort(np.random.rand(41))
+    planets = [[12.3, 4, 0.3, 1.2, 5], [45, 2, 0.6, 4, 10]]
+    mean = rvfunction.Keplerian(t, planets, gamma=1.5)
+    rv = 1.5 + sum(rvfunction.kepler(P=p[0], K=p[1], e=p[2], w=p[3], T=p[4],
+                                      t=t)[1] for p in planets)
+    assert np.allclose(mean.rv(), rv)
+
+    #joint gradient of the kernel and the orbits
+    yerr = np.ones_like(t)
+    y = rv + np.sin(t) + yerr * np.random.randn(len(t))
+    kernel0 = kernels.ExpSquared(1, 2)
+    loglike, grad = calc.likelihood_gradient(kernel0, t, y, yerr, mean)
+    assert np.allclose(loglike, calc.likelihood(kernel0, t, y - 1.5, yerr,
+                                                True, np.ravel(planets)))
+    pars, h = mean.get_parameter_vector(), 1e-6
+    for i, e in enumerate(pars):
+        step = h * (np.arange(pars.size) == i)
+        mean.set_parameter_vector(pars + step)
+        up = calc.likelihood(kernel0, t, y, yerr, True, mean)
+        mean.set_parameter_vector(pars - step)
+        down = calc.likelihood(kernel0, t, y, yerr, True, mean)
+        assert np.allclose(grad[2 + i], (up - down) / (2*h), rtol=1e-4,
+                           atol=1e-3)
+    mean.set_parameter_vector(pars)
+
+def test_periodogram():
+    x = 100 * np.sort(np.random.rand(61))
+    yerr = 0.5 * np.ones_like(x)
+    y = 3 + 2*np.sin(2*np.pi*x/7.3) + yerr * np.random.randn(len(x))
+
+    kernel0 = kernels.ExpSquared(0.5, 20)
+    frequencies = gedi.periodogram.frequency_grid(x, fmax=0.5)
+    delta_chi2, loglike = gedi.periodogram.periodogram(kernel0, x, y, yerr,
+                                                       frequencies, chunk=64)
+    best = np.argmax(delta_chi2)
+    assert abs(1/frequencies[best] - 7.3) < 0.2
+    #the same as the likelihood of the residuals of the weighted fit
+    A = np.c_[np.ones_like(x), np.cos(2*np.pi*frequencies[best]*x),
+              np.sin(2*np.pi*frequencies[best]*x)]
+    Kinv = np.linalg.inv(calc.build_matrix(kernel0, x, yerr))
+    coeffs = np.linalg.solve(A.T.dot(Kinv).dot(A), A.T.dot(Kinv).dot(y))
+    assert np.allclose(loglike[best],
+                       calc.likelihood(kernel0, x, y - A.dot(coeffs), yerr))
+
+def test_multioutput():
+    t = np.sort(10 * np.random.rand(15))
+    x_list = [t, t, t[::2]]
+    yerr_list = [0.1 + 0.1*np.random.rand(e.size) for e in x_list]
+    y_list = [np.random.randn(e.size) for e in x_list]
+    latent = [kernels.QuasiPeriodic(1.5, 0.8, 12, 3),
+              kernels.ExpSquared(0.7, 2)]
+    a, b = np.array([[1, 0.5, -0.3], [0.2, 0, 1]]), \
+        np.array([[0.8, 0, 0.4], [0, 0, 0]])
+    jitter = np.array([0.1, 0.2, 0.3])
+    K = gedi.multioutput.covariance(latent, x_list, yerr_list, a, b, jitter)
+
+    #derivative of the latent processes as a finite difference
+    h = 1e-4
+    expected = np.diag(np.concatenate([e**2 + j**2 for e, j in
+                                       zip(yerr_list, jitter)]))
+    for q, kern in enumerate(latent):
+        points = np.concatenate([e + d for e in x_list
+                                 for d in (0, h, -h)])
+        W = np.zeros((expected.shape[0], points.size))
+        for i, (s, j) in enumerate([(s, j) for s, e in enumerate(x_list)
+                                    for j in range(e.size)]):
+            start = 3 * sum(e.size for e in x_list[:s])
+            W[i, start + j] = a[q, s]
+            W[i, start + x_list[s].size + j] = b[q, s] / (2*h)
+            W[i, start + 2*x_list[s].size + j] = -b[q, s] / (2*h)
+        expected += W.dot(kern(points[:, None] - points[None, :])).dot(W.T)
+    assert np.allclose(K, expected, atol=1e-5)
+
+    y = np.concatenate(y_list)
+    assert np.allclose(gedi.multioutput.likelihood(latent, x_list, y_list,
+                                                   yerr_list, a, b, jitter),
+                       calc._log_likelihood(expected, y), rtol=1e-4)
+
+def test_kronecker():
+    x = np.sort(20 * np.random.rand(25))
+    kernel0 = kernels.QuasiPeriodic(1.5, 0.8, 12, 3)
+    a = np.array([1.0, 0.8, 1.3])
+    instruments = np.outer(a, a) + np.diag([0.1, 0.05, 0.2])
+    yerr, jitter = np.array([0.3, 0.5, 0.2]), np.array([0.1, 0.0, 0.4])
+    offsets = np.array([5.0, -2.0, 1.0])
+    y = offsets[:, None] + np.random.randn(3, x.size)
+
+    #dense matrix of the points ordered instrument by instrument
+    K = np.kron(instruments, calc.build_matrix(kernel0, x, 0.)) \
+        + np.diag(np.repeat(yerr**2 + jitter**2, x.size))
+    expected = calc._log_likelihood(K, np.ravel(y - offsets[:, None]))
+    assert np.allclose(gedi.kronecker.likelihood(kernel0, x, y, yerr,
+                                                 instruments, offsets,
+                                                 jitter), expected)
+
+def test_tiled(tmp_path):
+    x = 10 * np.sort(np.random.rand(53))
+    yerr = 0.2 + 0.1*np.random.rand(len(x))
+    y = np.sin(x) + yerr * np.random.randn(len(x))
+
+    kernel0 = kernels.QuasiPeriodic(1, 1, 10, 3) + kernels.WhiteNoise(0.1)
+    K = calc.build_matrix(kernel0, x, yerr)
+    loglike, alpha, log_det = gedi.tiled.likelihood(kernel0, x, y, yerr,
+                                                    tile=16,
+                                                    directory=str(tmp_path))
+    assert np.allclose(loglike, calc.likelihood(kernel0, x, y, yerr))
+    assert np.allclose(alpha, np.linalg.solve(K, y))
+    assert np.allclose(log_det, np.linalg.slogdet(K)[1])
+    assert not list(tmp_path.iterdir())